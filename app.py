@@ -1,12 +1,15 @@
 import streamlit as st
 import os
-import json
-import numpy as np
 import re
 
 # Import các hàm xử lý từ các module common.py và kb.py
-from common import embed_texts, generate_answer
-from kb import read_document, split_into_chunks, save_knowledge, load_knowledge
+from common import embed_texts, generate_answer_stream, embed_cache_stats, api_client_stats, PRIORITY_BATCH
+import jobs
+import batch
+import metrics
+import registry
+from kb import hybrid_search, pack_context, CONTEXT_CANDIDATES
+from kb import get_answer_cache, answer_cache_stats, kb_cache_stats, chunk_source, missing_vectors
 
 # Thiết lập thư mục lưu trữ dữ liệu
 DATA_DIR = "data"
@@ -18,6 +21,28 @@ def safe_filename(name: str) -> str:
     # Thay thế các chuỗi ký tự không phải chữ, số, hoặc gạch dưới bằng ký tự gạch dưới "_"
     return re.sub(r'\W+', '_', name.strip())
 
+# Mô tả vị trí một đoạn nguồn: tệp, mục (đường dẫn tiêu đề) và trang nếu chủ đề có lưu
+def source_location(class_code: str, hit) -> str:
+    meta = chunk_source(class_code, hit.topic, hit.index)
+    if not meta:
+        return f"đoạn {hit.index + 1}"
+    parts = [meta["source"]] if meta.get("source") else []
+    if meta["headings"]:
+        parts.append(" › ".join(meta["headings"]))
+    if meta["page"]:
+        start, end = meta["page"]
+        parts.append(f"tr. {start}" if start == end else f"tr. {start}–{end}")
+    return ", ".join(parts) or f"đoạn {hit.index + 1}"
+
+# Chạy tiếp các job tạo chủ đề bị ngắt ở lần chạy trước (chỉ 1 lần mỗi process)
+jobs.resume_pending_jobs()
+
+# Chuyển các file <lớp>_info.json cũ vào sổ đăng ký lớp (chỉ lần đầu, kiểm tra 1 lần mỗi process)
+registry.import_legacy_info()
+
+# Cache câu trả lời dùng chung cho mọi học sinh trong process
+answer_cache = get_answer_cache()
+
 # Cấu hình trang Streamlit
 st.set_page_config(page_title="AI Teaching Assistant Chatbot", layout="wide")
 
@@ -38,13 +63,27 @@ if mode == "Giáo viên":
             st.sidebar.error("⚠️ Không tìm thấy TEACHER_PIN trong cấu hình ứng dụng.")
         elif pin_input == st.secrets["TEACHER_PIN"]:
             st.sidebar.success("✅ Đăng nhập thành công! Bạn có thể quản lý lớp học.")
-            # Đọc danh sách các lớp đã có (dựa trên các file info trong thư mục DATA_DIR)
-            class_codes = []
-            for fname in os.listdir(DATA_DIR):
-                if fname.endswith("_info.json"):
-                    code = fname.replace("_info.json", "")
-                    class_codes.append(code)
-            class_codes.sort()
+            # Thống kê hiệu quả các bộ nhớ đệm (embedding, tri thức, câu trả lời)
+            with st.sidebar.expander("📊 Thống kê bộ nhớ đệm"):
+                ans_stats = answer_cache_stats()
+                st.write(f"**Câu trả lời:** tỉ lệ trúng {ans_stats['hit_rate']:.0%} "
+                         f"({ans_stats['hits']} trúng / {ans_stats['misses']} trượt, {ans_stats['entries']} mục)")
+                st.write("**Embedding:**", embed_cache_stats())
+                st.write("**Gọi API** (gộp = request trùng dùng chung kết quả):", api_client_stats())
+                st.write("**Tri thức đã nạp:**", kb_cache_stats())
+            # Thời gian từng công đoạn (p50/p95) và các bộ đếm kể từ khi process khởi động
+            with st.sidebar.expander("🩺 Chẩn đoán hiệu năng"):
+                diag = metrics.summary()
+                if not metrics.ENABLED:
+                    st.caption("Đang tắt đo hiệu năng (METRICS=0).")
+                elif not diag["stages"]:
+                    st.caption("Chưa có số liệu. Hãy đặt thử một câu hỏi ở chế độ Học sinh.")
+                else:
+                    st.table([dict(stage=k, **v) for k, v in diag["stages"].items()])
+                    st.write("**Bộ đếm:**", diag["counters"])
+                    st.caption(f"Chi tiết từng câu hỏi: `{metrics.METRICS_PATH}`")
+            # Đọc danh sách các lớp đã có (từ sổ đăng ký lớp, đã sắp xếp)
+            class_codes = registry.list_classes()
 
             # Giao diện tạo lớp mới
             st.subheader("Tạo lớp mới")
@@ -62,19 +101,10 @@ if mode == "Giáo viên":
                         # Cảnh báo nếu mã lớp được điều chỉnh khác với input ban đầu
                         if safe_code != new_class_code_input:
                             st.info(f"Mã lớp đã được chuyển thành **{safe_code}** để phù hợp.")
-                        # Kiểm tra lớp đã tồn tại chưa
-                        info_path = os.path.join(DATA_DIR, f"{safe_code}_info.json")
-                        if os.path.exists(info_path):
+                        # Tạo lớp mới (trong một giao dịch: không tạo trùng nếu hai giáo viên bấm cùng lúc)
+                        if not registry.create_class(safe_code):
                             st.error(f"⚠️ Lớp \"{safe_code}\" đã tồn tại. Hãy chọn mã lớp khác.")
                         else:
-                            # Tạo file thông tin lớp mới
-                            class_info = {
-                                "class_code": safe_code,
-                                "students": [],
-                                "topics": []
-                            }
-                            with open(info_path, "w", encoding="utf-8") as f:
-                                json.dump(class_info, f, ensure_ascii=False, indent=2)
                             st.success(f"✅ Đã tạo lớp mới với mã: **{safe_code}**")
                             # Cập nhật danh sách lớp
                             class_codes.append(safe_code)
@@ -94,10 +124,8 @@ if mode == "Giáo viên":
                 st.session_state["selected_class"] = selected_class
 
                 # Hiển thị thông tin lớp được chọn
-                info_path = os.path.join(DATA_DIR, f"{selected_class}_info.json")
-                if os.path.exists(info_path):
-                    with open(info_path, "r", encoding="utf-8") as f:
-                        class_info = json.load(f)
+                class_info = registry.get_class(selected_class)
+                if class_info is not None:
                     students = class_info.get("students", [])
                     topics = class_info.get("topics", [])
                     st.write(f"**Mã lớp:** {selected_class}")
@@ -105,6 +133,7 @@ if mode == "Giáo viên":
                     st.write(f"**Số chủ đề kiến thức:** {len(topics)} - " + (", ".join(t['name'] for t in topics) if topics else "Chưa có"))
                 else:
                     st.warning("Không tìm thấy thông tin lớp đã chọn.")
+                    class_info = {"class_code": selected_class, "students": [], "topics": []}
 
                 # Thêm học sinh vào lớp
                 st.subheader("Thêm học sinh")
@@ -114,71 +143,154 @@ if mode == "Giáo viên":
                     if not new_student:
                         st.warning("Vui lòng nhập tên học sinh.")
                     else:
-                        # Đọc thông tin lớp, thêm học sinh, lưu lại
-                        with open(info_path, "r", encoding="utf-8") as f:
-                            class_info = json.load(f)
-                        # Kiểm tra trùng tên (không bắt buộc duy nhất nhưng tránh thêm 2 lần)
-                        if new_student in class_info.get("students", []):
+                        # Thêm học sinh (trùng tên thì bỏ qua để tránh thêm 2 lần)
+                        if not registry.add_student(selected_class, new_student):
                             st.warning(f"Học sinh \"{new_student}\" đã có trong lớp.")
                         else:
-                            class_info.setdefault("students", []).append(new_student)
-                            with open(info_path, "w", encoding="utf-8") as f:
-                                json.dump(class_info, f, ensure_ascii=False, indent=2)
                             st.success(f"✅ Đã thêm học sinh **{new_student}** vào lớp **{selected_class}**")
 
                 # Upload tài liệu để tạo chủ đề mới
                 st.subheader("Tạo chủ đề kiến thức")
                 topic_name_input = st.text_input("Nhập tên chủ đề:")
-                uploaded_file = st.file_uploader("Tải lên tài liệu cho chủ đề:", type=["pdf", "docx", "txt"])
+                # Một chủ đề có thể gồm nhiều tệp (vd. các chương) hoặc một tệp ZIP, được đọc song song
+                uploaded_files = st.file_uploader("Tải lên tài liệu cho chủ đề (một hoặc nhiều tệp, hoặc ZIP):",
+                                                  type=["pdf", "docx", "txt", "zip"], accept_multiple_files=True)
                 create_topic_btn = st.button("Tạo chủ đề")
                 if create_topic_btn:
                     if not topic_name_input:
                         st.warning("Vui lòng nhập tên chủ đề.")
-                    elif not uploaded_file:
-                        st.warning("Vui lòng chọn một tệp tài liệu.")
+                    elif not uploaded_files:
+                        st.warning("Vui lòng chọn ít nhất một tệp tài liệu.")
                     else:
-                        # Đảm bảo đã có thư mục data, tạo nếu chưa
-                        if not os.path.exists(DATA_DIR):
-                            os.makedirs(DATA_DIR)
-                        # Đọc nội dung tài liệu
-                        try:
-                            document_text = read_document(uploaded_file)
-                        except Exception as e:
-                            st.error(f"❌ Lỗi: Không thể đọc file. Chi tiết: {e}")
-                            document_text = None
-                        if document_text is None or document_text.strip() == "":
-                            st.error("❌ Không thể lấy nội dung từ tài liệu đã upload.")
+                        # Tạo tên tập tin an toàn cho chủ đề
+                        safe_topic = safe_filename(topic_name_input)
+                        if safe_topic == "":
+                            safe_topic = "topic"
+                        # Kiểm tra chủ đề đã tồn tại trong lớp chưa (trước khi tốn công nhúng tài liệu)
+                        topic_exists = False
+                        for t in class_info.get("topics", []):
+                            if t["file"] == safe_topic or t["name"] == topic_name_input:
+                                topic_exists = True
+                                break
+                        if topic_exists:
+                            st.error("⚠️ Chủ đề này đã tồn tại. Vui lòng chọn tên khác.")
+                        elif jobs.has_pending_topic(selected_class, safe_topic, topic_name_input):
+                            st.warning("⏳ Chủ đề này đang được xử lý. Vui lòng chờ hoàn tất.")
+                        else:
+                            # Đưa vào hàng đợi chạy nền: đọc → chia đoạn → nhúng → lưu, có checkpoint.
+                            # Tắt tab hay rerun không làm mất việc; chủ đề chỉ hiện trong lớp khi đã xong.
+                            try:
+                                jobs.submit_job(selected_class, topic_name_input, safe_topic, uploaded_files)
+                                st.info(f"⏳ Đã đưa chủ đề **{topic_name_input}** vào hàng đợi xử lý. Theo dõi tiến độ bên dưới.")
+                            except ValueError as e:
+                                st.error(f"⚠️ {e}")
+
+                # Cập nhật tài liệu của chủ đề đã có (chỉ nhúng lại các đoạn thay đổi)
+                existing_topics = class_info.get("topics", [])
+                if existing_topics:
+                    st.subheader("Cập nhật chủ đề")
+                    # chủ đề chuyển từ bản cũ có đoạn không khớp vector: chỉ tìm được theo từ khóa
+                    stale = [t["name"] for t in existing_topics if missing_vectors(selected_class, t["file"])]
+                    if stale:
+                        st.warning("⚠️ Một số đoạn của chủ đề " + ", ".join(f"**{n}**" for n in stale)
+                                   + " chưa có vector (dữ liệu cũ). Hãy tải lại tài liệu để cập nhật chủ đề.")
+                    update_topic_name = st.selectbox("Chọn chủ đề cần cập nhật:", [t["name"] for t in existing_topics])
+                    update_files = st.file_uploader("Tải lên tài liệu mới cho chủ đề:", type=["pdf", "docx", "txt", "zip"],
+                                                    accept_multiple_files=True, key="update_file")
+                    if st.button("Cập nhật chủ đề"):
+                        update_topic = next(t for t in existing_topics if t["name"] == update_topic_name)
+                        if not update_files:
+                            st.warning("Vui lòng chọn ít nhất một tệp tài liệu.")
+                        elif jobs.has_pending_topic(selected_class, update_topic["file"], update_topic["name"]):
+                            st.warning("⏳ Chủ đề này đang được xử lý. Vui lòng chờ hoàn tất.")
+                        else:
+                            try:
+                                jobs.submit_job(selected_class, update_topic["name"], update_topic["file"], update_files,
+                                                mode="update")
+                                st.info(f"⏳ Đang cập nhật chủ đề **{update_topic['name']}**. Học sinh vẫn dùng bản cũ cho tới khi xong.")
+                            except ValueError as e:
+                                st.error(f"⚠️ {e}")
+
+                # Tạo sẵn đáp án cho cả bộ câu hỏi ôn tập (nhúng + tìm kiếm theo lô, sinh song song)
+                if existing_topics:
+                    st.subheader("Tạo đáp án cho bộ câu hỏi")
+                    bank_topics = st.multiselect("Chủ đề dùng để trả lời:", [t["name"] for t in existing_topics],
+                                                 default=[t["name"] for t in existing_topics])
+                    bank_text = st.text_area("Danh sách câu hỏi (mỗi dòng một câu):", key="bank_text")
+                    bank_file = st.file_uploader("Hoặc tải lên tệp .txt (mỗi dòng một câu):", type=["txt"], key="bank_file")
+                    if st.button("Tạo đáp án"):
+                        questions = batch.parse_questions(bank_text)
+                        if bank_file is not None:
+                            questions += batch.parse_questions(bank_file.getvalue().decode("utf-8", errors="ignore"))
+                        slugs = [t["file"] for t in existing_topics if t["name"] in bank_topics]
+                        if not questions:
+                            st.warning("Vui lòng nhập ít nhất một câu hỏi.")
+                        elif not slugs:
+                            st.warning("Vui lòng chọn ít nhất một chủ đề.")
+                        else:
+                            if len(questions) > batch.BATCH_MAX_QUESTIONS:
+                                st.info(f"Chỉ xử lý {batch.BATCH_MAX_QUESTIONS} câu đầu tiên.")
+                            bar = st.progress(0.0, text="Đang tạo đáp án...")
+                            batch_stats: dict = {}
+                            rows = batch.answer_batch(
+                                selected_class, slugs, questions,
+                                on_progress=lambda d, n: bar.progress(d / n, text=f"Đã trả lời {d}/{n} câu"),
+                                priority=PRIORITY_BATCH,   # nhường lượt gọi API cho học sinh đang hỏi
+                                stats=batch_stats,
+                            )
+                            for msg in batch_stats["errors"]:
+                                st.error(msg)
+                            st.session_state["bank_result"] = (selected_class, rows)
+                    bank_result = st.session_state.get("bank_result")
+                    if bank_result and bank_result[0] == selected_class:
+                        rows = bank_result[1]
+                        names = {t["file"]: t["name"] for t in existing_topics}
+                        n_err = sum(r["error"] for r in rows)
+                        st.write(f"✅ {len(rows)} câu ({sum(r['cached'] for r in rows)} câu lấy từ bộ nhớ đệm"
+                                 + (f", {n_err} câu lỗi" if n_err else "") + ")")
+                        col_csv, col_json = st.columns(2)
+                        col_csv.download_button("⬇️ Tải CSV", batch.export_answers(rows, "csv", names),
+                                                file_name=f"dap_an_{selected_class}.csv", mime="text/csv")
+                        col_json.download_button("⬇️ Tải JSON", batch.export_answers(rows, "json", names),
+                                                 file_name=f"dap_an_{selected_class}.json", mime="application/json")
+
+                # Tiến độ các chủ đề đang xử lý nền của lớp
+                def show_jobs():
+                    class_jobs = jobs.list_jobs(selected_class)[:10]
+                    if not class_jobs:
+                        return
+                    st.subheader("Tiến độ tạo chủ đề")
+                    for job in class_jobs:
+                        label = f"**{job['topic_name']}** ({job['filename']})"
+                        files = job.get("files") or []
+                        failed = [f for f in files if f.get("error")]
+                        if job["status"] == "done":
+                            reused = job.get("chunks_reused") or 0
+                            st.write(f"✅ {label}: hoàn tất, {job['chunks_embedded']} đoạn"
+                                     + (f" ({reused} đoạn không đổi được dùng lại)" if reused else ""))
+                            for f in failed:
+                                st.caption(f"⚠️ {f['name']}: {f['error']}")
+                        elif job["status"] == "error":
+                            st.write(f"❌ {label}: lỗi – {job['error']}")
+                            if st.button("Thử lại", key=f"retry_{job['id']}"):
+                                jobs.retry_job(job["id"])
                         else:
-                            # Chia nhỏ tài liệu thành các đoạn (chunks)
-                            chunks = split_into_chunks(document_text)
-                            if not chunks or len(chunks) == 0:
-                                st.error("❌ Tài liệu quá ngắn hoặc không thể tạo đoạn văn bản.")
+                            if job.get("files_total", 1) > 1:
+                                pages_txt = f"{job.get('files_done', 0)}/{job['files_total']} tệp"
                             else:
-                                # Nhúng vector cho các đoạn văn bản (sử dụng hàm embed_texts)
-                                with st.spinner("Đang xử lý và lưu trữ tri thức..."):
-                                    embeddings = embed_texts(chunks)
-                                    # Chuyển embeddings sang numpy array (nếu cần)
-                                    embeddings = np.array(embeddings)
-                                    # Tạo tên tập tin an toàn cho chủ đề
-                                    safe_topic = safe_filename(topic_name_input)
-                                    if safe_topic == "":
-                                        safe_topic = "topic"
-                                    # Kiểm tra chủ đề đã tồn tại trong lớp chưa (dựa trên tên file hoặc tên chủ đề)
-                                    topic_exists = False
-                                    for t in class_info.get("topics", []):
-                                        if t["file"] == safe_topic or t["name"] == topic_name_input:
-                                            topic_exists = True
-                                            break
-                                    if topic_exists:
-                                        st.error("⚠️ Chủ đề này đã tồn tại. Vui lòng chọn tên khác.")
-                                    else:
-                                        # Lưu kiến thức (chunks và embeddings) ra file JSON + NPY
-                                        save_knowledge(selected_class, safe_topic, chunks, embeddings)
-                                        # Cập nhật thông tin chủ đề vào file info của lớp
-                                        class_info.setdefault("topics", []).append({"name": topic_name_input, "file": safe_topic})
-                                        with open(info_path, "w", encoding="utf-8") as f:
-                                            json.dump(class_info, f, ensure_ascii=False, indent=2)
-                                        st.success(f"✅ Đã tạo chủ đề **{topic_name_input}** cho lớp **{selected_class}**")
+                                pages_txt = (f"{job['pages_done']}/{job['pages_total']} trang" if job["pages_total"]
+                                             else f"{job['pages_done']} phần")
+                            total = max(job["chunks_total"], 1)
+                            st.progress(min(job["chunks_embedded"] / total, 1.0),
+                                        text=f"⏳ {label}: đã đọc {pages_txt}, đã nhúng {job['chunks_embedded']}/{job['chunks_total']} đoạn")
+                    if any(j["status"] in ("queued", "running") for j in class_jobs):
+                        st.button("🔄 Làm mới tiến độ")
+
+                # Streamlit mới có st.fragment: tự làm mới phần tiến độ mỗi 2 giây mà không chạy lại cả trang
+                if hasattr(st, "fragment"):
+                    st.fragment(run_every=2)(show_jobs)()
+                else:
+                    show_jobs()
         else:
             st.sidebar.error("❌ Mã PIN không đúng. Vui lòng thử lại.")
 
@@ -198,8 +310,7 @@ elif mode == "Học sinh":
         else:
             # Chuẩn hóa mã lớp giống như khi tạo (đảm bảo khớp tên file)
             class_code_safe = safe_filename(class_code)
-            info_path = os.path.join(DATA_DIR, f"{class_code_safe}_info.json")
-            if not os.path.exists(info_path):
+            if not registry.class_exists(class_code_safe):
                 st.error("❌ Mã lớp không hợp lệ hoặc lớp chưa được tạo.")
             else:
                 # Lưu mã lớp đã chọn vào session state để giữ trạng thái đăng nhập lớp
@@ -209,10 +320,8 @@ elif mode == "Học sinh":
     # Nếu học sinh đã vào lớp (mã lớp hợp lệ được lưu)
     if "current_class" in st.session_state:
         class_code = st.session_state["current_class"]
-        info_path = os.path.join(DATA_DIR, f"{class_code}_info.json")
         # Đọc thông tin lớp để lấy danh sách chủ đề
-        with open(info_path, "r", encoding="utf-8") as f:
-            class_info = json.load(f)
+        class_info = registry.get_class(class_code) or {}
         topics = class_info.get("topics", [])
         if not topics:
             st.warning("Lớp này hiện chưa có chủ đề kiến thức nào. Vui lòng quay lại sau.")
@@ -244,37 +353,80 @@ elif mode == "Học sinh":
                         del st.session_state["last_answer"]
                 # Nhập câu hỏi
                 question = st.text_input("Đặt câu hỏi của bạn:")
+                search_all = st.checkbox("Tìm trong tất cả chủ đề của lớp", value=False)
                 ask_btn = st.button("Hỏi")
                 if ask_btn:
                     if not question:
                         st.warning("Vui lòng nhập câu hỏi.")
                     else:
-                        # Tải tri thức của chủ đề (chunks và embeddings)
-                        chunks, embeddings = load_knowledge(class_code, topic_file)
-                        embeddings = np.array(embeddings)
-                        # Tính vector embedding cho câu hỏi
-                        question_embedding = embed_texts([question])
-                        question_embedding = np.array(question_embedding[0] if isinstance(question_embedding, list) else question_embedding)
-                        # Tính độ tương đồng cosine giữa câu hỏi và các đoạn kiến thức
-                        # Sử dụng công thức: cos_sim = (A·B) / (||A||*||B||)
-                        q_norm = np.linalg.norm(question_embedding)
-                        emb_norms = np.linalg.norm(embeddings, axis=1)
-                        # Tránh chia cho 0
-                        denom = (emb_norms * q_norm + 1e-8)
-                        cosine_similarities = np.dot(embeddings, question_embedding) / denom
-                        # Lấy chỉ số của một số đoạn văn bản liên quan nhất (ví dụ top 3)
-                        top_k = 3
-                        if len(cosine_similarities) < top_k:
-                            top_k = len(cosine_similarities)
-                        top_indices = cosine_similarities.argsort()[::-1][:top_k]
-                        relevant_chunks = [chunks[i] for i in top_indices]
-                        # Gọi hàm sinh câu trả lời từ AI với ngữ cảnh
-                        with st.spinner("Đang tìm câu trả lời..."):
-                            answer = generate_answer(question, relevant_chunks)
-                        # Hiển thị câu trả lời
-                        st.write("**Trợ lý:** " + str(answer))
-                        # Lưu câu trả lời vào session (có thể dùng nếu muốn hiển thị lại)
-                        st.session_state["last_answer"] = str(answer)
+                        # Đo thời gian từng công đoạn của câu hỏi (ghi vào data/metrics.jsonl)
+                        with metrics.trace("ask", class_code=class_code, search_all=search_all) as tr:
+                            # Tìm các đoạn liên quan nhất trong chủ đề đang chọn hoặc cả lớp:
+                            # kết hợp từ khóa (BM25) + vector; câu hỏi khớp từ khóa rõ ràng thì không cần nhúng
+                            search_topics = [t["file"] for t in topics] if search_all else [topic_file]
+                            topic_names_by_file = {t["file"]: t["name"] for t in topics}
+                            hits, question_embedding = hybrid_search(
+                                class_code, search_topics, question,
+                                lambda q: embed_texts([q], task_type="retrieval_query")[0], top_k=CONTEXT_CANDIDATES,
+                            )
+                            if not hits:
+                                # không raise st.stop() trong trace: ghi rõ trường hợp không có kết quả thay vì lỗi
+                                tr.set(no_hits=True)
+                                st.error("❌ Không tải được tri thức của chủ đề này.")
+                            else:
+                                # Ghép ngữ cảnh trong ngân sách token: bỏ đoạn trùng, thêm đoạn liền kề nếu còn chỗ
+                                packed = pack_context(class_code, hits)
+                                tr.set(topics=len(search_topics), context_tokens=packed.tokens,
+                                       lexical_only=question_embedding is None)
+                                hits = packed.hits
+                                relevant_chunks = packed.chunks
+                                st.write("**Trợ lý:**")
+                                # Câu hỏi gần như trùng một câu đã trả lời (cùng chủ đề, cùng phiên bản tri thức) → dùng lại
+                                # câu hỏi trả lời bằng từ khóa (không nhúng) được tra theo văn bản câu hỏi
+                                cached = answer_cache.lookup(class_code, search_topics, question_embedding, hits,
+                                                             question=question)
+                                if cached is not None:
+                                    answer = cached["answer"]
+                                    tr.set(answer_cache=True)
+                                    st.write(answer)
+                                    st.caption("⚡ Trả lời từ bộ nhớ đệm (câu hỏi tương tự đã được trả lời trước đó)")
+                                else:
+                                    # Gọi AI sinh câu trả lời với ngữ cảnh, hiển thị dần từng đoạn khi mô hình trả về
+                                    gen_stats = {}
+                                    answer = st.write_stream(generate_answer_stream(question, relevant_chunks, stats=gen_stats))
+                                    if not gen_stats.get("error"):
+                                        answer_cache.store(class_code, search_topics, question_embedding, question, str(answer), hits)
+                                    if gen_stats.get("ttft") is not None:
+                                        st.caption(f"⏱️ Phản hồi đầu tiên sau {gen_stats['ttft']:.2f}s, hoàn tất sau {gen_stats['total']:.2f}s"
+                                                   f" · ~{gen_stats['prompt_tokens']} token đầu vào"
+                                                   f" ({packed.tokens}/{packed.budget} cho {len(relevant_chunks)} đoạn ngữ cảnh)")
+                                st.caption("Nguồn: " + "; ".join(
+                                    f"{topic_names_by_file.get(h.topic, h.topic)} ({source_location(class_code, h)}, độ liên quan {h.score:.2f})"
+                                    for h in hits
+                                ))
+                                # Lưu câu trả lời vào session (có thể dùng nếu muốn hiển thị lại)
+                                st.session_state["last_answer"] = str(answer)
+
+                # Gửi nhiều câu hỏi một lần (mỗi dòng một câu), trả lời theo lô
+                with st.expander("📝 Hỏi nhiều câu cùng lúc"):
+                    multi_text = st.text_area("Mỗi dòng một câu hỏi (tối đa 10 câu):", key="multi_text")
+                    if st.button("Hỏi tất cả"):
+                        questions = batch.parse_questions(multi_text)[:10]
+                        if not questions:
+                            st.warning("Vui lòng nhập câu hỏi.")
+                        else:
+                            search_topics = [t["file"] for t in topics] if search_all else [topic_file]
+                            batch_stats: dict = {}
+                            with st.spinner("Đang trả lời..."):
+                                rows = batch.answer_batch(class_code, search_topics, questions, stats=batch_stats)
+                            for msg in batch_stats["errors"]:
+                                st.error(msg)
+                            for r in rows:
+                                st.markdown(f"**❓ {r['question']}**")
+                                st.write(r["answer"])
+                            st.download_button("⬇️ Tải câu trả lời", batch.export_answers(
+                                rows, "csv", {t["file"]: t["name"] for t in topics}),
+                                file_name="cau_tra_loi.csv", mime="text/csv")
     else:
         # Chưa nhập hoặc xác nhận mã lớp
         st.info("Hãy nhập mã lớp và nhấn 'Vào lớp' để bắt đầu.")
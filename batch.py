@@ -0,0 +1,135 @@
+"""
+batch.py — trả lời nhiều câu hỏi cùng lúc (bộ câu hỏi ôn tập của giáo viên, nhiều câu của học sinh).
+- Nhúng tất cả câu hỏi trong một lần embed_texts (theo batch), tìm cho mọi câu bằng
+  một phép nhân ma trận trên mỗi chủ đề (kb.search_batch).
+- Câu đã có trong cache câu trả lời thì dùng lại; phần còn lại sinh song song có giới hạn.
+- export_answers() xuất kết quả ra CSV (mở được bằng Excel) hoặc JSON.
+"""
+
+from __future__ import annotations
+import io
+import csv
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import common
+import kb
+import metrics
+
+BATCH_GEN_WORKERS = 4          # số câu sinh đồng thời (tránh vượt giới hạn tốc độ của API)
+BATCH_MAX_QUESTIONS = 500
+
+def parse_questions(text: str) -> list[str]:
+    """Mỗi dòng một câu hỏi; bỏ dòng trống và số thứ tự đầu dòng kiểu '1.' / '2)'."""
+    out = []
+    for line in (text or "").splitlines():
+        q = line.strip().lstrip("-•").strip()
+        head, sep, rest = q.partition(" ")
+        if sep and head.rstrip(".)").isdigit():
+            q = rest.strip()
+        if q:
+            out.append(q)
+    return out
+
+def answer_batch(
+    class_code: str,
+    topic_slugs: list[str],
+    questions: list[str],
+    top_k: int = kb.CONTEXT_CANDIDATES,
+    max_workers: int = BATCH_GEN_WORKERS,
+    use_cache: bool = True,
+    on_progress=None,
+    priority: int | None = None,
+    stats: dict | None = None,
+) -> list[dict]:
+    """
+    Trả về danh sách kết quả theo đúng thứ tự `questions`, mỗi mục:
+    {question, answer, sources: [{topic, index, score}], cached, error}.
+    Câu hỏi trùng nhau chỉ được xử lý một lần. on_progress(done, total) được gọi ở
+    luồng gọi hàm này sau mỗi câu trả lời xong. priority: độ ưu tiên gọi API
+    (mặc định theo luồng gọi; bộ câu hỏi của giáo viên dùng common.PRIORITY_BATCH).
+    Nếu truyền `stats` (dict) thì stats["errors"] là các thông báo lỗi gọi mô hình (không
+    trùng lặp) để luồng gọi hiển thị — worker sinh câu trả lời không đụng tới Streamlit.
+    """
+    priority = common.current_priority() if priority is None else priority
+    questions = [q.strip() for q in questions][:BATCH_MAX_QUESTIONS]
+    unique = list(dict.fromkeys(q for q in questions if q))
+    results: dict[str, dict] = {}
+    errors: list[str] = []
+    if stats is not None:
+        stats["errors"] = errors
+    if not unique:
+        return [{"question": q, "answer": "", "sources": [], "cached": False, "error": True} for q in questions]
+
+    with metrics.trace("ask_batch", class_code=class_code, questions=len(unique), topics=len(topic_slugs)), \
+            common.api_priority(priority):
+        qvecs = common.embed_texts(unique, task_type="retrieval_query")
+        all_hits = kb.search_batch(class_code, topic_slugs, qvecs, top_k=top_k)
+        cache = kb.get_answer_cache() if use_cache else None
+
+        todo = []       # (câu hỏi, vector, hits, các đoạn ngữ cảnh)
+        for q, qv, hits in zip(unique, qvecs, all_hits):
+            if not hits:
+                results[q] = {"question": q, "answer": "Không tìm thấy tri thức liên quan.",
+                              "sources": [], "cached": False, "error": True}
+                continue
+            packed = kb.pack_context(class_code, hits)
+            cached = cache.lookup(class_code, topic_slugs, qv, packed.hits) if cache is not None and qv.any() else None
+            if cached is not None:
+                results[q] = _row(q, cached["answer"], packed.hits, cached=True)
+            else:
+                todo.append((q, qv, packed.hits, packed.chunks))
+
+        done = len(results)
+        if on_progress is not None:
+            on_progress(done, len(unique))
+
+        def generate(item):
+            q, _, _, chunks = item
+            stats: dict = {}
+            with common.api_priority(priority):
+                answer = common.generate_answer(q, chunks, stats=stats)
+            return answer, stats.get("error", False), stats.get("error_detail")
+
+        if todo:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(todo))),
+                                    thread_name_prefix="answer") as ex:
+                futures = {ex.submit(metrics.bind(generate), item): item for item in todo}
+                for fut in as_completed(futures):
+                    q, qv, hits, _ = futures[fut]
+                    answer, error, detail = fut.result()
+                    results[q] = _row(q, answer, hits, cached=False, error=error)
+                    if detail and detail not in errors:
+                        errors.append(detail)
+                    if cache is not None and not error and qv.any():
+                        cache.store(class_code, topic_slugs, qv, q, answer, hits)
+                    done += 1
+                    if on_progress is not None:
+                        on_progress(done, len(unique))
+
+    return [results.get(q) or {"question": q, "answer": "", "sources": [], "cached": False, "error": True}
+            for q in questions]
+
+def _row(question: str, answer: str, hits: list, cached: bool, error: bool = False) -> dict:
+    return {
+        "question": question,
+        "answer": answer,
+        "sources": [{"topic": h.topic, "index": h.index, "score": round(h.score, 4)} for h in hits],
+        "cached": cached,
+        "error": error,
+    }
+
+def export_answers(rows: list[dict], fmt: str = "csv", topic_names: dict | None = None) -> bytes:
+    """Xuất kết quả answer_batch: fmt="csv" (UTF-8 có BOM cho Excel) hoặc "json"."""
+    names = topic_names or {}
+    if fmt == "json":
+        return json.dumps(rows, ensure_ascii=False, indent=2).encode("utf-8")
+    if fmt != "csv":
+        raise ValueError(f"Định dạng không hỗ trợ: {fmt}")
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["STT", "Câu hỏi", "Trả lời", "Nguồn"])
+    for i, r in enumerate(rows, 1):
+        src = "; ".join(f"{names.get(s['topic'], s['topic'])} (đoạn {s['index'] + 1})" for s in r["sources"])
+        w.writerow([i, r["question"], r["answer"], src])
+    return buf.getvalue().encode("utf-8-sig")
@@ -0,0 +1,519 @@
+"""
+bench.py — đo hiệu năng offline (không gọi mạng, dùng backend giả lập trong common.py).
+
+Chạy:
+    python bench.py embed --chunks 2000 --latency 0.05
+    python bench.py ann --chunks 50000 --k 5
+    python bench.py quant --chunks 50000 --k 5
+    python bench.py startup --repeat 5
+    python bench.py ratelimit --students 60 --distinct 15
+    python bench.py suite --sizes 1000,10000 --out before.json   (thêm --large để đo cả 100k đoạn)
+    python bench.py compare before.json after.json
+
+`suite` chạy trong thư mục tạm (không đụng data/ thật), với dữ liệu tiếng Việt tổng hợp
+sinh từ seed cố định, nên hai lần chạy trên cùng máy so sánh được với nhau.
+"""
+
+from __future__ import annotations
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+
+import common
+import jobs
+import kb
+import metrics
+
+def _sample_chunks(n: int, words: int = 100) -> list[str]:
+    vocab = ("điện trở dòng điện hiệu điện thế định luật ôm mạch nối tiếp song song "
+             "vật dẫn năng lượng công suất nhiệt lượng bài tập ví dụ chương").split()
+    return [" ".join(vocab[(i * 7 + j) % len(vocab)] for j in range(words)) for i in range(n)]
+
+def bench_embed(chunks: int, latency: float, batch_size: int, workers: int) -> dict:
+    """So sánh gọi từng chunk (như trước) với batch + song song."""
+    texts = _sample_chunks(chunks)
+    results = {}
+    for name, bs, w in (("serial", 1, 1), ("batched", batch_size, workers)):
+        backend = common.FakeEmbedBackend(latency=latency)
+        common.set_embed_backend(backend)
+        t0 = time.perf_counter()
+        emb = common.embed_texts(texts, batch_size=bs, max_workers=w, use_cache=False)
+        dt = time.perf_counter() - t0
+        results[name] = {
+            "seconds": round(dt, 4),
+            "chunks_per_sec": round(len(texts) / dt, 1) if dt else None,
+            "api_calls": backend.calls,
+            "shape": list(emb.shape),
+        }
+    common.set_embed_backend(None)
+    return results
+
+def _clustered_vectors(n: int, dim: int, clusters: int, seed: int = 0) -> np.ndarray:
+    """Vector giả có cấu trúc cụm (giống embedding thật hơn nhiễu đều)."""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=n)
+    return kb.normalize_rows(centers[labels] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32))
+
+def bench_ann(chunks: int, dim: int, queries: int, k: int, nprobe: int) -> dict:
+    """recall@k và độ trễ của IVF so với tìm chính xác (brute force)."""
+    emb = _clustered_vectors(chunks, dim, clusters=max(10, chunks // 500))
+    q = kb.normalize_rows(_clustered_vectors(queries, dim, clusters=max(10, chunks // 500), seed=1))
+
+    t0 = time.perf_counter()
+    index = kb.IVFIndex.build(emb)
+    build_s = time.perf_counter() - t0
+
+    # từng câu hỏi một, giống luồng hỏi đáp của học sinh
+    t0 = time.perf_counter()
+    exact = np.vstack([kb.top_k_indices(emb @ qi, k) for qi in q])
+    exact_s = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    approx = np.vstack([index.search(emb, qi.reshape(1, -1), k, nprobe=nprobe)[0] for qi in q])
+    ann_s = time.perf_counter() - t0
+
+    recall = np.mean([len(set(a.tolist()) & set(e.tolist())) / k for a, e in zip(approx, exact)])
+    return {
+        "chunks": chunks,
+        "nlist": index.nlist,
+        "nprobe": nprobe,
+        f"recall@{k}": round(float(recall), 4),
+        "build_seconds": round(build_s, 3),
+        "exact_ms_per_query": round(1000 * exact_s / queries, 3),
+        "ann_ms_per_query": round(1000 * ann_s / queries, 3),
+    }
+
+def bench_quant(chunks: int, dim: int, queries: int, k: int, seed: int = 0) -> dict:
+    """
+    Lưu cùng một ma trận ở float32 / float16 / int8 (có và không kèm bản float32 để
+    chấm lại), đo recall@k so với float32, độ trễ mỗi câu hỏi và dung lượng.
+    Tìm chính xác (exact=True) để tách riêng ảnh hưởng của việc nén khỏi chỉ mục IVF.
+    """
+    emb = _clustered_vectors(chunks, dim, clusters=max(10, chunks // 500), seed=seed)
+    q = _clustered_vectors(queries, dim, clusters=max(10, chunks // 500), seed=seed + 1)
+    texts = [f"đoạn {i}" for i in range(chunks)]
+    truth = [set(kb.top_k_indices(emb @ qi, k).tolist()) for qi in q]
+    variants = (("float32", False), ("float16", False), ("float16", True), ("int8", False), ("int8", True))
+    out = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="bench_") as tmp:
+        os.chdir(tmp)
+        try:
+            os.makedirs(kb.DATA_DIR, exist_ok=True)
+            for dtype, keep_exact in variants:
+                slug = f"{dtype}{'_exact' if keep_exact else ''}"
+                kb.save_knowledge("bench", slug, texts, emb, dtype=dtype, keep_exact=keep_exact)
+                topic = kb.load_topic("bench", slug)
+                v = kb.read_meta("bench", slug)["version"]
+                files = [kb._version_path("bench", slug, v, sfx) for sfx in ("emb.npy", "scale.npy", "exact.npy")]
+                disk = sum(os.path.getsize(f) for f in files if os.path.exists(f))
+                lat, recall = [], []
+                for qi, t in zip(q, truth):
+                    t0 = time.perf_counter()
+                    hits = kb.search("bench", slug, qi, top_k=k, exact=True)
+                    lat.append(time.perf_counter() - t0)
+                    recall.append(len({h.index for h in hits} & t) / k)
+                out[slug] = dict(
+                    _percentiles_ms(lat),
+                    **{f"recall@{k}": round(float(np.mean(recall)), 4)},
+                    scan_mb=round(topic.embeddings.nbytes / 2**20, 2),
+                    disk_mb=round(disk / 2**20, 2),
+                )
+                kb.invalidate_topic("bench", slug)
+        finally:
+            os.chdir(cwd)
+    return out
+
+_APP_MODULES = ("common", "kb", "registry", "jobs", "batch", "metrics")
+_HEAVY_MODULES = ("google.generativeai", "pypdf", "docx")
+
+def _import_seconds(stmt: str) -> float:
+    """Thời gian chạy `stmt` trong một interpreter mới (cold start, không có sys.modules sẵn)."""
+    code = f"import time; t0 = time.perf_counter(); {stmt}; print(time.perf_counter() - t0)"
+    out = subprocess.run([sys.executable, "-W", "ignore", "-c", code], capture_output=True, text=True,
+                         cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    return float(out.stdout.strip().splitlines()[-1])
+
+def bench_startup(repeat: int) -> dict:
+    """
+    Thời gian import các module của app (như lúc container khởi động) và những module
+    nặng nào đã bị nạp sẵn; so với thời gian import riêng từng module nặng được hoãn lại.
+    """
+    stmt = "import " + ", ".join(_APP_MODULES)
+    app_s = [_import_seconds(stmt) for _ in range(repeat)]
+    probe = subprocess.run(
+        [sys.executable, "-W", "ignore", "-c",
+         f"import sys; {stmt}; print(','.join(m for m in {_HEAVY_MODULES!r} if m in sys.modules))"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    deferred = {}
+    for mod in _HEAVY_MODULES:
+        try:
+            deferred[mod] = round(1000 * float(np.median([_import_seconds(f"import {mod}") for _ in range(repeat)])), 1)
+        except subprocess.CalledProcessError:
+            deferred[mod] = None    # chưa cài
+    return {
+        "app_import_ms": round(1000 * float(np.median(app_s)), 1),
+        "heavy_loaded_at_import": [m for m in probe.stdout.strip().split(",") if m],
+        "deferred_import_ms": deferred,
+    }
+
+def bench_ratelimit(students: int, distinct: int, background: int, quota: int, window: float,
+                    latency: float) -> dict:
+    """
+    Cả lớp cùng bấm "Hỏi" trong lúc một bộ câu hỏi chạy nền, với server giả lập chỉ nhận
+    `quota` request mỗi `window` giây (thu nhỏ thời gian so với hạn mức theo phút).
+    "direct": gọi thẳng backend như trước; "client": qua ApiClient (giới hạn tốc độ,
+    ưu tiên, thử lại, gộp request trùng).
+    """
+    questions = [f"Câu hỏi số {i % distinct} về định luật Ôm?" for i in range(students)]
+    bank = [f"Câu ôn tập {i}" for i in range(background)]
+    out = {}
+    for mode in ("direct", "client"):
+        rpm = quota / window * 60 * 0.8 if mode == "client" else None    # chừa 20% hạn mức
+        backend = common.FakeGenerateBackend(first_token_latency=latency, rpm=rpm, quota_rpm=quota,
+                                             quota_window=window)
+        common.set_generate_backend(backend)
+        lat: dict[str, list] = {"student": [], "background": []}
+        errors = {"student": 0, "background": 0}
+
+        def ask(kind: str, q: str) -> None:
+            t0 = time.perf_counter()
+            if mode == "direct":
+                try:
+                    backend.generate(common.build_prompt(q))
+                    ok = True
+                except Exception:
+                    ok = False
+            else:
+                prio = common.PRIORITY_INTERACTIVE if kind == "student" else common.PRIORITY_BACKGROUND
+                with common.api_priority(prio):
+                    stats: dict = {}
+                    common.generate_answer(q, stats=stats)
+                    ok = not stats["error"]
+            lat[kind].append(time.perf_counter() - t0)
+            errors[kind] += not ok
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=ask, args=("background", q)) for q in bank]
+        for t in threads:
+            t.start()
+        time.sleep(0.05)        # nền đã xếp hàng trước khi học sinh hỏi
+        more = [threading.Thread(target=ask, args=("student", q)) for q in questions]
+        for t in more:
+            t.start()
+        for t in threads + more:
+            t.join()
+        out[mode] = {
+            "seconds": round(time.perf_counter() - t0, 3),
+            "upstream_calls": backend.calls,
+            "rejected_429": backend.quota.rejected,
+            "student_errors": errors["student"],
+            "background_errors": errors["background"],
+            "student": _percentiles_ms(lat["student"]),
+            "background": _percentiles_ms(lat["background"]) if lat["background"] else None,
+        }
+    common.set_generate_backend(None)
+    return out
+
+# ========= BỘ ĐO TỔNG HỢP (suite) =========
+_VI_SYLLABLES = (
+    "điện trở dòng hiệu thế định luật ôm mạch nối tiếp song vật dẫn năng lượng công suất nhiệt "
+    "học sinh giáo viên bài tập ví dụ chương phần câu hỏi trả lời lực khối vận tốc gia quãng đường "
+    "thời gian nguyên tử phân hóa phản ứng axit bazơ muối nước không khí ánh sáng âm thanh tần số "
+    "sóng từ trường nam châm cơ động áp suất chất lỏng rắn độ sôi nóng chảy của là và các một có"
+).split()
+
+def synthetic_corpus(words: int, seed: int = 0) -> str:
+    """Văn bản tiếng Việt giả: câu 6–24 âm tiết, có số mục kiểu '2.3', đoạn 3–8 câu."""
+    rng = random.Random(seed)
+    paras, para, n = [], [], 0
+    para_len = rng.randint(3, 8)
+    while n < words:
+        sent = rng.choices(_VI_SYLLABLES, k=rng.randint(6, 24))
+        if rng.random() < 0.1:
+            sent.insert(rng.randrange(len(sent)), f"{rng.randint(1, 12)}.{rng.randint(1, 9)}")
+        sent[0] = sent[0].capitalize()
+        para.append(" ".join(sent) + rng.choice("....?!"))
+        n += len(sent)
+        if len(para) >= para_len:
+            paras.append(" ".join(para))
+            para, para_len = [], rng.randint(3, 8)
+    if para:
+        paras.append(" ".join(para))
+    return "\n".join(paras)
+
+def _synthetic_chunks(n: int, seed: int, words: int = 60) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(_VI_SYLLABLES, k=words)) for _ in range(n)]
+
+def _measure(fn, memory: bool) -> tuple:
+    """(kết quả, giây, đỉnh bộ nhớ MB | None). Đo bộ nhớ ở lượt chạy riêng vì tracemalloc làm chậm."""
+    t0 = time.perf_counter()
+    out = fn()
+    seconds = time.perf_counter() - t0
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            peak = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+        finally:
+            tracemalloc.stop()
+    return out, seconds, peak
+
+def _percentiles_ms(samples: list[float]) -> dict:
+    a = np.asarray(samples) * 1000
+    return {"p50_ms": round(float(np.percentile(a, 50)), 3), "p95_ms": round(float(np.percentile(a, 95)), 3)}
+
+def bench_chunking(words: int, seed: int) -> dict:
+    text = synthetic_corpus(words, seed)
+    chunks, seconds, _ = _measure(lambda: kb.split_into_chunks(text), memory=False)
+    f = io.BytesIO(text.encode("utf-8"))
+    f.name = "bench.txt"
+    structured, s_seconds, _ = _measure(lambda: kb.chunk_document(f), memory=False)
+    return {
+        "words": words,
+        "chunks": len(chunks),
+        "seconds": round(seconds, 4),
+        "words_per_sec": round(words / seconds, 1) if seconds else None,
+        "mb_per_sec": round(len(text.encode("utf-8")) / 2**20 / seconds, 2) if seconds else None,
+        "structured": {
+            "chunks": len(structured),
+            "seconds": round(s_seconds, 4),
+            "words_per_sec": round(words / s_seconds, 1) if s_seconds else None,
+            "avg_tokens": round(sum(kb.approx_tokens(c.text) for c in structured) / len(structured), 1)
+            if structured else 0,
+        },
+    }
+
+def bench_ingest(chunks: int, seed: int, memory: bool) -> dict:
+    """Tệp TXT → đọc/chia đoạn/nhúng (backend giả) → lưu phiên bản mới, như job tạo chủ đề."""
+    data = synthetic_corpus(chunks * 100, seed).encode("utf-8")
+
+    def run():
+        f = io.BytesIO(data)
+        f.name = "bench.txt"
+        texts, metas, parts = [], [], []
+        # cùng pipeline đọc → chia đoạn → nhúng gối nhau và cùng cỡ lô với job tạo chủ đề
+        for batch, batch_metas, emb in kb.embed_pipelined(kb.iter_document_chunks(f), common.embed_texts,
+                                                          jobs.CHECKPOINT_EVERY):
+            texts.extend(batch)
+            metas.extend(batch_metas)
+            parts.append(emb)
+        if kb.save_knowledge("bench", "ingest", texts, np.vstack(parts), chunk_meta=metas) is not True:
+            raise RuntimeError("save_knowledge thất bại")
+        return len(texts)
+
+    n, seconds, peak = _measure(run, memory)
+    return {"chunks": n, "mb": round(len(data) / 2**20, 2), "seconds": round(seconds, 3),
+            "chunks_per_sec": round(n / seconds, 1) if seconds else None, "peak_mb": peak}
+
+def bench_retrieval(size: int, queries: int, k: int, seed: int, memory: bool) -> dict:
+    """Lưu chủ đề `size` đoạn, đo nạp nguội và độ trễ tìm kiếm (vector và kết hợp BM25)."""
+    slug = f"r{size}"
+    chunks = _synthetic_chunks(size, seed)
+    emb = _clustered_vectors(size, common.get_embed_backend().dim, clusters=max(10, size // 500), seed=seed)
+    _, save_s, _ = _measure(lambda: kb.save_knowledge("bench", slug, chunks, emb), memory=False)
+
+    def cold_load():
+        kb.invalidate_topic("bench", slug)
+        topic = kb.load_topic("bench", slug)
+        topic.embeddings[-1].sum()      # chạm tới trang cuối của mmap
+        return topic
+
+    _, load_s, load_peak = _measure(cold_load, memory)
+
+    rng = random.Random(seed + 1)
+    questions = [" ".join(rng.sample(chunks[rng.randrange(size)].split(), 6)) for _ in range(queries)]
+    qvecs = common.embed_texts(questions, task_type="retrieval_query", use_cache=False)
+    embed_query = lambda q: common.embed_texts([q], task_type="retrieval_query", use_cache=False)[0]
+
+    vec_t, hyb_t, lexical_only = [], [], 0
+    for q, qv in zip(questions, qvecs):
+        t0 = time.perf_counter()
+        kb.search("bench", slug, qv, top_k=k)
+        vec_t.append(time.perf_counter() - t0)
+        t0 = time.perf_counter()
+        _, used_vec = kb.hybrid_search("bench", [slug], q, embed_query, top_k=k)
+        hyb_t.append(time.perf_counter() - t0)
+        lexical_only += used_vec is None
+    return {
+        "save_seconds": round(save_s, 3),
+        "cold_load_ms": round(load_s * 1000, 3),
+        "load_peak_mb": load_peak,
+        "vector": _percentiles_ms(vec_t),
+        "hybrid": dict(_percentiles_ms(hyb_t), lexical_only=lexical_only),
+        "ann": kb.load_topic("bench", slug).ann is not None,
+    }
+
+def _environment(args: dict) -> dict:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        rev = None
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git": rev,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "args": args,
+    }
+
+def _max_rss_mb() -> float | None:
+    try:
+        import resource
+    except ImportError:          # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (2**20 if sys.platform == "darwin" else 2**10), 1)
+
+SUITE_LARGE_SIZE = 100_000      # cỡ chủ đề lớn nhất của suite, chỉ đo khi có --large
+
+def bench_suite(sizes: list[int], ingest_chunks: int, chunk_words: int, queries: int, k: int,
+                latency: float, memory: bool, seed: int) -> dict:
+    """Chạy toàn bộ trong thư mục tạm với backend giả lập tất định, không cache, không metrics."""
+    args = dict(sizes=sizes, ingest_chunks=ingest_chunks, chunk_words=chunk_words, queries=queries,
+                k=k, latency=latency, memory=memory, seed=seed)
+    env = _environment(args)
+    cwd = os.getcwd()
+    old_cache = os.environ.get("EMBED_CACHE")
+    os.environ["EMBED_CACHE"] = "0"
+    metrics_on = metrics.ENABLED
+    metrics.set_enabled(False)
+    common.set_embed_backend(common.FakeEmbedBackend(latency=latency))
+    results: dict = {}
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench_") as tmp:
+            os.chdir(tmp)
+            os.makedirs(kb.DATA_DIR, exist_ok=True)
+            results["chunking"] = bench_chunking(chunk_words, seed)
+            results["ingest"] = bench_ingest(ingest_chunks, seed, memory)
+            results["retrieval"] = {str(n): bench_retrieval(n, queries, k, seed, memory) for n in sizes}
+            for n in sizes:
+                kb.invalidate_topic("bench", f"r{n}")
+            kb.invalidate_topic("bench", "ingest")
+            os.chdir(cwd)
+    finally:
+        os.chdir(cwd)
+        common.set_embed_backend(None)
+        metrics.set_enabled(metrics_on)
+        if old_cache is None:
+            os.environ.pop("EMBED_CACHE", None)
+        else:
+            os.environ["EMBED_CACHE"] = old_cache
+    results["max_rss_mb"] = _max_rss_mb()
+    return {"env": env, "results": results}
+
+def _flatten(d: dict, prefix: str = "") -> dict:
+    out = {}
+    for key, v in d.items():
+        name = f"{prefix}.{key}" if prefix else str(key)
+        if isinstance(v, dict):
+            out.update(_flatten(v, name))
+        elif isinstance(v, (int, float)) and not isinstance(v, bool):
+            out[name] = v
+    return out
+
+def compare(before_path: str, after_path: str) -> list[dict]:
+    """So sánh từng chỉ số số học của hai file kết quả suite (thay đổi tính theo %)."""
+    with open(before_path, "r", encoding="utf-8") as f:
+        before = _flatten(json.load(f).get("results", {}))
+    with open(after_path, "r", encoding="utf-8") as f:
+        after = _flatten(json.load(f).get("results", {}))
+    rows = []
+    for key in sorted(set(before) | set(after)):
+        a, b = before.get(key), after.get(key)
+        change = round(100.0 * (b - a) / a, 1) if a and b is not None else None
+        rows.append({"metric": key, "before": a, "after": b, "change_pct": change})
+    return rows
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark offline cho chatbot trợ giảng")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("embed", help="thông lượng embed_texts với backend giả lập")
+    p.add_argument("--chunks", type=int, default=1000)
+    p.add_argument("--latency", type=float, default=0.02, help="giây / round trip giả lập")
+    p.add_argument("--batch-size", type=int, default=common.EMBED_BATCH_SIZE)
+    p.add_argument("--workers", type=int, default=common.EMBED_MAX_WORKERS)
+    p = sub.add_parser("ann", help="recall@k / độ trễ của chỉ mục IVF so với tìm chính xác")
+    p.add_argument("--chunks", type=int, default=20000)
+    p.add_argument("--dim", type=int, default=768)
+    p.add_argument("--queries", type=int, default=200)
+    p.add_argument("--k", type=int, default=5)
+    p.add_argument("--nprobe", type=int, default=kb.ANN_NPROBE)
+    p = sub.add_parser("quant", help="recall / độ trễ / dung lượng của embedding float16, int8 so với float32")
+    p.add_argument("--chunks", type=int, default=20000)
+    p.add_argument("--dim", type=int, default=768)
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=5)
+    p = sub.add_parser("startup", help="thời gian import lúc khởi động (interpreter mới mỗi lần)")
+    p.add_argument("--repeat", type=int, default=5)
+    p = sub.add_parser("ratelimit", help="cả lớp hỏi cùng lúc với server giả lập có hạn mức: gọi thẳng vs ApiClient")
+    p.add_argument("--students", type=int, default=60)
+    p.add_argument("--distinct", type=int, default=15, help="số câu hỏi khác nhau trong lớp")
+    p.add_argument("--background", type=int, default=20, help="số câu của bộ câu hỏi chạy nền")
+    p.add_argument("--quota", type=int, default=20, help="số request server nhận mỗi cửa sổ")
+    p.add_argument("--window", type=float, default=3.0, help="độ dài cửa sổ hạn mức (giây)")
+    p.add_argument("--latency", type=float, default=0.2, help="giây tới đoạn đầu tiên")
+    p = sub.add_parser("suite", help="chia đoạn, ingest, nạp nguội, độ trễ tìm kiếm theo kích thước, bộ nhớ")
+    p.add_argument("--sizes", default="1000,10000", help="số đoạn của các chủ đề đo tìm kiếm")
+    p.add_argument("--large", action="store_true",
+                   help=f"thêm chủ đề {SUITE_LARGE_SIZE} đoạn và cho phép --sizes từ cỡ đó trở lên (cần nhiều RAM)")
+    p.add_argument("--ingest-chunks", type=int, default=2000)
+    p.add_argument("--chunk-words", type=int, default=1_000_000, help="số từ văn bản đo tốc độ chia đoạn")
+    p.add_argument("--queries", type=int, default=100)
+    p.add_argument("--k", type=int, default=8)
+    p.add_argument("--latency", type=float, default=0.0, help="giây / round trip embedding giả lập")
+    p.add_argument("--no-memory", action="store_true", help="bỏ lượt đo đỉnh bộ nhớ (tracemalloc)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--out", help="ghi kết quả JSON vào file (để so sánh giữa các lần chạy)")
+    p = sub.add_parser("compare", help="so sánh hai file kết quả của suite")
+    p.add_argument("before")
+    p.add_argument("after")
+    args = ap.parse_args()
+
+    if args.cmd == "embed":
+        out = bench_embed(args.chunks, args.latency, args.batch_size, args.workers)
+    elif args.cmd == "ann":
+        out = bench_ann(args.chunks, args.dim, args.queries, args.k, args.nprobe)
+    elif args.cmd == "quant":
+        out = bench_quant(args.chunks, args.dim, args.queries, args.k)
+    elif args.cmd == "startup":
+        out = bench_startup(args.repeat)
+    elif args.cmd == "ratelimit":
+        out = bench_ratelimit(args.students, args.distinct, args.background, args.quota, args.window, args.latency)
+    elif args.cmd == "suite":
+        sizes = [int(x) for x in args.sizes.split(",") if x.strip()]
+        if args.large and SUITE_LARGE_SIZE not in sizes:
+            sizes.append(SUITE_LARGE_SIZE)
+        elif not args.large and max(sizes, default=0) >= SUITE_LARGE_SIZE:
+            ap.error(f"cỡ >= {SUITE_LARGE_SIZE} đoạn có thể hết bộ nhớ; thêm --large nếu chắc chắn")
+        out = bench_suite(sizes, args.ingest_chunks, args.chunk_words, args.queries, args.k,
+                          args.latency, not args.no_memory, args.seed)
+        if args.out:
+            with open(args.out, "w", encoding="utf-8") as f:
+                json.dump(out, f, ensure_ascii=False, indent=2)
+    elif args.cmd == "compare":
+        for row in compare(args.before, args.after):
+            change = "" if row["change_pct"] is None else f"{row['change_pct']:+.1f}%"
+            print(f"{row['metric']:<40} {row['before']!s:>14} {row['after']!s:>14} {change:>9}")
+        return
+    print(json.dumps(out, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -2,25 +2,47 @@
 common.py
 - Không ném Exception khi import nếu thiếu API key (để app còn render UI).
 - Lấy GEMINI_API_KEY từ st.secrets (ưu tiên) hoặc biến môi trường.
-- Cung cấp 2 hàm:
-    embed_texts(texts: list[str]) -> np.ndarray
-    generate_answer(question: str, context: list[str] | str | None = None) -> str
+- Cung cấp các hàm:
+    embed_texts(texts: list[str], task_type=...) -> np.ndarray   (batch, song song, giữ thứ tự)
+    generate_answer(question: str, context: list[str] | str | None = None, stats=None) -> str
+    generate_answer_stream(question, context, stats=None) -> Iterator[str]   (từng đoạn text)
+- Mọi lần gọi API đi qua ApiClient dùng chung (giới hạn tốc độ, ưu tiên, thử lại, gộp request trùng).
 """
 
 from __future__ import annotations
 import os
+import time
+import heapq
+import random
+import hashlib
+import threading
+import contextvars
+import sqlite3
+import unicodedata
+import weakref
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import numpy as np
 
+import metrics
+
 # Thử import streamlit để đọc secrets khi chạy trên Streamlit Cloud
 try:
     import streamlit as st  # type: ignore
 except Exception:
     st = None
 
-# SDK Gemini
-import google.generativeai as genai
-
 _CONFIGURED = False  # đã configure API hay chưa
+DATA_DIR = "data"    # cùng thư mục dữ liệu với kb.py
+_GENAI = None        # SDK Gemini, chỉ import khi thật sự gọi API (import mất ~1s)
+
+def _genai():
+    """google.generativeai, import lười ở lần dùng đầu tiên."""
+    global _GENAI
+    if _GENAI is None:
+        import google.generativeai as genai
+        _GENAI = genai
+    return _GENAI
 
 def _get_api_key() -> str | None:
     """Ưu tiên lấy từ st.secrets, sau đó biến môi trường."""
@@ -46,107 +68,910 @@ def _ensure_config() -> bool:
         else:
             print("[warn] GEMINI_API_KEY missing")
         return False
-    genai.configure(api_key=api_key)
+    _genai().configure(api_key=api_key)
     _CONFIGURED = True
     return True
 
-# ========= EMBEDDINGS =========
-def embed_texts(texts: list[str]) -> np.ndarray:
+# ========= LỚP GỌI API DÙNG CHUNG =========
+# Mọi phiên Streamlit trong process gọi API qua cùng một ApiClient cho mỗi loại (embed /
+# generate): token bucket giữ số request/phút dưới hạn mức, request chờ được xếp theo độ
+# ưu tiên (câu hỏi của học sinh trước, nạp tài liệu chạy nền sau), lỗi 429/503 được thử
+# lại với exponential backoff + jitter, và các request giống hệt nhau đang chạy được gộp
+# thành một lần gọi (cả lớp cùng bấm "Hỏi" một câu → một request lên Gemini).
+PRIORITY_INTERACTIVE = 0    # học sinh đang chờ câu trả lời
+PRIORITY_BATCH = 1          # bộ câu hỏi của giáo viên
+PRIORITY_BACKGROUND = 2     # job tạo / cập nhật chủ đề
+
+EMBED_RPM = float(os.getenv("GEMINI_EMBED_RPM", "1500"))    # hạn mức request/phút của tài khoản
+GEN_RPM = float(os.getenv("GEMINI_GEN_RPM", "1000"))
+API_BACKOFF_BASE = 1.0      # giây, nhân đôi sau mỗi lần thử lại ...
+API_BACKOFF_MAX = 30.0      # ... tối đa 30 giây
+API_QUEUE_TIMEOUT = 60.0    # câu hỏi tương tác chờ lượt quá lâu → báo bận thay vì treo
+
+_PRIORITY: contextvars.ContextVar = contextvars.ContextVar("api_priority", default=PRIORITY_INTERACTIVE)
+
+class ApiBusyError(RuntimeError):
+    """Chờ lượt gọi API quá API_QUEUE_TIMEOUT (hệ thống đang quá tải)."""
+
+class _PriorityScope:
+    __slots__ = ("priority", "token")
+
+    def __init__(self, priority: int):
+        self.priority = priority
+
+    def __enter__(self):
+        self.token = _PRIORITY.set(self.priority)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _PRIORITY.reset(self.token)
+        return False
+
+def api_priority(priority: int) -> _PriorityScope:
+    """with api_priority(PRIORITY_BACKGROUND): ... — độ ưu tiên cho các lần gọi API trong khối."""
+    return _PriorityScope(priority)
+
+def current_priority() -> int:
+    return _PRIORITY.get()
+
+def _is_retryable(exc: Exception) -> bool:
+    """Lỗi do giới hạn tốc độ / quá tải tạm thời thì nên thử lại."""
+    name = type(exc).__name__
+    if name in ("ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded"):
+        return True
+    msg = str(exc).lower()
+    return "429" in msg or "rate limit" in msg or "quota" in msg or "503" in msg
+
+def _retry_after(exc: Exception) -> float:
+    """Thời gian chờ server gợi ý (giây) nếu lỗi có kèm, ngược lại 0."""
+    for attr in ("retry_after", "retry_delay"):
+        val = getattr(exc, attr, None)
+        if hasattr(val, "total_seconds"):
+            val = val.total_seconds()
+        if isinstance(val, (int, float)) and val > 0:
+            return float(val)
+    return 0.0
+
+def backoff_delay(attempt: int, retry_after: float = 0.0) -> float:
+    """Exponential backoff với jitter (một nửa cố định, một nửa ngẫu nhiên) cho lần thử lại thứ attempt (0, 1...)."""
+    cap = min(API_BACKOFF_MAX, API_BACKOFF_BASE * (2 ** attempt))
+    return max(retry_after, cap / 2 + random.uniform(0, cap / 2))
+
+class RateLimiter:
     """
-    Tạo embedding cho danh sách chuỗi. Trả về mảng (N, D).
-    Nếu thiếu API key → raise RuntimeError (tại thời điểm dùng).
+    Token bucket `rpm` request/phút (dồn tối đa `burst` lượt, mặc định ~1 giây). Khi hết lượt, các
+    luồng chờ được phục vụ theo (độ ưu tiên, thứ tự đến). rpm=None → không giới hạn.
+    pause(s) chặn mọi lượt mới trong s giây (server vừa trả 429).
     """
-    if not texts:
-        return np.zeros((0, 0), dtype=np.float32)
-    if not _ensure_config():
-        raise RuntimeError("GEMINI_API_KEY chưa được thiết lập trong Secrets/ENV.")
 
-    vecs = []
-    for t in texts:
-        t = (t or "").strip()
-        if not t:
-            continue
-        # model embedding mới
-        resp = genai.embed_content(
-            model="models/text-embedding-004",
-            content=t,
-            task_type="retrieval_document",
-        )
-        # Chuẩn hóa lấy vector
-        emb = None
-        if isinstance(resp, dict):
-            emb = resp.get("embedding")
-            if isinstance(emb, dict):
-                emb = emb.get("values") or emb.get("value")
-            if emb is None and "embeddings" in resp:
-                try:
-                    emb = resp["embeddings"][0].get("values") or resp["embeddings"][0].get("value")
-                except Exception:
-                    emb = None
+    def __init__(self, rpm: float | None, burst: float | None = None):
+        self.rate = rpm / 60.0 if rpm else None
+        self.burst = max(1.0, burst if burst is not None else (rpm / 60.0 if rpm else 1.0))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.waited = 0.0           # tổng giây các request phải chờ lượt
+        self._cond = threading.Condition()
+        self._waiters: list = []    # heap (độ ưu tiên, số thứ tự)
+        self._seq = 0
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int = PRIORITY_INTERACTIVE, timeout: float | None = None) -> bool:
+        """Lấy một lượt; False nếu quá `timeout` giây mà chưa tới lượt."""
+        if self.rate is None and time.monotonic() >= self.paused_until:
+            return True
+        t0 = time.monotonic()
+        deadline = None if timeout is None else t0 + timeout
+        with self._cond:
+            self._seq += 1
+            me = (priority, self._seq)
+            heapq.heappush(self._waiters, me)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.rate is not None:
+                        self._refill(now)
+                    if self._waiters[0] == me and now >= self.paused_until and (self.rate is None or self.tokens >= 1):
+                        if self.rate is not None:
+                            self.tokens -= 1
+                        self.waited += now - t0
+                        return True
+                    if deadline is not None and now >= deadline:
+                        return False
+                    if self._waiters[0] != me:
+                        wait = None
+                    elif now < self.paused_until:
+                        wait = self.paused_until - now
+                    else:
+                        wait = (1 - self.tokens) / self.rate
+                    if deadline is not None:
+                        wait = deadline - now if wait is None else min(wait, deadline - now)
+                    self._cond.wait(wait)
+            finally:
+                self._waiters.remove(me)
+                heapq.heapify(self._waiters)
+                self._cond.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        with self._cond:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            if self.rate is not None:
+                self.tokens = min(self.tokens, 0.0)
+            self._cond.notify_all()
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._waiters)
+
+class _Broadcast:
+    """Kết quả stream của một lần gọi, phát lại cho mọi người đọc (kể cả người đến sau)."""
+
+    def __init__(self):
+        self.deltas: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self._cond = threading.Condition()
+
+    def push(self, delta: str) -> None:
+        with self._cond:
+            self.deltas.append(delta)
+            self._cond.notify_all()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def __iter__(self):
+        i = 0
+        while True:
+            with self._cond:
+                while i >= len(self.deltas) and not self.done:
+                    self._cond.wait()
+                if i >= len(self.deltas):
+                    if self.error is not None:
+                        raise self.error
+                    return
+                delta = self.deltas[i]
+            i += 1
+            yield delta
+
+class ApiClient:
+    """
+    Cổng gọi API dùng chung trong process cho một loại request (stage = "embed" / "generate").
+    call(): gọi có giới hạn tốc độ, thử lại, gộp request trùng (theo `key`).
+    stream(): như call() cho API trả về từng đoạn; chỉ thử lại khi chưa nhận được đoạn nào.
+    """
+
+    def __init__(self, stage: str, rpm: float | None, max_retries: int):
+        self.stage = stage
+        self.limiter = RateLimiter(rpm)
+        self.max_retries = max_retries
+        self.calls = 0
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._inflight: dict = {}       # key → Future (call) / _Broadcast (stream)
+
+    def _acquire(self, priority: int) -> None:
+        t0 = time.perf_counter()
+        timeout = API_QUEUE_TIMEOUT if priority == PRIORITY_INTERACTIVE else None
+        if not self.limiter.acquire(priority, timeout):
+            raise ApiBusyError("Có quá nhiều yêu cầu cùng lúc, vui lòng thử lại sau ít phút.")
+        waited = time.perf_counter() - t0
+        if waited > 0.001:
+            metrics.observe(f"{self.stage}.queue", waited, priority=priority)
+
+    def _failed(self, e: Exception, attempt: int) -> float | None:
+        """Số giây chờ trước lần thử lại, hoặc None nếu không nên thử lại."""
+        if attempt >= self.max_retries or not _is_retryable(e):
+            return None
+        retry_after = _retry_after(e)
+        delay = backoff_delay(attempt, retry_after)
+        if retry_after:
+            self.limiter.pause(retry_after)     # server đã nói rõ: cả process cùng dừng
+        metrics.incr(f"{self.stage}.retries")
+        return delay
+
+    def _attempt(self, fn, args, priority: int):
+        for attempt in range(self.max_retries + 1):
+            self._acquire(priority)
+            with self._lock:
+                self.calls += 1
+            metrics.incr(f"{self.stage}.api_calls")
+            try:
+                return fn(*args)
+            except Exception as e:
+                delay = self._failed(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+
+    def call(self, fn, *args, key=None, priority: int | None = None):
+        priority = current_priority() if priority is None else priority
+        if key is None:
+            return self._attempt(fn, args, priority)
+        with self._lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader:
+                fut = self._inflight[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            metrics.incr(f"{self.stage}.coalesced")
+            return fut.result()
+        try:
+            result = self._attempt(fn, args, priority)
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+
+    def stream(self, fn, *args, key=None, priority: int | None = None):
+        """Generator các đoạn; upstream chạy ở luồng riêng nên người đọc dừng giữa chừng không làm kẹt người khác."""
+        priority = current_priority() if priority is None else priority
+        with self._lock:
+            bc = self._inflight.get(key) if key is not None else None
+            if bc is None:
+                bc = _Broadcast()
+                if key is not None:
+                    self._inflight[key] = bc
+                start = True
+            else:
+                self.coalesced += 1
+                start = False
+        if start:
+            threading.Thread(target=metrics.bind(self._pump), args=(bc, fn, args, key, priority),
+                             name=f"{self.stage}-stream", daemon=True).start()
         else:
+            metrics.incr(f"{self.stage}.coalesced")
+        return iter(bc)
+
+    def _pump(self, bc: _Broadcast, fn, args, key, priority: int) -> None:
+        error = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    self._acquire(priority)
+                    with self._lock:
+                        self.calls += 1
+                    metrics.incr(f"{self.stage}.api_calls")
+                    for delta in fn(*args):
+                        bc.push(delta)
+                    break
+                except ApiBusyError:
+                    raise
+                except Exception as e:
+                    delay = None if bc.deltas else self._failed(e, attempt)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+        except BaseException as e:
+            error = e
+        finally:
+            if key is not None:
+                with self._lock:
+                    self._inflight.pop(key, None)
+            bc.finish(error)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "coalesced": self.coalesced, "queued": self.limiter.queued(),
+                    "waited_s": round(self.limiter.waited, 3)}
+
+_CLIENTS: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()   # backend → {(stage, model): client}
+_CLIENTS_LOCK = threading.Lock()
+
+def get_api_client(stage: str, backend) -> ApiClient:
+    """
+    Client dùng chung của process cho (backend, stage, model). Hạn mức lấy từ `backend.rpm`
+    (Gemini: GEMINI_EMBED_RPM / GEMINI_GEN_RPM; backend giả lập: None = không giới hạn).
+    Client đi theo vòng đời của backend: backend bị thay (set_embed_backend...) và thu hồi
+    thì client của nó cũng bị bỏ.
+    """
+    key = (stage, getattr(backend, "model", ""))
+    with _CLIENTS_LOCK:
+        clients = _CLIENTS.setdefault(backend, {})
+        client = clients.get(key)
+        if client is None:
+            retries = EMBED_MAX_RETRIES if stage == "embed" else GEN_MAX_RETRIES
+            client = clients[key] = ApiClient(stage, getattr(backend, "rpm", None), retries)
+        return client
+
+def api_client_stats() -> dict:
+    with _CLIENTS_LOCK:
+        clients = [c for per_backend in list(_CLIENTS.values()) for c in per_backend.values()]
+    out: dict = {}
+    for c in clients:
+        s = c.stats()
+        agg = out.setdefault(c.stage, dict.fromkeys(s, 0))
+        for k, v in s.items():
+            agg[k] += v
+    return out
+
+class FakeRateLimitError(RuntimeError):
+    """Lỗi 429 của server giả lập (có retry_after như header Retry-After)."""
+    retry_after = 0.0
+
+class _FakeQuota:
+    """
+    Hạn mức giả lập của server cho backend giả: quá `rpm` request trong cửa sổ `window`
+    giây (mặc định một phút; benchmark thu nhỏ cửa sổ để chạy nhanh) → lỗi 429.
+    """
+
+    def __init__(self, rpm: float | None, window: float = 60.0):
+        self.rpm = rpm
+        self.window = window
+        self.rejected = 0
+        self._times: deque = deque()
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        if not self.rpm:
+            return
+        with self._lock:
+            now = time.monotonic()
+            while self._times and now - self._times[0] >= self.window:
+                self._times.popleft()
+            if len(self._times) >= self.rpm:
+                self.rejected += 1
+                err = FakeRateLimitError("429 Resource has been exhausted (fake quota)")
+                err.retry_after = self.window - (now - self._times[0])
+                raise err
+            self._times.append(now)
+
+# ========= EMBEDDINGS =========
+EMBED_MODEL = "models/text-embedding-004"
+EMBED_BATCH_SIZE = 100      # batchEmbedContents nhận tối đa 100 đoạn / request
+EMBED_MAX_WORKERS = 4       # số batch gửi song song
+EMBED_MAX_RETRIES = 5       # số lần thử lại khi bị giới hạn tốc độ (429/503)
+
+def _extract_vectors(resp, n: int) -> list:
+    """
+    Chuẩn hóa response của embed_content (dict hoặc object, đơn lẻ hoặc batch)
+    thành list n phần tử; phần tử nào không đọc được thì là None.
+    """
+    emb = None
+    if isinstance(resp, dict):
+        emb = resp.get("embedding")
+        if isinstance(emb, dict):
+            emb = emb.get("values") or emb.get("value")
+        if emb is None and "embeddings" in resp:
             try:
-                emb_obj = getattr(resp, "embedding", None)
-                emb = getattr(emb_obj, "values", None) or getattr(emb_obj, "value", None)
+                emb = [e.get("values") or e.get("value") for e in resp["embeddings"]]
             except Exception:
                 emb = None
+    else:
+        try:
+            emb_obj = getattr(resp, "embedding", None)
+            emb = getattr(emb_obj, "values", None) or getattr(emb_obj, "value", None)
+        except Exception:
+            emb = None
+
+    if emb is None:
+        return [None] * n
+    emb = list(emb)
+    # đơn lẻ → 1 vector (list số); batch → list các vector
+    if emb and isinstance(emb[0], (int, float)):
+        vecs = [emb]
+    else:
+        vecs = [list(v) if v is not None else None for v in emb]
+    if len(vecs) != n:
+        return [None] * n
+    return vecs
 
-        if emb is None:
-            continue
-        vecs.append(np.array(emb, dtype=np.float32))
+class GeminiEmbedBackend:
+    """Gọi genai.embed_content theo batch (content là list chuỗi)."""
+    requires_api_key = True
+
+    def __init__(self, model: str = EMBED_MODEL, rpm: float | None = None):
+        self.model = model
+        self.rpm = rpm or EMBED_RPM
+
+    def embed_batch(self, texts: list[str], task_type: str) -> list:
+        resp = _genai().embed_content(model=self.model, content=texts, task_type=task_type)
+        return _extract_vectors(resp, len(texts))
+
+class FakeEmbedBackend:
+    """
+    Backend giả lập chạy offline để test/benchmark (không gọi mạng).
+    Vector = tổng các vector ngẫu nhiên cố định theo từng từ → văn bản chung từ
+    thì gần nhau, kết quả tất định giữa các lần chạy. `latency` (giây) mô phỏng
+    thời gian một round trip cho mỗi batch. `quota_rpm` giả lập hạn mức của server
+    (vượt → lỗi 429), `rpm` là hạn mức phía client tự giữ (None = không giới hạn).
+    """
+    requires_api_key = False
 
-    if not vecs:
+    def __init__(self, dim: int = 768, latency: float = 0.0, model: str = "fake-embedding",
+                 rpm: float | None = None, quota_rpm: float | None = None, quota_window: float = 60.0):
+        self.dim = dim
+        self.latency = latency
+        self.model = model
+        self.rpm = rpm
+        self.quota = _FakeQuota(quota_rpm, quota_window)
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._word_vecs: dict[str, np.ndarray] = {}
+
+    def _word_vec(self, word: str) -> np.ndarray:
+        v = self._word_vecs.get(word)
+        if v is None:
+            seed = int.from_bytes(hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest(), "little")
+            v = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+            self._word_vecs[word] = v
+        return v
+
+    def embed_batch(self, texts: list[str], task_type: str) -> list:
+        with self._lock:
+            self.calls += 1
+        self.quota.check()
+        if self.latency:
+            time.sleep(self.latency)
+        out = []
+        for t in texts:
+            v = np.zeros(self.dim, dtype=np.float32)
+            for w in t.lower().split():
+                v += self._word_vec(w)
+            out.append(v)
+        return out
+
+_EMBED_BACKEND = None
+
+def get_embed_backend():
+    """Backend hiện tại; đặt EMBED_BACKEND=fake để chạy offline."""
+    global _EMBED_BACKEND
+    if _EMBED_BACKEND is None:
+        if os.getenv("EMBED_BACKEND", "").lower() == "fake":
+            _EMBED_BACKEND = FakeEmbedBackend()
+        else:
+            _EMBED_BACKEND = GeminiEmbedBackend()
+    return _EMBED_BACKEND
+
+def set_embed_backend(backend) -> None:
+    """Thay backend (dùng cho benchmark/test). None → chọn lại theo ENV."""
+    global _EMBED_BACKEND
+    _EMBED_BACKEND = backend
+
+def _embed_batch_with_retry(backend, texts: list[str], task_type: str, priority: int | None = None) -> list:
+    """
+    Gửi 1 batch qua ApiClient dùng chung: chờ lượt theo hạn mức, thử lại khi bị giới hạn
+    tốc độ, và batch giống hệt đang được gửi bởi phiên khác thì dùng chung kết quả.
+    """
+    key = (task_type, hashlib.sha256("\0".join(texts).encode("utf-8")).hexdigest())
+    try:
+        return get_api_client("embed", backend).call(backend.embed_batch, texts, task_type,
+                                                     key=key, priority=priority)
+    except Exception as e:
+        metrics.error("embed", e, batch=len(texts))
+        raise
+
+# ========= EMBEDDING CACHE =========
+EMBED_CACHE_MAX_ENTRIES = 200_000   # ~600MB với vector 768 chiều float32
+
+def _normalize_text(text: str) -> str:
+    """Chuẩn hóa Unicode (NFC) và khoảng trắng để cùng nội dung → cùng khóa."""
+    return unicodedata.normalize("NFC", " ".join((text or "").split()))
+
+class EmbeddingCache:
+    """
+    Cache embedding trên đĩa (SQLite trong DATA_DIR), dùng chung cho cả nạp tài liệu
+    và câu hỏi của học sinh; còn nguyên sau khi Streamlit khởi động lại.
+    Khóa = sha256(model, task_type, văn bản đã chuẩn hóa). Vượt `max_entries` thì
+    xóa các mục lâu không dùng nhất (LRU theo last_used).
+    """
+
+    def __init__(self, path: str | None = None, max_entries: int = EMBED_CACHE_MAX_ENTRIES):
+        self.path = path or os.path.join(DATA_DIR, "embed_cache.sqlite")
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb ("
+            " key TEXT PRIMARY KEY, dim INTEGER NOT NULL, vec BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS emb_last_used ON emb(last_used)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, task_type: str, text: str) -> str:
+        h = hashlib.sha256()
+        for part in (model, task_type, _normalize_text(text)):
+            h.update(part.encode("utf-8"))
+            h.update(b"\0")
+        return h.hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict:
+        """Trả {key: vector} cho các khóa có trong cache và cập nhật last_used."""
+        found = {}
+        if not keys:
+            return found
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vec FROM emb WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for k, blob in rows:
+                    found[k] = np.frombuffer(blob, dtype=np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE emb SET last_used=? WHERE key=?", [(now, k) for k in found])
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: dict) -> None:
+        """Lưu {key: vector}; xóa bớt mục cũ nếu vượt giới hạn."""
+        if not items:
+            return
+        now = time.time()
+        rows = [(k, len(v), np.asarray(v, dtype=np.float32).tobytes(), now) for k, v in items.items()]
+        with self._lock:
+            # rowcount của INSERT OR IGNORE chỉ tính khóa mới; khóa đã có (cùng nội dung nên
+            # cùng vector) chỉ cần làm mới last_used
+            cur = self._conn.executemany("INSERT OR IGNORE INTO emb(key, dim, vec, last_used) VALUES (?,?,?,?)", rows)
+            inserted = max(cur.rowcount, 0)
+            if inserted < len(rows):
+                self._conn.executemany("UPDATE emb SET last_used=? WHERE key=?", [(now, k) for k in items])
+            self._count += inserted
+            if self._count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM emb WHERE key IN (SELECT key FROM emb ORDER BY last_used LIMIT ?)",
+                    (self._count - self.max_entries,),
+                )
+                self._count = self._conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0]
+            self._conn.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "entries": self._count,
+        }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM emb")
+            self._conn.commit()
+            self._count = 0
+            self.hits = self.misses = 0
+
+_EMBED_CACHE = None
+
+def get_embed_cache() -> EmbeddingCache | None:
+    """Cache dùng chung trong process; đặt EMBED_CACHE=0 để tắt."""
+    global _EMBED_CACHE
+    if os.getenv("EMBED_CACHE", "1") == "0":
+        return None
+    if _EMBED_CACHE is None:
+        _EMBED_CACHE = EmbeddingCache()
+    return _EMBED_CACHE
+
+def embed_cache_stats() -> dict:
+    cache = get_embed_cache()
+    return cache.stats() if cache is not None else {}
+
+def embed_texts(
+    texts: list[str],
+    task_type: str = "retrieval_document",
+    batch_size: int = EMBED_BATCH_SIZE,
+    max_workers: int = EMBED_MAX_WORKERS,
+    use_cache: bool = True,
+) -> np.ndarray:
+    """
+    Tạo embedding cho danh sách chuỗi. Trả về mảng (N, D) với N == len(texts):
+    dòng i luôn ứng với texts[i]; chuỗi rỗng hoặc không nhận được vector thì là
+    dòng toàn 0 (để .npy luôn khớp với danh sách chunk).
+    Chuỗi đã có trong cache đĩa thì không gọi API; phần còn lại được gửi theo batch,
+    tối đa `max_workers` batch chạy song song.
+    Nếu thiếu API key → raise RuntimeError (tại thời điểm dùng).
+    """
+    if not texts:
         return np.zeros((0, 0), dtype=np.float32)
-    return np.vstack(vecs)
+    with metrics.timer("embed", task=task_type, texts=len(texts)) as t:
+        out = _embed_texts(texts, task_type, batch_size, max_workers, use_cache)
+        t.set(dim=int(out.shape[1]))
+        return out
+
+def _embed_texts(texts: list[str], task_type: str, batch_size: int, max_workers: int, use_cache: bool) -> np.ndarray:
+    backend = get_embed_backend()
+    results: list = [None] * len(texts)
+
+    # chỉ xử lý các chuỗi không rỗng, nhớ vị trí gốc để trả về đúng thứ tự
+    idx = [i for i, t in enumerate(texts) if (t or "").strip()]
+    cache = get_embed_cache() if use_cache else None
+    keys: dict[int, str] = {}
+    if cache is not None and idx:
+        model = getattr(backend, "model", "")
+        keys = {i: cache.make_key(model, task_type, texts[i]) for i in idx}
+        found = cache.get_many(list(set(keys.values())))
+        for i in idx:
+            results[i] = found.get(keys[i])
+        metrics.incr("embed.cache_hits", len(idx) - sum(results[i] is None for i in idx))
+        idx = [i for i in idx if results[i] is None]
+
+    if idx and getattr(backend, "requires_api_key", False) and not _ensure_config():
+        raise RuntimeError("GEMINI_API_KEY chưa được thiết lập trong Secrets/ENV.")
+    batches = [idx[i:i + batch_size] for i in range(0, len(idx), max(1, batch_size))]
+    priority = current_priority()   # worker thread không thừa hưởng contextvar của luồng gọi
+
+    def run(batch: list[int]):
+        vecs = _embed_batch_with_retry(backend, [texts[i].strip() for i in batch], task_type, priority)
+        for i, v in zip(batch, vecs):
+            results[i] = v
+    run = metrics.bind(run)     # lượt gọi API/thử lại trong worker vẫn tính vào trace hiện tại
+
+    if len(batches) <= 1 or max_workers <= 1:
+        for b in batches:
+            run(b)
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(batches))) as ex:
+            for fut in [ex.submit(run, b) for b in batches]:
+                fut.result()
+
+    if cache is not None and idx:
+        cache.put_many({keys[i]: results[i] for i in idx if results[i] is not None})
+
+    dim = next((len(v) for v in results if v is not None), 0)
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for i, v in enumerate(results):
+        if v is not None and len(v) == dim:
+            out[i] = np.asarray(v, dtype=np.float32)
+    return out
 
 # ========= GENERATION =========
-def generate_answer(
-    question: str,
-    context: list[str] | str | None = None
-) -> str:
+GEN_MODEL = "gemini-1.5-flash"
+GEN_MAX_RETRIES = 2         # học sinh đang chờ: thử lại ít lần hơn embedding
+
+def _response_text(resp) -> str:
+    """Lấy text từ response (hoặc 1 chunk khi stream); rỗng nếu không có."""
+    try:
+        text = getattr(resp, "text", None)
+    except Exception:
+        # .text raise khi chunk không có part văn bản (vd. chỉ có safety ratings)
+        text = None
+    if text:
+        return text
+    # fallback khi SDK thay đổi cấu trúc
+    try:
+        parts = []
+        for c in resp.candidates:  # type: ignore[attr-defined]
+            for p in c.content.parts:
+                if hasattr(p, "text"):
+                    parts.append(p.text)
+        return "\n".join(parts)
+    except Exception:
+        return ""
+
+class GeminiGenerateBackend:
+    """Gọi GenerativeModel.generate_content (thường hoặc stream=True)."""
+    requires_api_key = True
+
+    def __init__(self, model: str = GEN_MODEL, rpm: float | None = None):
+        self.model = model
+        self.rpm = rpm or GEN_RPM
+        self._client = None
+        self._lock = threading.Lock()
+
+    def _model(self):
+        """GenerativeModel tạo 1 lần và dùng lại cho mọi câu hỏi (backend dùng chung trong process)."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = _genai().GenerativeModel(self.model)
+        return self._client
+
+    def generate(self, prompt: str) -> str:
+        resp = self._model().generate_content(prompt)
+        return _response_text(resp)
+
+    def stream(self, prompt: str):
+        for chunk in self._model().generate_content(prompt, stream=True):
+            text = _response_text(chunk)
+            if text:
+                yield text
+
+class FakeGenerateBackend:
     """
-    Gọi Gemini-1.5-Flash sinh trả lời. Nếu có context (1 hoặc nhiều đoạn), mô hình sẽ
-    được hướng dẫn chỉ bám vào context. Nếu thiếu API key → thông báo gọn.
+    Sinh câu trả lời giả lập offline (test/benchmark): nhắc lại câu hỏi và đoạn đầu
+    của tài liệu tham khảo, trả từng từ với độ trễ `first_token_latency` rồi
+    `token_latency` giây mỗi từ. `rpm` / `quota_rpm` như FakeEmbedBackend.
     """
-    if not _ensure_config():
-        return "⚠️ Ứng dụng chưa có GEMINI_API_KEY (Settings → Secrets)."
+    requires_api_key = False
+
+    def __init__(self, first_token_latency: float = 0.0, token_latency: float = 0.0, model: str = "fake-generation",
+                 rpm: float | None = None, quota_rpm: float | None = None, quota_window: float = 60.0):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.model = model
+        self.rpm = rpm
+        self.quota = _FakeQuota(quota_rpm, quota_window)
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _answer(self, prompt: str) -> str:
+        q = prompt.rsplit("Câu hỏi:", 1)[-1].split("\n", 1)[0].strip()
+        ctx = prompt.split("(trích đoạn):\n", 1)[1].split("\n", 1)[0] if "(trích đoạn):" in prompt else ""
+        words = ctx.split()[:40]
+        return f"Trả lời cho câu hỏi '{q}': " + (" ".join(words) if words else "Không có trong tài liệu.")
+
+    def generate(self, prompt: str) -> str:
+        return "".join(self.stream(prompt))
+
+    def stream(self, prompt: str):
+        with self._lock:
+            self.calls += 1
+        self.quota.check()
+        if self.first_token_latency:
+            time.sleep(self.first_token_latency)
+        for i, w in enumerate(self._answer(prompt).split(" ")):
+            if i and self.token_latency:
+                time.sleep(self.token_latency)
+            yield w if i == 0 else " " + w
+
+_GEN_BACKEND = None
+
+def get_generate_backend():
+    """Backend sinh câu trả lời hiện tại; đặt GEN_BACKEND=fake để chạy offline."""
+    global _GEN_BACKEND
+    if _GEN_BACKEND is None:
+        if os.getenv("GEN_BACKEND", "").lower() == "fake":
+            _GEN_BACKEND = FakeGenerateBackend()
+        else:
+            _GEN_BACKEND = GeminiGenerateBackend()
+    return _GEN_BACKEND
+
+def set_generate_backend(backend) -> None:
+    """Thay backend (dùng cho benchmark/test). None → chọn lại theo ENV."""
+    global _GEN_BACKEND
+    _GEN_BACKEND = backend
 
-    # Chuẩn bị prompt
+CHARS_PER_TOKEN = 3     # ước lượng thô cho tiếng Việt có dấu, giống kb.approx_tokens
+
+def estimate_tokens(text: str) -> int:
+    """Ước lượng số token đầu vào (không gọi API count_tokens để khỏi thêm một round trip)."""
+    return max(1, -(-len(text) // CHARS_PER_TOKEN)) if text else 0
+
+def build_prompt(question: str, context: list[str] | str | None = None) -> str:
+    """Prompt gửi mô hình: có context thì yêu cầu chỉ bám vào context."""
     if context:
         ctx = "\n".join(context) if isinstance(context, list) else str(context)
         system = (
             "Bạn là Trợ giảng AI. Chỉ sử dụng thông tin trong 'Tài liệu tham khảo' để trả lời. "
             "Nếu không đủ thông tin, hãy nói: 'Không có trong tài liệu'."
         )
-        prompt = (
+        return (
             f"{system}\n\n"
             f"Tài liệu tham khảo (trích đoạn):\n{ctx}\n\n"
             f"Câu hỏi: {question}\n"
             f"Hãy trả lời ngắn gọn, chính xác, bám sát tài liệu."
         )
+    return f"Câu hỏi: {question}\nTrả lời ngắn gọn, chính xác bằng tiếng Việt."
+
+def _prompt_key(prompt: str) -> str:
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def _generation_error_message(e: Exception) -> str:
+    if isinstance(e, ApiBusyError):
+        return "⏳ Đang có nhiều bạn hỏi cùng lúc, vui lòng thử lại sau ít phút."
+    return "Đã xảy ra lỗi khi gọi mô hình."
+
+def _report_generation_error(e: Exception, stats: dict | None = None) -> None:
+    """
+    Ghi lỗi sinh câu trả lời. Có `stats` thì chỉ ghi thông báo vào stats["error_detail"]
+    để luồng gọi tự hiển thị (hàm có thể đang chạy ở luồng worker, không được gọi st.*).
+    """
+    metrics.error("generate", e)
+    if stats is not None:
+        stats["error_detail"] = f"Lỗi gọi mô hình: {e}"
+    elif st is not None:
+        st.error(f"Lỗi gọi mô hình: {e}")
     else:
-        prompt = f"Câu hỏi: {question}\nTrả lời ngắn gọn, chính xác bằng tiếng Việt."
+        print(f"[Generation error] {e}")
+
+def generate_answer(
+    question: str,
+    context: list[str] | str | None = None,
+    stats: dict | None = None,
+) -> str:
+    """
+    Gọi Gemini-1.5-Flash sinh trả lời. Nếu có context (1 hoặc nhiều đoạn), mô hình sẽ
+    được hướng dẫn chỉ bám vào context. Nếu thiếu API key → thông báo gọn.
+    Nếu truyền `stats` (dict) thì có thêm prompt_tokens và error (True nếu không sinh
+    được câu trả lời thật), để phía gọi không lưu thông báo lỗi như một câu trả lời;
+    lỗi gọi mô hình khi đó nằm trong stats["error_detail"] thay vì hiện bằng st.error.
+    """
+    if stats is not None:
+        stats.update(prompt_tokens=0, error=False)
+    backend = get_generate_backend()
+    if getattr(backend, "requires_api_key", False) and not _ensure_config():
+        if stats is not None:
+            stats["error"] = True
+        return "⚠️ Ứng dụng chưa có GEMINI_API_KEY (Settings → Secrets)."
 
+    prompt = build_prompt(question, context)
+    prompt_tokens = estimate_tokens(prompt)
+    if stats is not None:
+        stats["prompt_tokens"] = prompt_tokens
     try:
-        model = genai.GenerativeModel("gemini-1.5-flash")
-        resp = model.generate_content(prompt)
-        text = getattr(resp, "text", None)
+        with metrics.timer("generate.total", prompt_tokens=prompt_tokens):
+            text = get_api_client("generate", backend).call(backend.generate, prompt, key=_prompt_key(prompt))
         if text and text.strip():
             return text.strip()
-        # fallback khi SDK thay đổi cấu trúc
-        try:
-            parts = []
-            for c in resp.candidates:  # type: ignore[attr-defined]
-                for p in c.content.parts:
-                    if hasattr(p, "text"):
-                        parts.append(p.text)
-            if parts:
-                return "\n".join(parts).strip()
-        except Exception:
-            pass
         return "Không có trong tài liệu."
     except Exception as e:
-        if st is not None:
-            st.error(f"Lỗi gọi mô hình: {e}")
-        else:
-            print(f"[Generation error] {e}")
-        return "Đã xảy ra lỗi khi gọi mô hình."
+        _report_generation_error(e, stats)
+        if stats is not None:
+            stats["error"] = True
+        return _generation_error_message(e)
+
+def generate_answer_stream(
+    question: str,
+    context: list[str] | str | None = None,
+    stats: dict | None = None,
+):
+    """
+    Như generate_answer nhưng trả về generator các đoạn text (delta) ngay khi mô hình
+    sinh ra, để UI hiển thị dần (st.write_stream). Nếu truyền `stats` (dict) thì sau
+    khi stream xong sẽ có: ttft (giây tới đoạn đầu tiên), total (giây), chars,
+    prompt_tokens (ước lượng) và error (True nếu không sinh được câu trả lời thật).
+    """
+    t0 = time.perf_counter()
+    if stats is not None:
+        stats.update(ttft=None, total=None, chars=0, prompt_tokens=0, error=False)
+
+    def done(n_chars: int, error: bool = False):
+        total = time.perf_counter() - t0
+        metrics.observe("generate.total", total, chars=n_chars, error=error)
+        if stats is not None:
+            stats["total"] = total
+            stats["chars"] = n_chars
+            stats["error"] = error
+
+    backend = get_generate_backend()
+    if getattr(backend, "requires_api_key", False) and not _ensure_config():
+        done(0, error=True)
+        yield "⚠️ Ứng dụng chưa có GEMINI_API_KEY (Settings → Secrets)."
+        return
+
+    prompt = build_prompt(question, context)
+    prompt_tokens = estimate_tokens(prompt)
+    if stats is not None:
+        stats["prompt_tokens"] = prompt_tokens
+    n_chars = 0
+    try:
+        for delta in get_api_client("generate", backend).stream(backend.stream, prompt, key=_prompt_key(prompt)):
+            if not delta:
+                continue
+            if n_chars == 0:
+                ttft = time.perf_counter() - t0
+                metrics.observe("generate.ttft", ttft, prompt_tokens=prompt_tokens)
+                if stats is not None:
+                    stats["ttft"] = ttft
+            n_chars += len(delta)
+            yield delta
+    except Exception as e:
+        _report_generation_error(e)
+        yield ("\n\n" if n_chars else "") + _generation_error_message(e)
+        done(n_chars, error=True)
+        return
+    if n_chars == 0:
+        yield "Không có trong tài liệu."
+    done(n_chars)
@@ -0,0 +1,514 @@
+"""
+jobs.py — hàng đợi tạo chủ đề chạy nền.
+- Mỗi job là một bản ghi JSON trong DATA_DIR/jobs (kèm bản sao tệp tải lên), nên
+  tắt tab / rerun Streamlit không làm mất việc đang chạy.
+- Worker thread đọc → chia đoạn → nhúng (kb.embed_pipelined: lô trước được nhúng trong lúc
+  lô sau còn đang đọc), ghi checkpoint sau mỗi lô đoạn đã nhúng;
+  job bị ngắt (process khởi động lại) sẽ chạy tiếp từ checkpoint thay vì làm lại
+  (trừ khi cách chia đoạn đã đổi — kb.CHUNKER_VERSION khác — thì chia và nhúng lại từ đầu).
+- Chỉ job hoàn tất mới được lưu tri thức và ghi vào sổ đăng ký lớp (registry.py).
+- Bản ghi job đã xong / lỗi được giữ JOB_RETENTION (mặc định 7 ngày) rồi tự xóa.
+- Job cập nhật chủ đề (mode="update") chỉ nhúng đoạn mới/đã sửa rồi ghi phiên bản mới.
+- Một chủ đề có thể gồm nhiều tệp hoặc một tệp ZIP: các tệp được đọc + chia đoạn song song
+  trong process pool (trích văn bản PDF tốn CPU, bị GIL giới hạn nếu chạy bằng thread), đoạn
+  của tệp trước được nhúng trong lúc tệp sau còn đang đọc; tệp lỗi được ghi lại, không làm
+  hỏng cả job, và tất cả gộp thành một kho tri thức của chủ đề.
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import uuid
+import zlib
+import zipfile
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+import common
+import kb
+import registry
+
+DATA_DIR = kb.DATA_DIR
+JOBS_DIR = os.path.join(DATA_DIR, "jobs")
+INGEST_WORKERS = 2                       # số job chạy đồng thời trong process
+CHECKPOINT_EVERY = common.EMBED_BATCH_SIZE * common.EMBED_MAX_WORKERS   # số đoạn mỗi lần nhúng + checkpoint
+PARSE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))   # process đọc tệp song song (job nhiều tệp)
+SUPPORTED_EXTS = (".pdf", ".docx", ".txt")
+ZIP_MAX_FILES = 200
+ZIP_MAX_BYTES = 500 * 1024 * 1024        # tổng dung lượng giải nén tối đa của một tệp ZIP
+JOB_RETENTION = 7 * 24 * 3600            # job đã xong / lỗi quá thời gian này (giây) thì bị xóa
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_LOCK = threading.Lock()          # bảo vệ _ACTIVE, _PARSE_POOL
+_ACTIVE: set = set()              # id job đang có trong hàng đợi của process này
+_RESUMED = False
+_PARSE_POOL: ProcessPoolExecutor | None = None
+_INDEX: dict = {}                 # tên tệp .json → ((mtime, size, inode), job): chỉ đọc lại JSON đã đổi
+_INDEX_LOCK = threading.Lock()
+
+def _path(job_id: str, suffix: str) -> str:
+    return os.path.join(JOBS_DIR, f"{job_id}.{suffix}")
+
+def _write_job(job: dict, throttle: bool = False) -> None:
+    now = time.time()
+    if throttle and now - job.get("updated", 0) < 0.5:
+        return      # cập nhật tiến độ theo trang: tối đa 2 lần/giây
+    job["updated"] = now
+    tmp = _path(job["id"], f"json.tmp{threading.get_ident()}")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(tmp, _path(job["id"], "json"))
+
+def get_job(job_id: str) -> dict | None:
+    try:
+        with open(_path(job_id, "json"), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def list_jobs(class_code: str | None = None, statuses: tuple | None = None) -> list[dict]:
+    """
+    Các job (mới nhất trước), lọc theo lớp / trạng thái nếu có. UI gọi hàm này mỗi lần
+    làm mới tiến độ nên chỉ đọc lại JSON của job có tệp vừa đổi (so mtime/size/inode), còn
+    lại lọc trên chỉ mục trong process. Job đã xong / lỗi quá JOB_RETENTION bị xóa hẳn.
+    """
+    try:
+        entries = [e for e in os.scandir(JOBS_DIR) if e.name.endswith(".json")]
+    except OSError:
+        return []
+    now = time.time()
+    out = []
+    with _INDEX_LOCK:
+        seen = set()
+        for e in entries:
+            try:
+                st = e.stat()
+            except OSError:
+                continue
+            stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+            cached = _INDEX.get(e.name)
+            if cached is None or cached[0] != stamp:
+                job = get_job(e.name[:-5])
+                if job is None:
+                    continue
+                cached = _INDEX[e.name] = (stamp, job)
+            job = cached[1]
+            if job.get("status") in ("done", "error") and now - job.get("updated", now) > JOB_RETENTION:
+                _expire(job)
+                continue
+            seen.add(e.name)
+            if class_code is not None and job.get("class_code") != class_code:
+                continue
+            if statuses is not None and job.get("status") not in statuses:
+                continue
+            out.append(dict(job))
+        for name in set(_INDEX) - seen:
+            del _INDEX[name]
+    out.sort(key=lambda j: j.get("created", 0), reverse=True)
+    return out
+
+def _expire(job: dict) -> None:
+    """Xóa hẳn job cũ: bản ghi JSON, bản sao tệp tải lên và checkpoint còn sót."""
+    _cleanup(job)
+    try:
+        os.remove(_path(job["id"], "json"))
+    except OSError:
+        pass
+
+def has_pending_topic(class_code: str, topic_file: str, topic_name: str) -> bool:
+    """Đã có job chưa xong cho cùng chủ đề trong lớp chưa."""
+    return any(
+        j["topic_file"] == topic_file or j["topic_name"] == topic_name
+        for j in list_jobs(class_code, statuses=("queued", "running"))
+    )
+
+def _copy(src, dst_path: str, limit: int | None = None) -> int:
+    """Chép luồng src vào tệp theo khối 1MB; vượt `limit` byte → ValueError."""
+    n = 0
+    with open(dst_path, "wb") as f:
+        while True:
+            block = src.read(1 << 20)
+            if not block:
+                break
+            n += len(block)
+            if limit is not None and n > limit:
+                raise ValueError("Tệp ZIP quá lớn sau khi giải nén.")
+            f.write(block)
+    return n
+
+def _zip_member_name(info: zipfile.ZipInfo) -> str:
+    """Tên tệp trong ZIP; ZIP tạo trên Windows thường ghi tên UTF-8 mà không bật cờ UTF-8."""
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("utf-8")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name
+
+def _save_uploads(job_id: str, uploaded_files) -> list[dict]:
+    """
+    Lưu các tệp tải lên thành <id>.<i>.upload; tệp ZIP được bung thành từng tệp thành viên.
+    Trả về danh sách mục tệp của job: {name, upload, status, chunks, error}.
+    """
+    files: list[dict] = []
+
+    def add(name: str, src, limit: int | None = None) -> int:
+        entry = {"name": name, "upload": None, "status": "queued", "chunks": 0, "error": None}
+        files.append(entry)
+        if os.path.splitext(name.lower())[1] not in SUPPORTED_EXTS:
+            entry.update(status="error", error="Định dạng không hỗ trợ.")
+            return 0
+        entry["upload"] = f"{len(files) - 1}.upload"
+        return _copy(src, _path(job_id, entry["upload"]), limit)
+
+    try:
+        for up in uploaded_files:
+            name = getattr(up, "name", "upload")
+            up.seek(0)
+            if not name.lower().endswith(".zip"):
+                add(name, up)
+                continue
+            try:
+                zf = zipfile.ZipFile(up)
+            except zipfile.BadZipFile:
+                raise ValueError(f"Tệp ZIP hỏng: {name}")
+            with zf:
+                members = [i for i in zf.infolist() if not i.is_dir() and not i.filename.startswith("__MACOSX/")
+                           and not os.path.basename(i.filename).startswith(".")]
+                if len(members) > ZIP_MAX_FILES:
+                    raise ValueError(f"Tệp ZIP có quá nhiều tệp (tối đa {ZIP_MAX_FILES}).")
+                budget = ZIP_MAX_BYTES
+                for info in sorted(members, key=lambda i: i.filename):
+                    member = _zip_member_name(info)
+                    if info.flag_bits & 0x1:
+                        raise ValueError(f"Tệp {member} trong {name} được đặt mật khẩu, vui lòng nén lại không mật khẩu.")
+                    try:
+                        with zf.open(info) as src:
+                            budget -= add(member, src, limit=budget)
+                    except (RuntimeError, NotImplementedError, EOFError, zlib.error, zipfile.BadZipFile) as e:
+                        # mật khẩu / kiểu nén không hỗ trợ / dữ liệu hỏng
+                        raise ValueError(f"Không giải nén được {member} trong {name}: {e}")
+        if not any(e["upload"] for e in files):
+            raise ValueError("Không có tệp .pdf, .docx hoặc .txt nào để xử lý.")
+    except Exception:
+        _cleanup({"id": job_id, "files": files})
+        raise
+    return files
+
+def submit_job(class_code: str, topic_name: str, topic_file: str, uploaded_files, mode: str = "create") -> str:
+    """
+    Lưu các tệp tải lên (một tệp, danh sách tệp, hoặc ZIP) + bản ghi job rồi đưa vào
+    hàng đợi. Trả về id job; ZIP hỏng / có mật khẩu / không có tệp hỗ trợ → ValueError.
+    mode="update": thay tài liệu của chủ đề đã có, chỉ nhúng các đoạn mới/đã sửa.
+    """
+    if not isinstance(uploaded_files, (list, tuple)):
+        uploaded_files = [uploaded_files]
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    job_id = time.strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8]
+    files = _save_uploads(job_id, uploaded_files)
+    names = [getattr(up, "name", "upload") for up in uploaded_files]
+    job = {
+        "id": job_id,
+        "class_code": class_code,
+        "topic_name": topic_name,
+        "topic_file": topic_file,
+        "filename": names[0] if len(names) == 1 else f"{names[0]} + {len(names) - 1} tệp khác",
+        "files": files,
+        "files_done": 0,
+        "mode": mode,
+        "status": "queued",
+        "created": time.time(),
+        "pages_done": 0,
+        "pages_total": None,
+        "chunks_total": 0,
+        "chunks_embedded": 0,
+        "chunker": kb.CHUNKER_VERSION,
+        "error": None,
+    }
+    _write_job(job)
+    _enqueue(job_id)
+    return job_id
+
+def _enqueue(job_id: str) -> None:
+    with _LOCK:
+        if job_id in _ACTIVE:
+            return
+        _ACTIVE.add(job_id)
+    _EXECUTOR.submit(_run_job, job_id)
+
+def resume_pending_jobs() -> int:
+    """Đưa lại vào hàng đợi các job chưa xong (gọi 1 lần khi process khởi động)."""
+    global _RESUMED
+    with _LOCK:
+        if _RESUMED:
+            return 0
+        _RESUMED = True
+    n = 0
+    for job in list_jobs(statuses=("queued", "running")):
+        _enqueue(job["id"])
+        n += 1
+    return n
+
+def _job_files(job: dict) -> list[dict]:
+    """Mục tệp của job (job cũ chỉ có một tệp <id>.upload)."""
+    if "files" not in job:
+        job["files"] = [{"name": job["filename"], "upload": "upload", "status": "queued", "chunks": 0, "error": None}]
+    return job["files"]
+
+def _open_upload(path: str, name: str):
+    """Mở bản sao tệp tải lên, mang tên gốc để kb.iter_document_chunks nhận đúng định dạng."""
+    f = open(path, "rb")
+    f.raw.name = name
+    return f
+
+def _parse_file(path: str, name: str) -> tuple[list[tuple[str, dict]], str | None]:
+    """
+    Đọc + chia đoạn cả tệp (chạy trong process con). Trả về (các đoạn, lỗi | None);
+    các đoạn đọc được trước khi gặp lỗi vẫn được giữ, giống khi đọc tuần tự.
+    """
+    out: list[tuple[str, dict]] = []
+    try:
+        with _open_upload(path, name) as f:
+            for item in kb.iter_document_chunks(f):
+                out.append(item)
+    except Exception as e:
+        return out, str(e) or type(e).__name__
+    return out, None
+
+def _parse_pool() -> ProcessPoolExecutor:
+    global _PARSE_POOL
+    with _LOCK:
+        if _PARSE_POOL is None:
+            # spawn: process con không thừa hưởng luồng/khóa đang giữ của Streamlit như fork
+            _PARSE_POOL = ProcessPoolExecutor(max_workers=PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context("spawn"))
+        return _PARSE_POOL
+
+def _reset_parse_pool() -> None:
+    global _PARSE_POOL
+    with _LOCK:
+        pool, _PARSE_POOL = _PARSE_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def _file_results(job: dict, files: list[dict]):
+    """
+    Yield (mục tệp, các đoạn (text, meta)) theo đúng thứ tự tệp (để checkpoint chạy tiếp được).
+    Một tệp: đọc lười ngay trong luồng job, báo tiến độ theo trang. Nhiều tệp: gửi hết vào
+    process pool, tệp sau được đọc trong lúc đoạn của tệp trước đang được nhúng.
+    Lỗi đọc tệp được ghi vào mục tệp (entry["error"]), không raise.
+    """
+    if len(files) == 1:
+        entry = files[0]
+        path = _path(job["id"], entry["upload"])
+
+        def on_part(done: int) -> None:
+            job["pages_done"] = done
+            _write_job(job, throttle=True)
+
+        def chunks():
+            try:
+                with _open_upload(path, entry["name"]) as f:
+                    job["pages_total"] = kb.count_document_pages(f)
+                    yield from kb.iter_document_chunks(f, on_part)
+            except Exception as e:      # chỉ lỗi đọc tệp; lỗi của bên nhúng không đi qua đây
+                entry["error"] = str(e) or type(e).__name__
+        yield entry, chunks()
+        return
+
+    paths = [_path(job["id"], e["upload"]) for e in files]
+    try:
+        pool = _parse_pool()
+        futures = [pool.submit(_parse_file, p, e["name"]) for p, e in zip(paths, files)]
+    except Exception:       # không tạo được process (môi trường hạn chế) → đọc tuần tự
+        futures = [None] * len(files)
+    try:
+        for entry, path, fut in zip(files, paths, futures):
+            try:
+                items, err = fut.result() if fut is not None else _parse_file(path, entry["name"])
+            except Exception:   # process con chết (hết bộ nhớ...) → đọc lại tệp này trong luồng job
+                _reset_parse_pool()
+                items, err = _parse_file(path, entry["name"])
+            entry["error"] = err
+            yield entry, items
+    finally:
+        for fut in futures:
+            if fut is not None:
+                fut.cancel()
+
+def _load_checkpoint(job_id: str) -> tuple[list[str], list[dict | None], np.ndarray | None]:
+    """
+    Đọc các đoạn đã nhúng (jsonl: {"text", "meta"} mỗi dòng) và vector tương ứng
+    (float32 thô, nối đuôi). Checkpoint tạo bởi cách chia đoạn khác được bỏ qua.
+    """
+    job = get_job(job_id) or {}
+    if job.get("chunker") != kb.CHUNKER_VERSION:
+        return [], [], None
+    chunks: list[str] = []
+    metas: list[dict | None] = []
+    try:
+        with open(_path(job_id, "ckpt.jsonl"), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.endswith("\n"):
+                    rec = json.loads(line)
+                    chunks.append(rec["text"])
+                    metas.append(rec.get("meta"))
+    except OSError:
+        return [], [], None
+    dim = job.get("dim") or 0
+    if not chunks or not dim:
+        return [], [], None
+    raw = np.fromfile(_path(job_id, "ckpt.f32"), dtype=np.float32)
+    rows = min(len(chunks), raw.size // dim)
+    # ghi dở giữa chừng → chỉ giữ phần khớp nhau
+    return chunks[:rows], metas[:rows], raw[:rows * dim].reshape(rows, dim)
+
+def _append_checkpoint(job_id: str, chunks: list[str], metas: list[dict | None], emb: np.ndarray) -> None:
+    with open(_path(job_id, "ckpt.f32"), "ab") as f:
+        f.write(np.ascontiguousarray(emb, dtype=np.float32).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    with open(_path(job_id, "ckpt.jsonl"), "a", encoding="utf-8") as f:
+        for c, m in zip(chunks, metas):
+            f.write(json.dumps({"text": c, "meta": m}, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def _truncate_checkpoint(job_id: str, chunks: list[str], metas: list[dict | None],
+                         emb: np.ndarray | None) -> None:
+    """Ghi lại checkpoint chỉ gồm phần nhất quán (sau khi bị ngắt giữa lúc ghi)."""
+    for suffix in ("ckpt.f32", "ckpt.jsonl"):
+        try:
+            os.remove(_path(job_id, suffix))
+        except OSError:
+            pass
+    if chunks and emb is not None:
+        _append_checkpoint(job_id, chunks, metas, emb)
+
+def register_topic(class_code: str, topic_name: str, topic_file: str) -> bool:
+    """Ghi chủ đề (kèm phiên bản tri thức vừa lưu) vào sổ đăng ký lớp. False nếu không có lớp."""
+    version = (kb.read_meta(class_code, topic_file) or {}).get("version")
+    return registry.add_topic(class_code, topic_name, topic_file, version)
+
+def _cleanup(job: dict) -> None:
+    uploads = [e["upload"] for e in job.get("files") or [{"upload": "upload"}] if e.get("upload")]
+    for suffix in uploads + ["ckpt.f32", "ckpt.jsonl"]:
+        try:
+            os.remove(_path(job["id"], suffix))
+        except OSError:
+            pass
+
+def _run_job(job_id: str) -> None:
+    with common.api_priority(common.PRIORITY_BACKGROUND):     # nhường lượt gọi API cho câu hỏi của học sinh
+        _run_job_inner(job_id)
+
+def _run_job_inner(job_id: str) -> None:
+    job = get_job(job_id)
+    try:
+        if job is None or job["status"] not in ("queued", "running"):
+            return
+        job["status"] = "running"
+        job["error"] = None
+        _write_job(job)
+
+        done_chunks, done_metas, done_emb = _load_checkpoint(job_id)
+        _truncate_checkpoint(job_id, done_chunks, done_metas, done_emb)
+        if job.get("chunker") != kb.CHUNKER_VERSION:
+            job["chunker"] = kb.CHUNKER_VERSION
+            job.pop("dim", None)
+        parts = [done_emb] if done_emb is not None else []
+        all_chunks: list[str] = list(done_chunks)
+        all_metas: list[dict | None] = list(done_metas)
+        job["chunks_embedded"] = len(done_chunks)
+
+        # cập nhật chủ đề: đoạn không đổi dùng lại vector của phiên bản đang lưu (nếu cùng mô hình)
+        embed_model = getattr(common.get_embed_backend(), "model", None)
+        if job.get("mode") == "update":
+            embed_fn = kb.ReusingEmbedder(job["class_code"], job["topic_file"], common.embed_texts,
+                                          model=embed_model)
+        else:
+            embed_fn = common.embed_texts
+
+        files = [e for e in _job_files(job) if e.get("upload")]
+        many = len(files) > 1
+        job["pages_done"] = 0
+        job["files_done"] = 0
+        job["files_total"] = len(files)
+
+        def fresh_chunks():
+            """Đoạn chưa nhúng ở lần chạy trước; cập nhật trạng thái từng tệp khi đọc xong."""
+            seen = 0
+            for entry, items in _file_results(job, files):
+                count = 0
+                for c, meta in items:
+                    if many:
+                        meta["source"] = entry["name"]
+                    count += 1
+                    seen += 1
+                    job["chunks_total"] = seen
+                    if seen > len(done_chunks):
+                        yield c, meta
+                entry["chunks"] = count
+                entry["status"] = "error" if entry["error"] else "done"
+                job["files_done"] += 1
+                _write_job(job)
+
+        # lô trước được nhúng ở luồng nền trong lúc luồng job đọc + chia đoạn lô sau
+        for batch, metas, emb in kb.embed_pipelined(fresh_chunks(), embed_fn, CHECKPOINT_EVERY):
+            if emb.shape[1] == 0 and parts:
+                emb = np.zeros((len(batch), parts[0].shape[1]), dtype=np.float32)
+            if not job.get("dim"):
+                job["dim"] = int(emb.shape[1])
+            _append_checkpoint(job_id, batch, metas, emb)
+            parts.append(emb)
+            all_chunks.extend(batch)
+            all_metas.extend(metas)
+            job["chunks_embedded"] += len(batch)
+            job["chunks_reused"] = getattr(embed_fn, "reused", 0)
+            _write_job(job)
+
+        if not all_chunks:
+            errors = [f"{e['name']}: {e['error']}" for e in _job_files(job) if e.get("error")]
+            if errors:
+                raise ValueError("Không đọc được tài liệu – " + "; ".join(errors))
+            raise ValueError("Tài liệu trống hoặc quá ngắn, không tạo được đoạn văn bản.")
+        embeddings = np.vstack(parts)
+        store = {}
+        if job.get("mode") == "update":
+            # giữ nguyên kiểu lưu của chủ đề (int8/float16, bản float32 để chấm lại)
+            meta = kb.read_meta(job["class_code"], job["topic_file"]) or {}
+            store = {"dtype": meta.get("dtype"), "keep_exact": bool(meta.get("exact"))}
+        saved = kb.save_knowledge(job["class_code"], job["topic_file"], all_chunks, embeddings,
+                                  chunk_meta=all_metas, embed_model=embed_model, **store)
+        if saved is not True:
+            raise RuntimeError(saved)
+        if not register_topic(job["class_code"], job["topic_name"], job["topic_file"]):
+            raise RuntimeError("Không ghi được chủ đề vào lớp (lớp không tồn tại hoặc trùng tên chủ đề).")
+        job["status"] = "done"
+        _write_job(job)
+        _cleanup(job)
+    except Exception as e:
+        if job is not None:
+            job["status"] = "error"
+            job["error"] = str(e)
+            _write_job(job)
+    finally:
+        with _LOCK:
+            _ACTIVE.discard(job_id)
+
+def retry_job(job_id: str) -> bool:
+    """Chạy lại job lỗi (tiếp tục từ checkpoint nếu còn)."""
+    job = get_job(job_id)
+    if job is None or job["status"] != "error":
+        return False
+    if not all(os.path.exists(_path(job_id, e["upload"])) for e in _job_files(job) if e.get("upload")):
+        return False
+    job["status"] = "queued"
+    _write_job(job)
+    _enqueue(job_id)
+    return True
@@ -2,15 +2,19 @@
 from __future__ import annotations
 import os
 import io
+import re
 import json
+import threading
+import time
 import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass
 from typing import List, Tuple
 
-from pypdf import PdfReader          # đọc PDF
-from docx import Document            # đọc DOCX
+import metrics
 
-DATA_DIR = "data"
-os.makedirs(DATA_DIR, exist_ok=True)
+# pypdf / python-docx chỉ import khi đọc tài liệu (chế độ học sinh không cần)
+DATA_DIR = "data"   # được tạo khi ghi dữ liệu lần đầu, không tạo lúc import
 
 def slugify_name(name: str) -> str:
     import re
@@ -28,95 +32,1886 @@ def slugify_name(name: str) -> str:
     s = re.sub(r"_+", "_", s).strip("_")
     return s or "untitled"
 
+DOCX_PARAS_PER_PART = 50     # DOCX/TXT không có trang: gom mỗi phần ~50 đoạn / 200 dòng
+TXT_LINES_PER_PART = 200
+
+def count_document_pages(uploaded_file) -> int | None:
+    """Số trang (PDF) để hiển thị tiến độ; định dạng khác trả None."""
+    ext = os.path.splitext(getattr(uploaded_file, "name", "").lower())[1]
+    if ext != ".pdf":
+        return None
+    try:
+        from pypdf import PdfReader
+        uploaded_file.seek(0)
+        return len(PdfReader(uploaded_file).pages)
+    except Exception:
+        return None
+    finally:
+        uploaded_file.seek(0)
+
+def iter_document_pages(uploaded_file):
+    """
+    Đọc lười UploadedFile (.pdf/.docx/.txt): yield (số thứ tự phần, text) cho từng
+    trang PDF, hoặc từng nhóm đoạn/dòng với DOCX/TXT, thay vì nạp cả file vào một chuỗi.
+    Định dạng không hỗ trợ → ValueError.
+    """
+    fname = getattr(uploaded_file, "name", "").lower()
+    ext = os.path.splitext(fname)[1]
+    if ext == ".pdf":
+        # PdfReader đọc trực tiếp từ file-like (seekable), trang nào cần mới phân tích
+        from pypdf import PdfReader
+        uploaded_file.seek(0)
+        reader = PdfReader(uploaded_file)
+        for i, page in enumerate(reader.pages, start=1):
+            yield i, page.extract_text() or ""
+    elif ext == ".docx":
+        # python-docx nhận file-like; nếu không được thì chuyển sang BytesIO
+        from docx import Document
+        try:
+            doc = Document(uploaded_file)
+        except Exception:
+            uploaded_file.seek(0)
+            doc = Document(io.BytesIO(uploaded_file.read()))
+        part, buf = 1, []
+        for p in doc.paragraphs:
+            buf.append(p.text)
+            if len(buf) >= DOCX_PARAS_PER_PART:
+                yield part, "\n".join(buf)
+                part, buf = part + 1, []
+        if buf:
+            yield part, "\n".join(buf)
+    elif ext == ".txt":
+        uploaded_file.seek(0)
+        stream = io.TextIOWrapper(uploaded_file, encoding="utf-8", errors="ignore", newline="")
+        try:
+            part, buf = 1, []
+            for line in stream:
+                buf.append(line.rstrip("\r\n"))
+                if len(buf) >= TXT_LINES_PER_PART:
+                    yield part, "\n".join(buf)
+                    part, buf = part + 1, []
+            if buf:
+                yield part, "\n".join(buf)
+        finally:
+            stream.detach()   # không đóng file gốc của Streamlit
+    else:
+        raise ValueError("Định dạng không hỗ trợ. Hãy dùng PDF/DOCX/TXT.")
+
 def read_document(uploaded_file) -> str:
     """
     Đọc nội dung từ UploadedFile (.pdf/.docx/.txt) và trả về chuỗi.
     Trả về chuỗi 'Lỗi …' nếu có lỗi để UI hiển thị rõ.
     """
     try:
-        fname = getattr(uploaded_file, "name", "").lower()
-        ext = os.path.splitext(fname)[1]
-        if ext == ".pdf":
-            data = uploaded_file.read()
-            reader = PdfReader(io.BytesIO(data))
-            text = []
-            for page in reader.pages:
-                text.append(page.extract_text() or "")
-            return "\n".join(text).strip()
-        elif ext == ".docx":
-            # python-docx nhận file-like; nếu không được thì chuyển sang BytesIO
-            try:
-                doc = Document(uploaded_file)
-            except Exception:
-                uploaded_file.seek(0)
-                doc = Document(io.BytesIO(uploaded_file.read()))
-            return "\n".join(p.text for p in doc.paragraphs).strip()
-        elif ext == ".txt":
-            b = uploaded_file.read()
-            return (b.decode("utf-8", errors="ignore")).strip()
-        else:
-            return "Lỗi: Định dạng không hỗ trợ. Hãy dùng PDF/DOCX/TXT."
+        return "\n".join(text for _, text in iter_document_pages(uploaded_file)).strip()
+    except ValueError as e:
+        return f"Lỗi: {e}"
     except Exception as e:
         return f"Lỗi khi đọc tài liệu: {e}"
 
-def split_into_chunks(text: str, max_words: int = 100) -> List[str]:
+_SENTENCE_SPLIT = re.compile(r'(?<=[\.!?])\s+')
+
+def iter_chunks(texts, max_words: int = 100):
     """
-    Chia văn bản thành các đoạn ~max_words từ (để tìm kiếm và prompt hiệu quả).
+    Bản tăng dần của split_into_chunks: nhận các phần văn bản (trang) lần lượt và
+    yield từng đoạn ngay khi đủ, cho kết quả giống hệt split_into_chunks("\n".join(texts)).
+    Câu chưa kết thúc ở cuối trang được giữ lại để nối với trang sau.
     """
-    import re
-    if not text or not text.strip():
-        return []
-    text = text.replace("\r", " ").replace("\n", " ")
-    sentences = re.split(r'(?<=[\.!?])\s+', text)
-    chunks, cur, cur_len = [], [], 0
-    for sent in sentences:
-        words = sent.split()
+    cur: List[str] = []
+    cur_len = 0
+    carry: List[str] = []      # các từ của câu đang dở
+
+    def add_sentence(words: List[str]):
+        nonlocal cur, cur_len
         while len(words) > max_words:          # câu quá dài thì cắt nhỏ
-            chunks.append(" ".join(words[:max_words]))
+            yield " ".join(words[:max_words])
             words = words[max_words:]
         if not words:
-            continue
+            return
         if cur_len + len(words) <= max_words:
             cur.extend(words)
             cur_len += len(words)
         else:
-            chunks.append(" ".join(cur))
+            if cur:
+                yield " ".join(cur)
             cur, cur_len = words, len(words)
+
+    for text in texts:
+        if not text:
+            continue
+        text = text.replace("\r", " ").replace("\n", " ")
+        buf = " ".join(carry) + " " + text if carry else text
+        sentences = _SENTENCE_SPLIT.split(buf)
+        carry = sentences.pop().split()
+        for sent in sentences:
+            yield from add_sentence(sent.split())
+        # câu dở quá dài: các phần đầu chắc chắn bị cắt ra, nên đẩy ra luôn
+        while len(carry) > max_words:
+            yield " ".join(carry[:max_words])
+            carry = carry[max_words:]
+    yield from add_sentence(carry)
     if cur:
-        chunks.append(" ".join(cur))
-    return [c.strip() for c in chunks if c.strip()]
+        yield " ".join(cur)
+
+def split_into_chunks(text: str, max_words: int = 100) -> List[str]:
+    """
+    Chia văn bản thành các đoạn ~max_words từ (để tìm kiếm và prompt hiệu quả).
+    """
+    if not text or not text.strip():
+        return []
+    return [c.strip() for c in iter_chunks([text], max_words) if c.strip()]
+
+# ========= CHIA ĐOẠN THEO CẤU TRÚC =========
+CHARS_PER_TOKEN = 3                # ước lượng thô cho tiếng Việt có dấu (thiên về dư)
+CHUNK_MAX_TOKENS = 256             # kích thước tối đa một đoạn (kể cả dòng tiêu đề đứng đầu)
+CHUNK_OVERLAP_TOKENS = 32          # số token cuối đoạn trước được lặp lại đầu đoạn sau (cùng mục)
+CHUNKER_VERSION = 3                # đổi khi cách chia đoạn đổi (checkpoint cũ không còn khớp)
+
+def approx_tokens(text: str) -> int:
+    """Ước lượng số token của đoạn văn (không gọi API)."""
+    return max(1, -(-len(text) // CHARS_PER_TOKEN)) if text else 0
+
+@dataclass
+class Block:
+    kind: str                   # "heading" | "para" | "list"
+    text: str
+    level: int = 0              # cấp tiêu đề, 1 là lớn nhất
+    page: int | None = None     # trang PDF (DOCX/TXT không có trang)
+    part: int = 1               # trang/phần tài liệu, để báo tiến độ
+
+@dataclass
+class Chunk:
+    text: str
+    headings: Tuple[str, ...] = ()      # đường dẫn tiêu đề, vd. ("Chương 1", "Bài 2")
+    page_start: int | None = None
+    page_end: int | None = None
+
+    def meta(self) -> dict:
+        return {"headings": list(self.headings),
+                "page": [self.page_start, self.page_end] if self.page_start is not None else None}
+
+_HEADING_WORD_RE = re.compile(r"^(chuong|phan|chapter|part|bai|muc|section|tiet)\s+([0-9]+|[ivxlc]+)\b")
+_HEADING_NUM_RE = re.compile(r"^(\d+(?:\.\d+)+|\d+(?=[.)]))[.)]?\s+\S")   # "1." / "2)" / "1.2", không nhận số trần
+_HEADING_ROMAN_RE = re.compile(r"^[IVXLC]+[.)]\s+\S")
+_LIST_RE = re.compile(r"^([-•*+–]|\d+[.)]|[a-zđ][.)])\s+")
+_PARA_END = (".", "!", "?", ":", ";", "…")
+MAX_HEADING_CHARS = 120   # dòng dài hơn thì không coi là tiêu đề
+
+def _heading_level(line: str) -> int:
+    """Cấp tiêu đề đoán từ một dòng văn bản thuần (0 nếu không giống tiêu đề)."""
+    words = line.split()
+    if not words or len(words) > 15 or len(line) > MAX_HEADING_CHARS \
+            or line.endswith((".", ",", ";", ":")):
+        return 0
+    if line.startswith("#"):
+        return min(len(line) - len(line.lstrip("#")), 6)
+    m = _HEADING_WORD_RE.match(fold_diacritics(line))
+    if m:
+        return 1 if m.group(1) in ("chuong", "phan", "chapter", "part") else 2
+    if _HEADING_ROMAN_RE.match(line):
+        return 1
+    m = _HEADING_NUM_RE.match(line)
+    if m and len(words) <= 12:
+        return 1 + m.group(1).count(".")
+    letters = [ch for ch in line if ch.isalpha()]
+    if len(letters) >= 4 and all(ch.isupper() for ch in letters):
+        return 1
+    return 0
+
+def _text_blocks(parts, pages: bool):
+    """
+    Dựng khối từ văn bản thuần (trang PDF / phần TXT): dòng trống hoặc dòng kết thúc
+    bằng dấu câu kết thúc đoạn; dòng ngắn giống tiêu đề / gạch đầu dòng được tách riêng.
+    Chỉ đoán tiêu đề khi dòng trước đã đóng đoạn (bộ đệm rỗng), để dòng bị ngắt giữa câu
+    bắt đầu bằng số ("12 học sinh ...") không bị nhận nhầm thành tiêu đề.
+    Đoạn chưa kết thúc ở cuối trang được nối tiếp sang trang sau.
+    """
+    buf: List[str] = []
+    buf_page = None
+    for part, text in parts:
+        page = part if pages else None
+        for raw in text.splitlines():
+            line = raw.strip()
+            if not line:
+                if buf:
+                    yield Block("para", " ".join(buf), page=buf_page, part=part)
+                    buf = []
+                continue
+            level = 0 if buf else _heading_level(line)
+            if level or _LIST_RE.match(line):
+                if buf:
+                    yield Block("para", " ".join(buf), page=buf_page, part=part)
+                    buf = []
+                if level:
+                    yield Block("heading", line.lstrip("#").strip(), level=level, page=page, part=part)
+                else:
+                    yield Block("list", line, page=page, part=part)
+                continue
+            if not buf:
+                buf_page = page
+            buf.append(line)
+            if line.endswith(_PARA_END):
+                yield Block("para", " ".join(buf), page=buf_page, part=part)
+                buf = []
+    if buf:
+        yield Block("para", " ".join(buf), page=buf_page, part=part)
+
+def _docx_blocks(uploaded_file):
+    from docx import Document
+    try:
+        doc = Document(uploaded_file)
+    except Exception:
+        uploaded_file.seek(0)
+        doc = Document(io.BytesIO(uploaded_file.read()))
+    for i, p in enumerate(doc.paragraphs):
+        text = p.text.strip()
+        if not text:
+            continue
+        part = i // DOCX_PARAS_PER_PART + 1
+        style = (p.style.name if p.style is not None else "") or ""
+        if style == "Title":
+            yield Block("heading", text, level=1, part=part)
+        elif style.startswith("Heading"):
+            digits = "".join(ch for ch in style if ch.isdigit())
+            yield Block("heading", text, level=int(digits) if digits else 1, part=part)
+        elif style.startswith("List") or p._p.pPr is not None and p._p.pPr.numPr is not None:
+            yield Block("list", text, part=part)
+        elif p.runs and all(r.bold for r in p.runs if r.text.strip()) and len(text.split()) <= 12 \
+                and not text.endswith(_PARA_END):
+            yield Block("heading", text, level=3, part=part)    # dòng in đậm đứng riêng: tiêu đề nhỏ
+        else:
+            level = _heading_level(text)
+            yield Block("heading" if level else "para", text, level=level, part=part)
+
+def iter_document_blocks(uploaded_file):
+    """
+    Đọc tài liệu thành các khối có cấu trúc (tiêu đề / đoạn / gạch đầu dòng):
+    DOCX lấy theo style (Heading N, List…), PDF/TXT đoán từ bố cục dòng. Đọc lười như
+    iter_document_pages; định dạng không hỗ trợ → ValueError.
+    """
+    ext = os.path.splitext(getattr(uploaded_file, "name", "").lower())[1]
+    if ext == ".docx":
+        yield from _docx_blocks(uploaded_file)
+    else:
+        yield from _text_blocks(iter_document_pages(uploaded_file), pages=(ext == ".pdf"))
+
+def _sentence_units(text: str, max_tokens: int, count_tokens) -> List[Tuple[str, int]]:
+    """Tách đoạn thành câu (câu quá dài thì cắt theo từ) kèm số token ước lượng."""
+    out = []
+    for sent in _SENTENCE_SPLIT.split(text):
+        sent = sent.strip()
+        if not sent:
+            continue
+        t = count_tokens(sent)
+        if t <= max_tokens:
+            out.append((sent, t))
+            continue
+        words, acc = [], 0
+        for w in sent.split():
+            wt = count_tokens(w + " ")
+            if words and acc + wt > max_tokens:
+                out.append((" ".join(words), acc))
+                words, acc = [], 0
+            words.append(w)
+            acc += wt
+        if words:
+            out.append((" ".join(words), acc))
+    return out
+
+def iter_structured_chunks(blocks, max_tokens: int = CHUNK_MAX_TOKENS,
+                           overlap_tokens: int = CHUNK_OVERLAP_TOKENS, count_tokens=approx_tokens):
+    """
+    Gom các khối thành Chunk theo ngân sách token: không vượt ranh giới tiêu đề, giữ
+    ranh giới đoạn (xuống dòng), cắt giữa các câu khi đầy. Đoạn mới trong cùng mục bắt
+    đầu bằng ~overlap_tokens cuối của đoạn trước. Mỗi chunk mở đầu bằng đường dẫn tiêu
+    đề ("Chương 1 › Bài 2") để đoạn đứng riêng vẫn đủ ngữ cảnh. Chạy tuyến tính, tăng dần.
+    """
+    stack: List[Tuple[int, str]] = []
+    units: List[list] = []      # [câu, token, xuống dòng trước?, trang]
+    used = 0
+    n_overlap = 0               # số câu đầu `units` là phần lặp lại từ đoạn trước
+    prefix, budget = "", max_tokens
+
+    def set_section():
+        nonlocal prefix, budget
+        prefix = " › ".join(h for _, h in stack)
+        budget = max(max_tokens - count_tokens(prefix), max_tokens // 2) if prefix else max_tokens
+
+    def emit():
+        body = ""
+        for i, (text, _, br, _) in enumerate(units):
+            body += (("\n" if br else " ") if i else "") + text
+        pages = [u[3] for u in units if u[3] is not None]
+        return Chunk(text=f"{prefix}\n{body}" if prefix else body, headings=tuple(h for _, h in stack),
+                     page_start=min(pages) if pages else None, page_end=max(pages) if pages else None)
+
+    def start_next():
+        """Đoạn mới giữ lại vài câu cuối (<= overlap_tokens) của đoạn vừa xuất."""
+        nonlocal units, used, n_overlap
+        keep, acc = [], 0
+        for u in reversed(units[1:]):
+            if acc + u[1] > overlap_tokens:
+                break
+            keep.append(u)
+            acc += u[1]
+        keep.reverse()
+        units = [[u[0], u[1], u[2] if i else False, u[3]] for i, u in enumerate(keep)]
+        used, n_overlap = acc, len(keep)
+
+    for b in blocks:
+        if b.kind == "heading":
+            if len(units) > n_overlap:
+                yield emit()
+            units, used, n_overlap = [], 0, 0
+            while stack and stack[-1][0] >= b.level:
+                stack.pop()
+            stack.append((b.level, b.text))
+            set_section()
+            continue
+        first = True
+        for text, t in ([(b.text, count_tokens(b.text))] if b.kind == "list" and count_tokens(b.text) <= budget
+                        else _sentence_units(b.text, budget, count_tokens)):
+            if used + t > budget and len(units) > n_overlap:
+                yield emit()
+                start_next()
+            while units and used + t > budget:      # phần lặp lại + câu mới vẫn quá dài
+                used -= units.pop(0)[1]
+                n_overlap = max(n_overlap - 1, 0)
+            units.append([text, t, first, b.page])
+            used += t
+            first = False
+    if len(units) > n_overlap:
+        yield emit()
+
+def chunk_document(uploaded_file, max_tokens: int = CHUNK_MAX_TOKENS,
+                   overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[Chunk]:
+    """Đọc + chia đoạn theo cấu trúc cả tài liệu (tiện cho script/benchmark)."""
+    return list(iter_structured_chunks(iter_document_blocks(uploaded_file), max_tokens, overlap_tokens))
+
+def iter_document_chunks(uploaded_file, on_part=None, max_tokens: int = CHUNK_MAX_TOKENS,
+                         overlap_tokens: int = CHUNK_OVERLAP_TOKENS):
+    """
+    (text, meta) của từng đoạn trong tài liệu, đọc lười theo trang/phần.
+    on_part(số phần đã đọc xong) được gọi khi sang trang/phần mới và khi đọc hết.
+    """
+    def blocks():
+        last = 0
+        for b in iter_document_blocks(uploaded_file):
+            if b.part > last:
+                if on_part is not None:
+                    on_part(last)
+                last = b.part
+            yield b
+        if on_part is not None:
+            on_part(last)
+
+    for ch in iter_structured_chunks(blocks(), max_tokens, overlap_tokens):
+        text = ch.text.strip()
+        if text:
+            yield text, ch.meta()
+
+def embed_pipelined(items, embed_fn, batch_size: int = 100):
+    """
+    Nhúng luồng (text, meta) theo lô, gối với việc đọc: trong lúc embed_fn (vd.
+    common.embed_texts) xử lý một lô ở luồng nền, luồng gọi tiếp tục đọc + chia đoạn
+    để gom lô sau. Yield (texts, metas, embeddings float32) theo đúng thứ tự đoạn;
+    lỗi nhúng được raise ở lô tương ứng. Chỉ một lô chờ nhúng trước lô đang được
+    trả về, nên bộ nhớ không phình theo độ dài tài liệu.
+    """
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    inflight = deque()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embed") as ex:
+        def take():
+            texts, metas, fut = inflight.popleft()
+            return texts, metas, np.asarray(fut.result(), dtype=np.float32)
+
+        texts: List[str] = []
+        metas: List[dict] = []
+        for text, meta in items:
+            texts.append(text)
+            metas.append(meta)
+            if len(texts) >= batch_size:
+                inflight.append((texts, metas, ex.submit(embed_fn, texts)))
+                texts, metas = [], []
+                if len(inflight) > 1:
+                    yield take()
+        if texts:
+            inflight.append((texts, metas, ex.submit(embed_fn, texts)))
+        while inflight:
+            yield take()
+
+# ========= KHO TRI THỨC TRÊN ĐĨA =========
+# Mỗi chủ đề <lớp>_<chủ đề> gồm:
+#   <base>.meta.json          con trỏ tới phiên bản hiện tại (ghi nguyên tử bằng os.replace)
+#   <base>.v<k>.emb.npy       ma trận embedding đã chuẩn hóa (float32/float16), mở bằng mmap
+#   <base>.v<k>.chunks.txt    nội dung các đoạn (UTF-8) nối liền nhau
+#   <base>.v<k>.offsets.npy   int64 (N+1) vị trí byte bắt đầu của từng đoạn
+#   <base>.v<k>.ivf.npz       chỉ mục ANN (chỉ có khi số đoạn >= ANN_MIN_CHUNKS)
+#   <base>.v<k>.bm25.npz      chỉ mục từ khóa BM25 (posting lists dạng mảng)
+#   <base>.v<k>.chunkmeta.npz trang + đường dẫn tiêu đề của từng đoạn (nếu có)
+# File của một phiên bản không bao giờ bị ghi đè: lưu mới = ghi phiên bản k+1 rồi đổi
+# con trỏ, nên các worker Streamlit dùng chung trang nhớ qua OS cache và người đang
+# đọc không bao giờ thấy cặp file ghi dở. Định dạng cũ <base>.json/.npy được tự chuyển đổi.
+STORE_FORMAT = 2
+STORE_KEEP_VERSIONS = 2   # giữ phiên bản hiện tại + phiên bản trước cho người đang đọc dở
+STORE_DTYPES = ("float32", "float16", "int8")
+STORE_DTYPE = os.getenv("KB_STORE_DTYPE", "float32")   # kiểu lưu ma trận embedding cho chủ đề mới
+
+def _base_name(class_code: str, topic_slug: str) -> str:
+    return f"{slugify_name(class_code)}_{slugify_name(topic_slug)}"
 
 def _base_paths(class_code: str, topic_slug: str) -> Tuple[str, str]:
-    cls = slugify_name(class_code)
-    t   = slugify_name(topic_slug)
-    base = f"{cls}_{t}"
+    """Đường dẫn cặp file định dạng cũ (.json + .npy)."""
+    base = _base_name(class_code, topic_slug)
     return os.path.join(DATA_DIR, base + ".json"), os.path.join(DATA_DIR, base + ".npy")
 
-def save_knowledge(class_code: str, topic_slug: str, chunks: List[str], embeddings: np.ndarray):
+def _meta_path(class_code: str, topic_slug: str) -> str:
+    return os.path.join(DATA_DIR, _base_name(class_code, topic_slug) + ".meta.json")
+
+def _version_path(class_code: str, topic_slug: str, version: int, suffix: str) -> str:
+    return os.path.join(DATA_DIR, f"{_base_name(class_code, topic_slug)}.v{version}.{suffix}")
+
+def _atomic_write_json(path: str, obj) -> None:
+    tmp = f"{path}.tmp{os.getpid()}_{threading.get_ident()}"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def read_meta(class_code: str, topic_slug: str) -> dict | None:
+    """Đọc con trỏ phiên bản hiện tại của chủ đề; chưa có thì trả None."""
+    try:
+        with open(_meta_path(class_code, topic_slug), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class ChunkStore:
+    """
+    Danh sách đoạn văn đọc lười từ file .chunks.txt qua mmap: lấy đoạn i là O(1)
+    (cắt theo offsets), không nạp toàn bộ văn bản vào RAM.
+    """
+
+    def __init__(self, text_fp: str, offsets: np.ndarray):
+        import mmap
+        self.offsets = offsets
+        self._f = open(text_fp, "rb")
+        size = os.fstat(self._f.fileno()).st_size
+        self._buf = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self._buf[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self) -> None:
+        if hasattr(self._buf, "close"):
+            self._buf.close()
+        self._f.close()
+
+class Int8Matrix:
+    """
+    Ma trận embedding lượng tử hóa int8 theo từng dòng: dòng i ≈ codes[i] × scales[i]
+    (scale = max|giá trị| / 127), nhỏ bằng 1/4 float32. Lấy dòng / np.asarray trả về
+    float32 đã giải nén, nên dùng được ở mọi chỗ đang đọc embeddings như mảng thường.
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray):
+        self.codes = codes          # (N, D) int8, thường là mmap
+        self.scales = scales        # (N,) float32
+
+    @staticmethod
+    def quantize(emb: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        emb = np.asarray(emb, dtype=np.float32)
+        scales = (np.abs(emb).max(axis=1) / 127.0 if emb.size else np.zeros(len(emb))).astype(np.float32)
+        safe = np.where(scales > 0, scales, 1.0)[:, None]
+        codes = np.clip(np.rint(emb / safe), -127, 127).astype(np.int8)
+        return codes, scales
+
+    @property
+    def shape(self) -> tuple:
+        return self.codes.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.codes.dtype
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.scales.nbytes
+
+    def __len__(self) -> int:
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx) -> np.ndarray:
+        codes = np.asarray(self.codes[idx], dtype=np.float32)
+        scales = np.asarray(self.scales[idx], dtype=np.float32)
+        return codes * (scales[..., None] if codes.ndim > scales.ndim else scales)
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        out = self[:]
+        return out.astype(dtype, copy=False) if dtype is not None else out
+
+class ChunkMeta:
+    """
+    Trang, đường dẫn tiêu đề và tệp nguồn của từng đoạn, lưu gọn: page_start/page_end
+    (int32, -1 = không có), chỉ số mục (section) trỏ vào danh sách đường dẫn tiêu đề khác
+    nhau, chỉ số tệp (source, -1 = chủ đề một tệp) trỏ vào danh sách tên tệp.
+    """
+
+    def __init__(self, page_start: np.ndarray, page_end: np.ndarray, section: np.ndarray, sections: list,
+                 source: np.ndarray | None = None, sources: list | None = None):
+        self.page_start = page_start
+        self.page_end = page_end
+        self.section = section
+        self.sections = sections
+        self.source = source if source is not None else np.full(len(section), -1, np.int32)
+        self.sources = sources or []
+
+    @classmethod
+    def build(cls, metas: List[dict | None]) -> "ChunkMeta":
+        ids: dict = {}
+        src_ids: dict = {}
+        n = len(metas)
+        ps, pe, sec = np.full(n, -1, np.int32), np.full(n, -1, np.int32), np.zeros(n, np.int32)
+        src = np.full(n, -1, np.int32)
+        for i, m in enumerate(metas):
+            m = m or {}
+            if m.get("page"):
+                ps[i], pe[i] = m["page"][0], m["page"][1]
+            sec[i] = ids.setdefault(tuple(m.get("headings") or ()), len(ids))
+            if m.get("source"):
+                src[i] = src_ids.setdefault(m["source"], len(src_ids))
+        return cls(ps, pe, sec, [list(h) for h in ids], src, list(src_ids))
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, page_start=self.page_start, page_end=self.page_end, section=self.section,
+                     sections=np.array(json.dumps(self.sections, ensure_ascii=False)),
+                     source=self.source, sources=np.array(json.dumps(self.sources, ensure_ascii=False)))
+
+    @classmethod
+    def load(cls, path: str) -> "ChunkMeta":
+        with np.load(path) as z:
+            has_source = "source" in z.files
+            return cls(z["page_start"], z["page_end"], z["section"], json.loads(str(z["sections"])),
+                       z["source"] if has_source else None,
+                       json.loads(str(z["sources"])) if has_source else None)
+
+    def __len__(self) -> int:
+        return len(self.section)
+
+    def get(self, i: int) -> dict:
+        """{"headings": [...], "page": [đầu, cuối] | None, "source": tên tệp | None} của đoạn i."""
+        page = [int(self.page_start[i]), int(self.page_end[i])] if self.page_start[i] >= 0 else None
+        source = self.sources[int(self.source[i])] if self.source[i] >= 0 else None
+        return {"headings": list(self.sections[int(self.section[i])]), "page": page, "source": source}
+
+    @property
+    def nbytes(self) -> int:
+        return self.page_start.nbytes + self.page_end.nbytes + self.section.nbytes + self.source.nbytes
+
+class _TopicLock:
+    """
+    Khóa ghi của một chủ đề: RLock trong process (dùng chung với việc nạp ở load_topic)
+    + flock trên <base>.lock để nhiều process không cấp trùng số phiên bản / cùng chuyển
+    đổi dữ liệu cũ. Vào lại được trong cùng luồng; file chỉ bị khóa ở tầng ngoài cùng.
     """
-    Lưu chunks (JSON) và embeddings (NPY) theo mã lớp + slug chủ đề.
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        if self._depth == 0:
+            try:
+                import fcntl
+            except ImportError:     # Windows: chỉ khóa trong process
+                fcntl = None
+            if fcntl is not None:
+                try:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                    fcntl.flock(self._fd, fcntl.LOCK_EX)
+                except BaseException:
+                    if self._fd is not None:
+                        os.close(self._fd)
+                        self._fd = None
+                    self.lock.release()
+                    raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            os.close(self._fd)      # đóng fd cũng nhả flock
+            self._fd = None
+        self.lock.release()
+        return False
+
+def _topic_lock(class_code: str, topic_slug: str) -> _TopicLock:
+    key = _cache_key(class_code, topic_slug)
+    with _KB_CACHE_LOCK:
+        tl = _KB_LOAD_LOCKS.get(key)
+        if tl is None:
+            tl = _KB_LOAD_LOCKS[key] = _TopicLock(
+                os.path.join(DATA_DIR, f"{_base_name(class_code, topic_slug)}.lock"))
+        return tl
+
+def _list_versions(class_code: str, topic_slug: str) -> List[int]:
+    prefix = _base_name(class_code, topic_slug) + ".v"
+    out = set()
+    try:
+        names = os.listdir(DATA_DIR)
+    except OSError:
+        return []
+    for name in names:
+        if name.startswith(prefix):
+            head = name[len(prefix):].split(".", 1)[0]
+            if head.isdigit():
+                out.add(int(head))
+    return sorted(out)
+
+def _gc_versions(class_code: str, topic_slug: str, current: int) -> None:
+    """Xóa các phiên bản cũ hơn STORE_KEEP_VERSIONS (bỏ qua file đang bị mở/mmap)."""
+    for v in _list_versions(class_code, topic_slug):
+        if v > current - STORE_KEEP_VERSIONS:
+            continue
+        for suffix in ("emb.npy", "scale.npy", "exact.npy", "chunks.txt", "offsets.npy", "ivf.npz", "bm25.npz",
+                       "chunkmeta.npz"):
+            try:
+                os.remove(_version_path(class_code, topic_slug, v, suffix))
+            except OSError:
+                pass
+
+def _write_version(class_code: str, topic_slug: str, chunks, embeddings: np.ndarray,
+                   dtype: str = "float32", extra_meta: dict | None = None, keep_exact: bool = False,
+                   chunk_meta: List[dict | None] | None = None) -> int:
+    """
+    Ghi một phiên bản mới rồi đổi con trỏ meta.json; trả về số phiên bản.
+    dtype: "float32" | "float16" | "int8" (lượng tử hóa theo dòng). keep_exact=True lưu
+    thêm bản float32 (exact.npy) để chấm lại chính xác các ứng viên khi tìm kiếm.
+    chunk_meta: mỗi đoạn một dict {"headings", "page", "source"?} (Chunk.meta()) hoặc None.
+    Cấp số phiên bản và ghi dưới khóa của chủ đề (_topic_lock).
     """
+    if dtype not in STORE_DTYPES:
+        raise ValueError(f"Kiểu lưu embedding không hỗ trợ: {dtype}")
     os.makedirs(DATA_DIR, exist_ok=True)
-    text_fp, emb_fp = _base_paths(class_code, topic_slug)
+    with _topic_lock(class_code, topic_slug):
+        return _write_version_locked(class_code, topic_slug, chunks, embeddings, dtype, extra_meta,
+                                     keep_exact, chunk_meta)
+
+def _write_version_locked(class_code: str, topic_slug: str, chunks, embeddings: np.ndarray, dtype: str,
+                          extra_meta: dict | None, keep_exact: bool, chunk_meta: List[dict | None] | None) -> int:
+    meta = read_meta(class_code, topic_slug) or {}
+    existing = _list_versions(class_code, topic_slug)
+    version = max([meta.get("version", 0)] + existing) + 1
+
+    emb = normalize_rows(embeddings) if np.size(embeddings) else np.zeros((len(chunks), 0), dtype=np.float32)
+    if emb.shape[0] != len(chunks):
+        raise ValueError(f"Số embedding ({emb.shape[0]}) khác số đoạn ({len(chunks)}).")
+    if chunk_meta is not None and len(chunk_meta) != len(chunks):
+        raise ValueError(f"Số metadata ({len(chunk_meta)}) khác số đoạn ({len(chunks)}).")
+    keep_exact = keep_exact and dtype != "float32" and emb.shape[1] > 0
+
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    with open(_version_path(class_code, topic_slug, version, "chunks.txt"), "wb") as f:
+        pos = 0
+        for i, c in enumerate(chunks):
+            b = c.encode("utf-8")
+            f.write(b)
+            pos += len(b)
+            offsets[i + 1] = pos
+    np.save(_version_path(class_code, topic_slug, version, "offsets.npy"), offsets)
+    if dtype == "int8":
+        codes, scales = Int8Matrix.quantize(emb)
+        np.save(_version_path(class_code, topic_slug, version, "emb.npy"), codes)
+        np.save(_version_path(class_code, topic_slug, version, "scale.npy"), scales)
+    else:
+        np.save(_version_path(class_code, topic_slug, version, "emb.npy"), emb.astype(dtype, copy=False))
+    if keep_exact:
+        np.save(_version_path(class_code, topic_slug, version, "exact.npy"), emb)
+
+    new_meta = {
+        "format": STORE_FORMAT,
+        "version": version,
+        "count": len(chunks),
+        "dim": int(emb.shape[1]),
+        "dtype": dtype,
+    }
+    if keep_exact:
+        new_meta["exact"] = True
+    if len(chunks) >= ANN_MIN_CHUNKS and emb.shape[1]:
+        index = IVFIndex.build(emb)         # dựng trên float32 trước khi nén
+        index.save(_version_path(class_code, topic_slug, version, "ivf.npz"))
+        new_meta["ann"] = {"type": "ivf", "nlist": index.nlist}
+    if chunks:
+        BM25Index.build(chunks).save(_version_path(class_code, topic_slug, version, "bm25.npz"))
+        new_meta["bm25"] = True
+    if chunk_meta is not None and any(chunk_meta):
+        ChunkMeta.build(chunk_meta).save(_version_path(class_code, topic_slug, version, "chunkmeta.npz"))
+        new_meta["chunk_meta"] = True
+    if extra_meta:
+        new_meta.update(extra_meta)
+    _atomic_write_json(_meta_path(class_code, topic_slug), new_meta)
+    _gc_versions(class_code, topic_slug, version)
+    return version
+
+def save_knowledge(class_code: str, topic_slug: str, chunks: List[str], embeddings: np.ndarray,
+                   dtype: str | None = None, keep_exact: bool = False, chunk_meta: List[dict] | None = None,
+                   embed_model: str | None = None):
+    """
+    Lưu chunks + embeddings theo mã lớp + slug chủ đề (thành một phiên bản mới).
+    dtype="float16" giảm một nửa, "int8" còn ~1/4 dung lượng ma trận embedding
+    (mặc định STORE_DTYPE); keep_exact=True giữ thêm bản float32 để chấm lại chính xác.
+    chunk_meta (tùy chọn): trang / đường dẫn tiêu đề / tệp nguồn của từng đoạn.
+    embed_model (tùy chọn): tên mô hình đã sinh embeddings, ghi vào meta.json để lần cập
+    nhật sau biết có dùng lại được vector cũ hay không (ReusingEmbedder).
+    """
     try:
-        with open(text_fp, "w", encoding="utf-8") as f:
-            json.dump(chunks, f, ensure_ascii=False, indent=2)
-        np.save(emb_fp, embeddings)
+        _write_version(class_code, topic_slug, list(chunks), embeddings, dtype=dtype or STORE_DTYPE,
+                       keep_exact=keep_exact, chunk_meta=chunk_meta, extra_meta=_model_meta(embed_model))
+        invalidate_topic(class_code, topic_slug)
         return True
     except Exception as e:
         return f"Lỗi lưu tri thức: {e}"
 
-def load_knowledge(class_code: str, topic_slug: str) -> Tuple[List[str] | None, np.ndarray | None]:
+def _model_meta(embed_model: str | None) -> dict | None:
+    return {"embed_model": embed_model} if embed_model else None
+
+def append_knowledge(class_code: str, topic_slug: str, chunks: List[str], embeddings: np.ndarray,
+                     chunk_meta: List[dict] | None = None):
     """
-    Tải lại (chunks, embeddings) cho lớp + chủ đề. Không có thì trả (None, None).
+    Thêm đoạn mới vào cuối chủ đề đã có mà không nhúng lại các đoạn cũ
+    (ghi thành phiên bản mới, các phiên bản trước giữ nguyên).
+    """
+    topic = load_topic(class_code, topic_slug)
+    if topic is None:
+        return save_knowledge(class_code, topic_slug, chunks, embeddings, chunk_meta=chunk_meta)
+    try:
+        new_emb = normalize_rows(embeddings)
+        old_emb = np.asarray(topic.exact if topic.exact is not None else topic.embeddings, dtype=np.float32)
+        if old_emb.shape[1] and new_emb.shape[1] != old_emb.shape[1]:
+            return "Lỗi lưu tri thức: số chiều embedding không khớp."
+        merged = np.vstack([old_emb, new_emb]) if old_emb.size else new_emb
+        meta = read_meta(class_code, topic_slug) or {}
+        if meta.get("missing_vectors"):
+            return "Lỗi lưu tri thức: chủ đề còn đoạn chưa có vector, hãy cập nhật lại tài liệu."
+        merged_meta = None
+        if topic.chunk_meta is not None or chunk_meta is not None:
+            old_meta = ([topic.chunk_meta.get(i) for i in range(len(topic.chunks))] if topic.chunk_meta is not None
+                        else [None] * len(topic.chunks))
+            merged_meta = old_meta + list(chunk_meta or [None] * len(chunks))
+        _write_version(class_code, topic_slug, list(topic.chunks) + list(chunks), merged,
+                       dtype=meta.get("dtype", "float32"), keep_exact=bool(meta.get("exact")),
+                       chunk_meta=merged_meta, extra_meta=_model_meta(meta.get("embed_model")))
+        invalidate_topic(class_code, topic_slug)
+        return True
+    except Exception as e:
+        return f"Lỗi lưu tri thức: {e}"
+
+def chunk_hash(text: str) -> str:
+    """Hash nội dung đoạn (bỏ khác biệt khoảng trắng) để so sánh giữa các phiên bản."""
+    import hashlib
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+class ReusingEmbedder:
+    """
+    Bọc embed_fn: đoạn nào đã có trong phiên bản hiện tại của chủ đề (cùng hash nội
+    dung) thì dùng lại vector đã lưu, chỉ gửi các đoạn mới/đã sửa đi nhúng.
+    Đếm số đoạn dùng lại / nhúng mới trong `reused` / `embedded`.
+    Vector cũ chỉ được dùng lại khi cùng mô hình (`model` so với "embed_model" trong
+    meta.json, nếu cả hai đều biết) và cùng số chiều với vector mới (lần gọi đầu nhúng
+    thử một đoạn để so), nếu không thì nhúng lại toàn bộ.
+    """
+
+    def __init__(self, class_code: str, topic_slug: str, embed_fn, model: str | None = None):
+        self.embed_fn = embed_fn
+        self.reused = 0
+        self.embedded = 0
+        self._emb = None
+        self._rows: dict = {}
+        self._checked = False
+        stored_model = (read_meta(class_code, topic_slug) or {}).get("embed_model")
+        if model and stored_model and model != stored_model:
+            return      # không gian vector khác → không dùng lại gì
+        topic = load_topic(class_code, topic_slug)
+        if topic is not None and topic.embeddings.shape[1]:
+            # có bản float32 thì dùng lại bản đó, không tích lũy sai số lượng tử hóa qua các lần cập nhật
+            self._emb = topic.exact if topic.exact is not None else topic.embeddings
+            # các đoạn cuối chưa có vector (chuyển từ bản cũ lệch dòng) thì nhúng lại
+            usable = len(topic.chunks) - int((read_meta(class_code, topic_slug) or {}).get("missing_vectors", 0))
+            for i in range(max(usable, 0)):
+                self._rows.setdefault(chunk_hash(topic.chunks[i]), i)
+
+    def _check_dim(self, text: str) -> None:
+        """Nhúng thử một đoạn; số chiều khác vector đã lưu (đổi backend/mô hình) → không dùng lại gì."""
+        probe = np.asarray(self.embed_fn([text]), dtype=np.float32)
+        if probe.ndim != 2 or not probe.shape[1]:
+            return      # nhúng lỗi: để lần gọi sau kiểm tra lại
+        self._checked = True
+        if probe.shape[1] != self._emb.shape[1]:
+            self._rows.clear()
+            self._emb = None
+
+    def __call__(self, texts: List[str]) -> np.ndarray:
+        if not self._checked and self._rows and texts:
+            self._check_dim(texts[0])
+        rows = [self._rows.get(chunk_hash(t)) for t in texts]
+        missing = [i for i, r in enumerate(rows) if r is None]
+        new = np.asarray(self.embed_fn([texts[i] for i in missing]), dtype=np.float32) if missing else None
+        dim = new.shape[1] if new is not None and new.ndim == 2 and new.shape[1] else (
+            self._emb.shape[1] if self._emb is not None else 0)
+        out = np.zeros((len(texts), dim), dtype=np.float32)
+        for i, r in enumerate(rows):
+            if r is not None and self._emb is not None and self._emb.shape[1] == dim:
+                out[i] = self._emb[r]
+        if new is not None and new.shape == (len(missing), dim):
+            out[missing] = new
+        self.reused += len(texts) - len(missing)
+        self.embedded += len(missing)
+        return out
+
+def update_knowledge(class_code: str, topic_slug: str, chunks: List[str], embed_fn,
+                     chunk_meta: List[dict] | None = None, embed_model: str | None = None):
+    """
+    Cập nhật chủ đề đã có bằng danh sách đoạn mới: so hash nội dung với phiên bản
+    đang lưu, chỉ nhúng đoạn mới/đã sửa, rồi ghi phiên bản mới và đổi con trỏ nguyên
+    tử — học sinh đang hỏi vẫn đọc phiên bản cũ cho tới lúc đổi.
+    Trả về dict {reused, embedded, removed, version} hoặc chuỗi 'Lỗi …'.
+    """
+    try:
+        old = load_topic(class_code, topic_slug)
+        old_hashes = {chunk_hash(c) for c in old.chunks} if old is not None else set()
+        embedder = ReusingEmbedder(class_code, topic_slug, embed_fn, model=embed_model)
+        emb = embedder(list(chunks))
+        meta = read_meta(class_code, topic_slug) or {}
+        version = _write_version(class_code, topic_slug, list(chunks), emb, dtype=meta.get("dtype", "float32"),
+                                 keep_exact=bool(meta.get("exact")), chunk_meta=chunk_meta,
+                                 extra_meta=_model_meta(embed_model))
+        invalidate_topic(class_code, topic_slug)
+        new_hashes = {chunk_hash(c) for c in chunks}
+        return {
+            "reused": embedder.reused,
+            "embedded": embedder.embedded,
+            "removed": len(old_hashes - new_hashes),
+            "version": version,
+        }
+    except Exception as e:
+        return f"Lỗi cập nhật tri thức: {e}"
+
+def migrate_legacy(class_code: str, topic_slug: str, keep_legacy: bool = False) -> bool:
+    """
+    Chuyển cặp <base>.json/.npy (định dạng cũ) sang kho phiên bản + mmap.
+    Trả về True nếu đã chuyển (hoặc chủ đề đã ở định dạng mới). Chạy dưới khóa của
+    chủ đề và đọc lại meta.json sau khi có khóa, nên nhiều phiên / process cùng nạp
+    lần đầu chỉ chuyển đổi một lần.
     """
+    if read_meta(class_code, topic_slug) is not None:
+        return True
     text_fp, emb_fp = _base_paths(class_code, topic_slug)
     if not (os.path.exists(text_fp) and os.path.exists(emb_fp)):
-        return None, None
+        # file cũ có thể vừa bị luồng khác xóa sau khi chuyển xong
+        return read_meta(class_code, topic_slug) is not None
+    with _topic_lock(class_code, topic_slug):
+        if read_meta(class_code, topic_slug) is not None:
+            return True     # luồng / process khác vừa chuyển xong
+        return _migrate_legacy_locked(class_code, topic_slug, text_fp, emb_fp, keep_legacy)
+
+def _migrate_legacy_locked(class_code: str, topic_slug: str, text_fp: str, emb_fp: str, keep_legacy: bool) -> bool:
     try:
         with open(text_fp, "r", encoding="utf-8") as f:
             chunks = json.load(f)
         emb = np.load(emb_fp)
-        return chunks, emb
+        missing = 0
+        if emb.ndim == 2 and emb.size and emb.shape[0] != len(chunks):
+            chunks, emb, missing = _align_legacy(chunks, emb)
+        elif not emb.size:
+            missing = len(chunks)
+        _write_version(class_code, topic_slug, chunks, emb,
+                       extra_meta={"missing_vectors": missing} if missing else None)
+    except Exception:
+        return False
+    if not keep_legacy:
+        for fp in (text_fp, emb_fp):
+            try:
+                os.remove(fp)
+            except OSError:
+                pass
+    return True
+
+def _align_legacy(chunks: List[str], emb: np.ndarray) -> Tuple[List[str], np.ndarray, int]:
+    """
+    Ghép lại đoạn ↔ vector của bản cũ bị lệch dòng (bản cũ bỏ qua đoạn rỗng và đoạn nhúng
+    lỗi). Bỏ đoạn rỗng mà khớp số dòng thì dùng luôn; nếu không, giữ cách bản cũ vẫn phục
+    vụ (đoạn thứ i ứng với vector thứ i) và để vector 0 cho các đoạn cuối không có vector —
+    vẫn tìm được theo từ khóa (BM25). Trả về (chunks, emb, số đoạn chưa có vector).
+    """
+    kept = [c for c in chunks if (c or "").strip()]
+    if len(kept) == emb.shape[0]:
+        return kept, emb, 0
+    n = min(len(chunks), emb.shape[0])
+    out = np.zeros((len(chunks), emb.shape[1]), dtype=np.float32)
+    out[:n] = emb[:n]
+    return chunks, out, len(chunks) - n
+
+def missing_vectors(class_code: str, topic_slug: str) -> int:
+    """Số đoạn chưa có vector (chủ đề chuyển từ bản cũ bị lệch dòng); > 0 → nên tải lại tài liệu."""
+    if not migrate_legacy(class_code, topic_slug):
+        return 0
+    return int((read_meta(class_code, topic_slug) or {}).get("missing_vectors", 0))
+
+def migrate_all_legacy(keep_legacy: bool = False) -> List[str]:
+    """Chuyển mọi cặp .json/.npy cũ trong DATA_DIR; trả về danh sách base đã chuyển."""
+    done = []
+    try:
+        names = os.listdir(DATA_DIR)
+    except OSError:
+        return done
+    for name in names:
+        if not name.endswith(".npy"):
+            continue
+        base = name[:-4]
+        if not os.path.exists(os.path.join(DATA_DIR, base + ".json")):
+            continue
+        # tên file chỉ phụ thuộc "<lớp>_<chủ đề>" nên tách ở dấu "_" nào cũng ra cùng file
+        cls, _, topic = base.partition("_")
+        if topic and _base_name(cls, topic) == base and migrate_legacy(cls, topic, keep_legacy):
+            done.append(base)
+    return done
+
+# ========= CACHE TRI THỨC TRONG PROCESS =========
+KB_CACHE_MAX_BYTES = 512 * 1024 * 1024   # ngân sách bộ nhớ riêng của process cho các chủ đề đã nạp
+KB_CACHE_MAX_TOPICS = 256                 # giới hạn số chủ đề đang mở (mmap/file handle)
+
+@dataclass
+class LoadedTopic:
+    chunks: ChunkStore         # đọc lười qua mmap
+    embeddings: np.ndarray     # mmap (chỉ đọc), mỗi dòng đã chuẩn hóa độ dài 1 (dòng rỗng = 0); có thể là Int8Matrix
+    signature: tuple           # (mtime_ns, size) của meta.json khi nạp
+    version: int
+    nbytes: int                # bộ nhớ riêng ước tính (trang mmap dùng chung qua OS cache)
+    ann: "IVFIndex | None" = None
+    bm25: "BM25Index | None" = None
+    exact: np.ndarray | None = None   # bản float32 (mmap) để chấm lại ứng viên khi embeddings được nén
+    chunk_meta: ChunkMeta | None = None   # trang / tiêu đề của từng đoạn (chủ đề cũ không có)
+
+_KB_CACHE: "OrderedDict[Tuple[str, str], LoadedTopic]" = OrderedDict()
+_KB_CACHE_LOCK = threading.Lock()
+_KB_LOAD_LOCKS: dict = {}       # khóa → _TopicLock (nạp / ghi / chuyển đổi từng chủ đề)
+_KB_CACHE_BYTES = 0
+_KB_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+
+def normalize_rows(emb: np.ndarray) -> np.ndarray:
+    """Chuẩn hóa từng dòng về độ dài 1 (float32); dòng toàn 0 giữ nguyên."""
+    emb = np.asarray(emb, dtype=np.float32)
+    if emb.ndim == 1:
+        emb = emb.reshape(1, -1)
+    norms = np.linalg.norm(emb, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return emb / norms
+
+def _file_signature(*paths: str) -> tuple | None:
+    try:
+        return tuple((st.st_mtime_ns, st.st_size) for st in (os.stat(p) for p in paths))
+    except OSError:
+        return None
+
+def _cache_key(class_code: str, topic_slug: str) -> Tuple[str, str]:
+    return slugify_name(class_code), slugify_name(topic_slug)
+
+def _evict(entry: LoadedTopic) -> None:
+    # không đóng mmap ngay: phiên khác có thể vẫn đang đọc; GC sẽ giải phóng
+    global _KB_CACHE_BYTES
+    _KB_CACHE_BYTES -= entry.nbytes
+
+def invalidate_topic(class_code: str, topic_slug: str) -> None:
+    """Bỏ chủ đề khỏi cache (gọi sau khi ghi lại tri thức)."""
+    with _KB_CACHE_LOCK:
+        entry = _KB_CACHE.pop(_cache_key(class_code, topic_slug), None)
+        if entry is not None:
+            _evict(entry)
+
+def kb_cache_stats() -> dict:
+    with _KB_CACHE_LOCK:
+        return dict(_KB_STATS, topics=len(_KB_CACHE), bytes=_KB_CACHE_BYTES)
+
+def _open_version(class_code: str, topic_slug: str, meta: dict) -> dict | None:
+    """Mở các file của phiên bản hiện tại; trả dict các trường cho LoadedTopic."""
+    v = meta["version"]
+    try:
+        offsets = np.load(_version_path(class_code, topic_slug, v, "offsets.npy"))
+        chunks = ChunkStore(_version_path(class_code, topic_slug, v, "chunks.txt"), offsets)
+        if meta.get("count", len(chunks)) and meta.get("dim", 0):
+            emb = np.load(_version_path(class_code, topic_slug, v, "emb.npy"), mmap_mode="r")
+            if meta.get("dtype") == "int8":
+                emb = Int8Matrix(emb, np.load(_version_path(class_code, topic_slug, v, "scale.npy")))
+        else:
+            emb = np.zeros((len(chunks), 0), dtype=np.float32)
     except Exception:
+        return None
+    out = {"chunks": chunks, "embeddings": emb, "ann": None, "bm25": None, "exact": None, "chunk_meta": None}
+    if meta.get("exact"):
+        try:
+            out["exact"] = np.load(_version_path(class_code, topic_slug, v, "exact.npy"), mmap_mode="r")
+        except Exception:
+            pass
+    if meta.get("chunk_meta"):
+        try:
+            out["chunk_meta"] = ChunkMeta.load(_version_path(class_code, topic_slug, v, "chunkmeta.npz"))
+        except Exception:
+            pass
+    # thiếu/hỏng chỉ mục phụ thì vẫn dùng được: quay về tìm chính xác / chỉ dùng vector
+    if meta.get("ann"):
+        try:
+            out["ann"] = IVFIndex.load(_version_path(class_code, topic_slug, v, "ivf.npz"))
+        except Exception:
+            pass
+    if meta.get("bm25"):
+        try:
+            out["bm25"] = BM25Index.load(_version_path(class_code, topic_slug, v, "bm25.npz"))
+        except Exception:
+            pass
+    return out
+
+def load_topic(class_code: str, topic_slug: str) -> LoadedTopic | None:
+    """
+    Tải chủ đề qua cache dùng chung cho mọi phiên Streamlit trong process.
+    Cache tự hết hạn khi meta.json trên đĩa đổi (mtime/size), và bỏ bớt chủ đề
+    ít dùng nhất khi vượt KB_CACHE_MAX_BYTES / KB_CACHE_MAX_TOPICS.
+    Chủ đề còn ở định dạng cũ thì được chuyển đổi ở lần đọc đầu. Không có thì trả None.
+    """
+    global _KB_CACHE_BYTES
+    key = _cache_key(class_code, topic_slug)
+    meta_fp = _meta_path(class_code, topic_slug)
+    sig = _file_signature(meta_fp)
+    if sig is None:
+        if not migrate_legacy(class_code, topic_slug):
+            invalidate_topic(class_code, topic_slug)
+            return None
+        sig = _file_signature(meta_fp)
+
+    with _KB_CACHE_LOCK:
+        entry = _KB_CACHE.get(key)
+        if entry is not None and entry.signature == sig:
+            _KB_CACHE.move_to_end(key)
+            _KB_STATS["hits"] += 1
+            metrics.incr("kb.cache_hits")
+            return entry
+    load_lock = _topic_lock(class_code, topic_slug).lock
+
+    # chỉ 1 luồng đọc đĩa cho mỗi chủ đề; các luồng khác chờ rồi dùng lại kết quả
+    with load_lock:
+        with _KB_CACHE_LOCK:
+            entry = _KB_CACHE.get(key)
+            if entry is not None and entry.signature == sig:
+                _KB_CACHE.move_to_end(key)
+                _KB_STATS["hits"] += 1
+                return entry
+            _KB_STATS["misses"] += 1
+        with metrics.timer("kb.load", topic=topic_slug) as t:
+            meta = read_meta(class_code, topic_slug)
+            opened = _open_version(class_code, topic_slug, meta) if meta else None
+            if opened is None:
+                return None
+            emb, ann, bm25 = opened["embeddings"], opened["ann"], opened["bm25"]
+            nbytes = opened["chunks"].offsets.nbytes
+            if isinstance(emb, Int8Matrix):
+                nbytes += emb.scales.nbytes
+            elif not isinstance(emb, np.memmap):
+                nbytes += emb.nbytes
+            if ann is not None:
+                nbytes += ann.centroids.nbytes + ann.list_ids.nbytes
+            if bm25 is not None:
+                nbytes += bm25.nbytes
+            if opened["chunk_meta"] is not None:
+                nbytes += opened["chunk_meta"].nbytes
+            t.set(chunks=int(emb.shape[0]), bytes=nbytes)
+        entry = LoadedTopic(signature=sig, version=int(meta["version"]), nbytes=nbytes, **opened)
+        with _KB_CACHE_LOCK:
+            old = _KB_CACHE.pop(key, None)
+            if old is not None:
+                _evict(old)
+            _KB_CACHE[key] = entry
+            _KB_CACHE_BYTES += nbytes
+            while len(_KB_CACHE) > 1 and (_KB_CACHE_BYTES > KB_CACHE_MAX_BYTES
+                                          or len(_KB_CACHE) > KB_CACHE_MAX_TOPICS):
+                _, ev = _KB_CACHE.popitem(last=False)
+                _evict(ev)
+                _KB_STATS["evictions"] += 1
+        return entry
+
+def chunk_source(class_code: str, topic_slug: str, index: int) -> dict | None:
+    """Trang / đường dẫn tiêu đề / tệp nguồn của một đoạn (None nếu chủ đề không lưu metadata)."""
+    topic = load_topic(class_code, topic_slug)
+    if topic is None or topic.chunk_meta is None or not 0 <= index < len(topic.chunk_meta):
+        return None
+    return topic.chunk_meta.get(index)
+
+def load_knowledge(class_code: str, topic_slug: str) -> Tuple[List[str] | None, np.ndarray | None]:
+    """
+    Tải lại (chunks, embeddings) cho lớp + chủ đề. Không có thì trả (None, None).
+    Đi qua cache (load_topic): embeddings là ma trận mmap chỉ đọc, đã chuẩn hóa độ dài 1.
+    """
+    topic = load_topic(class_code, topic_slug)
+    if topic is None:
         return None, None
+    return list(topic.chunks), topic.embeddings
+
+# ========= CHỈ MỤC ANN (IVF) =========
+ANN_MIN_CHUNKS = 5000     # từ ngưỡng này trở lên mới dựng/dùng chỉ mục xấp xỉ
+ANN_NPROBE = 16           # số cụm được dò cho mỗi câu hỏi
+
+class IVFIndex:
+    """
+    Inverted-file index: k-means (cầu, trên vector đã chuẩn hóa) chia các đoạn thành
+    `nlist` cụm; khi tìm chỉ tính điểm chính xác cho các đoạn thuộc `nprobe` cụm gần
+    câu hỏi nhất. Thuần NumPy, lưu cạnh file chủ đề dưới dạng .ivf.npz.
+    """
+
+    def __init__(self, centroids: np.ndarray, list_offsets: np.ndarray, list_ids: np.ndarray):
+        self.centroids = centroids        # (nlist, D) float32, đã chuẩn hóa
+        self.list_offsets = list_offsets  # (nlist + 1,) vị trí bắt đầu mỗi cụm trong list_ids
+        self.list_ids = list_ids          # (N,) chỉ số đoạn, sắp theo cụm
+
+    @property
+    def nlist(self) -> int:
+        return self.centroids.shape[0]
+
+    @staticmethod
+    def _assign(emb: np.ndarray, centroids: np.ndarray, block: int = 8192) -> np.ndarray:
+        out = np.empty(emb.shape[0], dtype=np.int32)
+        for i in range(0, emb.shape[0], block):
+            part = np.asarray(emb[i:i + block], dtype=np.float32)
+            out[i:i + block] = np.argmax(part @ centroids.T, axis=1)
+        return out
+
+    @classmethod
+    def build(cls, emb: np.ndarray, nlist: int | None = None, iters: int = 12, seed: int = 0) -> "IVFIndex":
+        n = emb.shape[0]
+        nlist = nlist or max(8, int(np.sqrt(n)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+        # huấn luyện trên mẫu con cho nhanh, sau đó gán toàn bộ
+        sample_idx = rng.choice(n, size=min(n, nlist * 64), replace=False)
+        sample = np.asarray(emb[np.sort(sample_idx)], dtype=np.float32)
+        centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(iters):
+            assign = cls._assign(sample, centroids)
+            order = np.argsort(assign, kind="stable")
+            counts = np.bincount(assign, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            nonempty = counts > 0
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[nonempty]
+            sums[nonempty] = np.add.reduceat(sample[order], starts, axis=0)
+            empty = ~nonempty
+            # cụm rỗng: khởi tạo lại bằng một điểm ngẫu nhiên
+            sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()))]
+            centroids = normalize_rows(sums)
+        assign = cls._assign(emb, centroids)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        counts = np.bincount(assign, minlength=nlist)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(centroids.astype(np.float32), offsets, order)
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_ids=self.list_ids)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as z:
+            return cls(z["centroids"], z["list_offsets"], z["list_ids"])
+
+    def search(self, emb: np.ndarray, q: np.ndarray, top_k: int, nprobe: int = ANN_NPROBE
+               ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        q: (Q, D) đã chuẩn hóa. Trả (idx, scores) dạng (Q, min(top_k, N)), top-k riêng của
+        từng câu hỏi; câu hỏi có ít ứng viên hơn được đệm cuối dòng bằng chỉ số -1, điểm -inf.
+        """
+        nprobe = min(nprobe, self.nlist)
+        probes = top_k_indices(q @ self.centroids.T, nprobe)
+        all_idx, all_scores = [], []
+        for qi in range(q.shape[0]):
+            cand = np.concatenate([self.list_ids[self.list_offsets[c]:self.list_offsets[c + 1]]
+                                   for c in probes[qi]])
+            cand.sort()   # đọc mmap theo thứ tự tăng dần
+            scores = np.asarray(emb[cand], dtype=np.float32) @ q[qi]
+            top = top_k_indices(scores, top_k)
+            all_idx.append(cand[top])
+            all_scores.append(scores[top])
+        return _pad_rows(all_idx, all_scores, min(top_k, self.list_ids.shape[0]))
+
+# ========= TÌM KIẾM =========
+@dataclass
+class SearchHit:
+    topic: str      # slug chủ đề chứa đoạn
+    index: int      # vị trí đoạn trong chủ đề
+    score: float    # cosine similarity
+    text: str
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Chỉ số k điểm cao nhất (giảm dần) theo dòng cuối cùng của `scores` (1-D hoặc 2-D).
+    Dùng argpartition O(N) rồi chỉ sắp xếp k phần tử thay vì argsort toàn bộ.
+    """
+    n = scores.shape[-1]
+    k = min(k, n)
+    if k <= 0:
+        return np.zeros(scores.shape[:-1] + (0,), dtype=np.int64)
+    if k < n:
+        part = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        part = np.broadcast_to(np.arange(n), scores.shape).copy()
+    order = np.argsort(-np.take_along_axis(scores, part, axis=-1), axis=-1, kind="stable")
+    return np.take_along_axis(part, order, axis=-1)
+
+SCORE_BLOCK_ROWS = 32768    # số dòng giải nén mỗi lần khi chấm điểm trên ma trận float16/int8
+RERANK_FACTOR = 4           # lấy top_k × hệ số ứng viên từ ma trận nén rồi chấm lại bằng float32
+
+def matrix_scores(emb, q: np.ndarray) -> np.ndarray:
+    """
+    (Q, N) = q @ emb.T. Ma trận float16/int8 được chấm theo từng khối SCORE_BLOCK_ROWS
+    dòng, nên không bao giờ tạo bản float32 của cả ma trận.
+    """
+    codes, scales = (emb.codes, emb.scales) if isinstance(emb, Int8Matrix) else (emb, None)
+    if codes.dtype == np.float32:
+        return q @ codes.T
+    n = codes.shape[0]
+    out = np.empty((q.shape[0], n), dtype=np.float32)
+    for s in range(0, n, SCORE_BLOCK_ROWS):
+        e = min(n, s + SCORE_BLOCK_ROWS)
+        out[:, s:e] = q @ np.asarray(codes[s:e], dtype=np.float32).T
+        if scales is not None:
+            out[:, s:e] *= scales[s:e]
+    return out
+
+def _pad_rows(idx_rows: list, score_rows: list, width: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Ghép các dòng kết quả dài ngắn khác nhau thành (Q, width); chỗ thiếu: chỉ số -1, điểm -inf."""
+    idx = np.full((len(idx_rows), width), -1, dtype=np.int64)
+    scores = np.full((len(idx_rows), width), -np.inf, dtype=np.float32)
+    for r, (i, s) in enumerate(zip(idx_rows, score_rows)):
+        idx[r, :len(i)] = i[:width]
+        scores[r, :len(s)] = s[:width]
+    return idx, scores
+
+def _rerank(exact: np.ndarray, q: np.ndarray, cand: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Chấm lại ứng viên cand (Q, c) bằng ma trận float32 (bỏ ô đệm -1); trả (idx, scores) (Q, k)."""
+    idx, top = [], []
+    for qi in range(q.shape[0]):
+        c = np.sort(cand[qi][cand[qi] >= 0])     # đọc mmap theo thứ tự tăng dần
+        sc = np.asarray(exact[c], dtype=np.float32) @ q[qi]
+        best = top_k_indices(sc, top_k)
+        idx.append(c[best])
+        top.append(sc[best])
+    return _pad_rows(idx, top, min(top_k, cand.shape[1]))
+
+def search_batch(
+    class_code: str,
+    topic_slugs: List[str],
+    query_vecs: np.ndarray,
+    top_k: int = 3,
+    min_score: float | None = None,
+    exact: bool = False,
+    rerank: bool = True,
+) -> List[List[SearchHit]]:
+    """
+    Tìm các đoạn liên quan nhất cho nhiều câu hỏi cùng lúc, trên một hoặc nhiều
+    chủ đề của lớp. query_vecs có dạng (Q, D); mỗi chủ đề chỉ cần một phép nhân ma
+    trận (N, D) × (D, Q). Chủ đề lớn (>= ANN_MIN_CHUNKS) có chỉ mục IVF thì dùng tìm
+    xấp xỉ, trừ khi exact=True. Chủ đề lưu nén (float16/int8) có kèm bản float32 thì
+    các ứng viên được chấm lại chính xác (rerank=False để bỏ qua).
+    Trả về Q danh sách SearchHit (điểm giảm dần), đã lọc theo `min_score` nếu có.
+    """
+    q = normalize_rows(query_vecs)
+    per_query: List[List[SearchHit]] = [[] for _ in range(q.shape[0])]
+    topics = [load_topic(class_code, slug) for slug in topic_slugs]
+    with metrics.timer("kb.search", topics=len(topic_slugs), queries=int(q.shape[0])) as t:
+        n_chunks = n_ann = 0
+        for slug, topic in zip(topic_slugs, topics):
+            if topic is None or topic.embeddings.shape[0] == 0 or topic.embeddings.shape[1] != q.shape[1]:
+                continue
+            n_chunks += topic.embeddings.shape[0]
+            refine = rerank and topic.exact is not None
+            k = top_k * RERANK_FACTOR if refine else top_k
+            if topic.ann is not None and not exact and topic.embeddings.shape[0] >= ANN_MIN_CHUNKS:
+                idx, top = topic.ann.search(topic.embeddings, q, k)
+                n_ann += 1
+            else:
+                scores = matrix_scores(topic.embeddings, q)        # (Q, N)
+                idx = top_k_indices(scores, k)                     # (Q, k)
+                top = np.take_along_axis(scores, idx, axis=1)
+            if refine and idx.size:
+                idx, top = _rerank(topic.exact, q, idx, top_k)
+            for qi in range(q.shape[0]):
+                for i, s in zip(idx[qi].tolist(), top[qi].tolist()):
+                    if i < 0 or min_score is not None and s < min_score:
+                        break       # hết ứng viên của câu hỏi này (ô đệm) hoặc dưới ngưỡng
+                    per_query[qi].append(SearchHit(topic=slug, index=i, score=s, text=topic.chunks[i]))
+        t.set(chunks=n_chunks, ann_topics=n_ann)
+    # gộp kết quả của các chủ đề, giữ top_k tốt nhất cho mỗi câu hỏi
+    return [sorted(hits, key=lambda h: -h.score)[:top_k] for hits in per_query]
+
+def search(
+    class_code: str,
+    topic_slugs: List[str] | str,
+    query_vec: np.ndarray,
+    top_k: int = 3,
+    min_score: float | None = None,
+    exact: bool = False,
+) -> List[SearchHit]:
+    """Tìm cho 1 câu hỏi (vector 1-D). topic_slugs có thể là 1 slug hoặc danh sách."""
+    if isinstance(topic_slugs, str):
+        topic_slugs = [topic_slugs]
+    return search_batch(class_code, topic_slugs, np.asarray(query_vec).reshape(1, -1),
+                        top_k, min_score, exact)[0]
+
+# ========= CHỈ MỤC TỪ KHÓA (BM25) =========
+BM25_K1 = 1.2
+BM25_B = 0.75
+HYBRID_ALPHA = 0.6                 # trọng số cosine khi trộn với BM25 (1 - alpha cho BM25)
+LEXICAL_DECISIVE_RATIO = 1.5       # BM25 top1 >= ratio × top2 ...
+LEXICAL_DECISIVE_COVERAGE = 0.8    # ... và đoạn top1 chứa >= 80% (theo IDF) các từ của câu hỏi
+
+_TOKEN_RE = re.compile(r"\d+(?:[.,]\d+)*|\w+")
+MAX_TOKEN_CHARS = 40               # "từ" dài hơn thường là chữ PDF bị dính liền → bỏ qua
+
+def fold_diacritics(text: str) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt (đ → d) để 'Định luật Ôm' khớp 'dinh luat om'."""
+    import unicodedata
+    text = unicodedata.normalize("NFD", text.lower().replace("đ", "d").replace("Đ", "d"))
+    return "".join(ch for ch in text if unicodedata.category(ch) != "Mn")
+
+def tokenize_vi(text: str) -> List[str]:
+    """
+    Tách từ cho chỉ mục: âm tiết đã bỏ dấu + cặp âm tiết liền kề (từ ghép tiếng Việt
+    như 'dinh_luat'), giữ nguyên số mục/công thức dạng '2.3'.
+    """
+    sylls = [t for t in _TOKEN_RE.findall(fold_diacritics(text)) if len(t) <= MAX_TOKEN_CHARS]
+    return sylls + [f"{a}_{b}" for a, b in zip(sylls, sylls[1:])]
+
+class _Vocab:
+    """Từ điển đã sắp xếp lưu thành một chuỗi UTF-8 nối liền + offsets (tra bằng bisect)."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self._bytes = blob.tobytes()
+
+    @classmethod
+    def from_terms(cls, terms: List[str]) -> "_Vocab":
+        encoded = [t.encode("utf-8") for t in terms]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return self._bytes[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def find(self, term: str) -> int:
+        """Vị trí của term trong từ điển, -1 nếu không có."""
+        import bisect
+        i = bisect.bisect_left(self, term)
+        return i if i < len(self) and self[i] == term else -1
+
+    @property
+    def nbytes(self) -> int:
+        return self.blob.nbytes + self.offsets.nbytes
+
+class BM25Index:
+    """
+    Chỉ mục ngược BM25 lưu gọn bằng mảng: từ điển đã sắp xếp (chuỗi nối liền + offsets),
+    posting lists nối liền (indptr / doc_ids / tfs) và độ dài từng đoạn.
+    """
+
+    def __init__(self, vocab: _Vocab, indptr: np.ndarray, doc_ids: np.ndarray,
+                 tfs: np.ndarray, doc_len: np.ndarray):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_len = doc_len
+        n = len(doc_len)
+        self.avgdl = float(doc_len.mean()) if n else 0.0
+        df = np.diff(indptr).astype(np.float32)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        return self.vocab.nbytes + sum(a.nbytes for a in (self.indptr, self.doc_ids, self.tfs, self.doc_len, self.idf))
+
+    @classmethod
+    def build(cls, chunks) -> "BM25Index":
+        """
+        Đánh số từ ngay khi quét (dict từ → id) và giữ posting dạng mảng số nguyên; chỉ
+        bản thân từ điển là chuỗi, nên bộ nhớ không phụ thuộc độ dài từ dài nhất.
+        """
+        from array import array
+        from collections import Counter
+        ids: dict = {}
+        terms, docs, tfs, doc_len = array("i"), array("i"), array("H"), array("i")
+        for d, c in enumerate(chunks):
+            toks = tokenize_vi(c)
+            doc_len.append(len(toks))
+            for t, tf in Counter(toks).items():
+                terms.append(ids.setdefault(t, len(ids)))
+                docs.append(d)
+                tfs.append(min(tf, 65535))
+        words = list(ids)
+        del ids
+        order_words = sorted(range(len(words)), key=words.__getitem__)
+        remap = np.empty(len(words), dtype=np.int32)
+        remap[np.array(order_words, dtype=np.int64)] = np.arange(len(words), dtype=np.int32)
+        term_ids = remap[np.frombuffer(terms, dtype=np.int32)] if len(terms) else np.zeros(0, dtype=np.int32)
+        doc_arr = np.frombuffer(docs, dtype=np.int32) if len(docs) else np.zeros(0, dtype=np.int32)
+        order = np.lexsort((doc_arr, term_ids))
+        indptr = np.zeros(len(words) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(term_ids, minlength=len(words)), out=indptr[1:])
+        return cls(_Vocab.from_terms([words[i] for i in order_words]), indptr, doc_arr[order],
+                   np.frombuffer(tfs, dtype=np.uint16)[order] if len(tfs) else np.zeros(0, dtype=np.uint16),
+                   np.array(doc_len, dtype=np.int32))
+
+    def save(self, path: str) -> None:
+        with open(path, "wb") as f:
+            np.savez(f, vocab_blob=self.vocab.blob, vocab_offsets=self.vocab.offsets, indptr=self.indptr,
+                     doc_ids=self.doc_ids, tfs=self.tfs, doc_len=self.doc_len)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as z:
+            if "vocab_blob" in z.files:
+                vocab = _Vocab(z["vocab_blob"], z["vocab_offsets"])
+            else:       # định dạng cũ: mảng chuỗi độ rộng cố định
+                vocab = _Vocab.from_terms(z["vocab"].tolist())
+            return cls(vocab, z["indptr"], z["doc_ids"], z["tfs"], z["doc_len"])
+
+    def _term_ids(self, tokens: List[str]) -> List[int]:
+        if not len(self.vocab) or not tokens:
+            return []
+        return [i for i in (self.vocab.find(t) for t in sorted(set(tokens))) if i >= 0]
+
+    def scores(self, query: str) -> Tuple[np.ndarray, float]:
+        """
+        Điểm BM25 của mọi đoạn cho câu hỏi, kèm độ phủ: tỉ lệ (theo IDF) các âm tiết
+        của câu hỏi có mặt trong đoạn điểm cao nhất.
+        """
+        out = np.zeros(len(self.doc_len), dtype=np.float32)
+        tokens = tokenize_vi(query)
+        tids = self._term_ids(tokens)
+        if not tids or not len(out):
+            return out, 0.0
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len / max(self.avgdl, 1e-9))
+        for t in tids:
+            lo, hi = self.indptr[t], self.indptr[t + 1]
+            ids = self.doc_ids[lo:hi]
+            tf = self.tfs[lo:hi].astype(np.float32)
+            out[ids] += self.idf[t] * tf * (BM25_K1 + 1) / (tf + norm[ids])
+        best = int(np.argmax(out))
+        # độ phủ chỉ tính trên âm tiết (không tính cặp), từ không có trong tài liệu có IDF tối đa
+        sylls = sorted({t for t in tokens if "_" not in t})
+        max_idf = float(np.log1p((len(out) + 0.5) / 0.5))
+        total = matched = 0.0
+        for t in sylls:
+            ids = self._term_ids([t])
+            if not ids:
+                total += max_idf
+                continue
+            w = float(self.idf[ids[0]])
+            total += w
+            lo, hi = self.indptr[ids[0]], self.indptr[ids[0] + 1]
+            if np.any(self.doc_ids[lo:hi] == best):
+                matched += w
+        return out, (matched / total if total else 0.0)
+
+def hybrid_search(
+    class_code: str,
+    topic_slugs: List[str] | str,
+    question: str,
+    embed_query,
+    top_k: int = 3,
+    alpha: float = HYBRID_ALPHA,
+    min_score: float | None = None,
+) -> Tuple[List[SearchHit], np.ndarray | None]:
+    """
+    Tìm kết hợp từ khóa (BM25) + vector. Nếu BM25 đã quyết định rõ (đoạn đứng đầu
+    vượt hẳn và chứa gần hết từ của câu hỏi) thì trả luôn kết quả từ khóa (điểm BM25
+    chuẩn hóa theo max, cũng lọc theo `min_score`), KHÔNG gọi embed_query. Ngược lại embed_query(question) → vector, lấy ứng viên từ cả hai
+    phía rồi trộn điểm: alpha × cosine + (1 - alpha) × BM25 (chuẩn hóa theo max).
+    Trả về (hits, vector câu hỏi hoặc None nếu không cần nhúng).
+    """
+    if isinstance(topic_slugs, str):
+        topic_slugs = [topic_slugs]
+    n_cand = max(top_k * 4, 10)
+    lexical = {}          # slug -> điểm BM25 (N,)
+    best = []             # (điểm, độ phủ) đứng đầu mỗi chủ đề
+    topics = [load_topic(class_code, slug) for slug in topic_slugs]
+    with metrics.timer("kb.bm25", topics=len(topic_slugs)):
+        for slug, topic in zip(topic_slugs, topics):
+            if topic is None or topic.bm25 is None:
+                continue
+            sc, coverage = topic.bm25.scores(question)
+            lexical[slug] = sc
+            if len(sc):
+                best.append((float(sc.max()), coverage))
+
+    all_lex = np.concatenate(list(lexical.values())) if lexical else np.zeros(0, dtype=np.float32)
+    lex_max = float(all_lex.max()) if all_lex.size else 0.0
+    if lex_max > 0 and all_lex.size:
+        top2 = np.partition(all_lex, -2)[-2] if all_lex.size > 1 else 0.0
+        coverage = max(best)[1]
+        if lex_max >= LEXICAL_DECISIVE_RATIO * max(float(top2), 1e-9) and coverage >= LEXICAL_DECISIVE_COVERAGE:
+            metrics.incr("kb.lexical_decisive")
+            hits = []
+            for slug, sc in lexical.items():
+                topic = load_topic(class_code, slug)
+                for i in top_k_indices(sc, top_k).tolist():
+                    score = float(sc[i]) / lex_max
+                    if sc[i] > 0 and (min_score is None or score >= min_score):
+                        hits.append(SearchHit(topic=slug, index=i, score=score, text=topic.chunks[i]))
+            return sorted(hits, key=lambda h: -h.score)[:top_k], None
+
+    q = normalize_rows(embed_query(question))[0]
+    vec_hits = search(class_code, topic_slugs, q, top_k=n_cand)
+    cand = {(h.topic, h.index): h.score for h in vec_hits}
+    for slug, sc in lexical.items():
+        for i in top_k_indices(sc, n_cand).tolist():
+            if sc[i] > 0:
+                cand.setdefault((slug, i), None)
+    hits = []
+    for (slug, i), cos in cand.items():
+        topic = load_topic(class_code, slug)
+        if topic is None:
+            continue
+        if cos is None:
+            rows = topic.exact if topic.exact is not None else topic.embeddings
+            cos = float(np.asarray(rows[i], dtype=np.float32) @ q) if rows.shape[1] == q.shape[0] else 0.0
+        lex = float(lexical[slug][i]) / lex_max if slug in lexical and lex_max > 0 else 0.0
+        score = alpha * cos + (1 - alpha) * lex
+        if min_score is None or score >= min_score:
+            hits.append(SearchHit(topic=slug, index=i, score=score, text=topic.chunks[i]))
+    return sorted(hits, key=lambda h: -h.score)[:top_k], q
+
+# ========= GHÉP NGỮ CẢNH THEO NGÂN SÁCH TOKEN =========
+CONTEXT_TOKEN_BUDGET = 1500        # số token tối đa dành cho phần trích đoạn trong prompt
+CONTEXT_CANDIDATES = 8             # số đoạn lấy từ tìm kiếm để chọn ra khi ghép ngữ cảnh
+CONTEXT_DUP_JACCARD = 0.8          # hai đoạn có >= 80% âm tiết chung coi như trùng
+
+@dataclass
+class PackedContext:
+    chunks: List[str]               # các đoạn theo thứ tự đưa vào prompt
+    hits: List[SearchHit]           # các đoạn tìm được đã đưa vào (theo điểm giảm dần)
+    neighbours: List[SearchHit]     # các đoạn liền kề được thêm cho đủ ý
+    tokens: int                     # tổng token ước lượng của các đoạn
+    budget: int
+    duplicates: int = 0             # số đoạn bị bỏ vì trùng gần như hoàn toàn
+    dropped: int = 0                # số đoạn bị bỏ vì vượt ngân sách
+
+def _syllables(text: str) -> frozenset:
+    return frozenset(_TOKEN_RE.findall(fold_diacritics(text)))
+
+def _near_duplicate(a: frozenset, b: frozenset) -> bool:
+    if not a or not b:
+        return a == b
+    inter = len(a & b)
+    # trùng theo Jaccard, hoặc đoạn ngắn nằm gần trọn trong đoạn dài (đoạn chồng lấn)
+    return inter / len(a | b) >= CONTEXT_DUP_JACCARD or inter / min(len(a), len(b)) >= 0.95
+
+def pack_context(
+    class_code: str,
+    hits: List[SearchHit],
+    budget: int = CONTEXT_TOKEN_BUDGET,
+    neighbours: bool = True,
+    count_tokens=approx_tokens,
+) -> PackedContext:
+    """
+    Chọn các đoạn đưa vào prompt trong giới hạn `budget` token:
+    - xét theo điểm giảm dần, bỏ đoạn trùng/chồng lấn với đoạn đã chọn;
+    - đoạn không vừa ngân sách thì bỏ qua (đoạn ngắn hơn phía sau vẫn có thể vừa);
+    - còn dư thì thêm đoạn liền trước/liền sau của các đoạn đã chọn (đủ ngữ cảnh hơn).
+    Mỗi đoạn tìm được đứng cùng các đoạn liền kề của nó theo thứ tự trong tài liệu.
+    """
+    t0 = time.perf_counter()
+    chosen: List[SearchHit] = []
+    sets: List[frozenset] = []
+    seen = set()
+    used = 0
+    dup = drop = 0
+    for h in sorted(hits, key=lambda h: -h.score):
+        if (h.topic, h.index) in seen:
+            dup += 1
+            continue
+        syl = _syllables(h.text)
+        if any(_near_duplicate(syl, s) for s in sets):
+            dup += 1
+            continue
+        cost = count_tokens(h.text)
+        if used + cost > budget and chosen:     # luôn giữ ít nhất đoạn tốt nhất
+            drop += 1
+            continue
+        chosen.append(h)
+        sets.append(syl)
+        seen.add((h.topic, h.index))
+        used += cost
+
+    blocks = {(h.topic, h.index): [h] for h in chosen}
+    extra: List[SearchHit] = []
+    if neighbours:
+        for h in chosen:
+            topic = load_topic(class_code, h.topic)
+            if topic is None:
+                continue
+            for j in (h.index + 1, h.index - 1):     # đoạn sau thường giải thích tiếp đoạn trước
+                if not 0 <= j < len(topic.chunks) or (h.topic, j) in seen:
+                    continue
+                text = topic.chunks[j]
+                cost = count_tokens(text)
+                if used + cost > budget:
+                    continue
+                syl = _syllables(text)
+                if any(_near_duplicate(syl, s) for s in sets):
+                    continue
+                nb = SearchHit(topic=h.topic, index=j, score=h.score, text=text)
+                blocks[(h.topic, h.index)].append(nb)
+                extra.append(nb)
+                sets.append(syl)
+                seen.add((h.topic, j))
+                used += cost
+
+    ordered: List[str] = []
+    for h in chosen:
+        ordered.extend(b.text for b in sorted(blocks[(h.topic, h.index)], key=lambda b: b.index))
+    metrics.observe("kb.pack", time.perf_counter() - t0, tokens=used, chunks=len(ordered),
+                    duplicates=dup, dropped=drop)
+    return PackedContext(chunks=ordered, hits=chosen, neighbours=extra, tokens=used,
+                         budget=budget, duplicates=dup, dropped=drop)
+
+# ========= CACHE CÂU TRẢ LỜI THEO NGỮ NGHĨA =========
+ANSWER_CACHE_MAX_DISTANCE = 0.05     # cosine distance tối đa (similarity >= 0.95) để coi là cùng câu hỏi
+ANSWER_CACHE_TTL = 6 * 3600          # giây
+ANSWER_CACHE_MAX_ENTRIES = 5000      # tổng số câu trả lời giữ trong process
+ANSWER_CACHE_EVICT_TO = 0.9          # vượt giới hạn thì bỏ một lượt các mục cũ nhất, còn 90%
+
+class _AnswerScope:
+    """Các câu trả lời của một (lớp, tập chủ đề) ở một phiên bản tri thức."""
+
+    def __init__(self, versions: tuple):
+        self.versions = versions
+        self.vecs = np.zeros((0, 0), dtype=np.float32)
+        self.items: List[dict] = []
+        self.exact: dict = {}       # (câu hỏi đã chuẩn hóa, đoạn đứng đầu) → mục, cho câu hỏi không nhúng
+
+    @property
+    def size(self) -> int:
+        return len(self.items) + len(self.exact)
+
+    def all_items(self):
+        return self.items + list(self.exact.values())
+
+    def drop(self, keep: List[int]) -> None:
+        self.vecs = self.vecs[keep] if len(keep) else np.zeros((0, self.vecs.shape[1]), dtype=np.float32)
+        self.items = [self.items[i] for i in keep]
+
+    def remove(self, ids: set) -> None:
+        """Bỏ các mục có id trong `ids` (mỗi lần gọi chép ma trận vecs tối đa một lần)."""
+        keep = [i for i, it in enumerate(self.items) if it["id"] not in ids]
+        if len(keep) != len(self.items):
+            self.drop(keep)
+        for k in [k for k, it in self.exact.items() if it["id"] in ids]:
+            del self.exact[k]
+
+class AnswerCache:
+    """
+    Cache câu trả lời trong process, theo (lớp, chủ đề, phiên bản tri thức).
+    Câu hỏi mới được coi là trùng nếu embedding cách một câu đã trả lời không quá
+    `max_distance` (cosine) VÀ đoạn tài liệu liên quan nhất vừa tìm được nằm trong
+    các nguồn của câu trả lời cũ. Câu hỏi trả lời chỉ bằng từ khóa (không có vector)
+    được tra theo đúng văn bản câu hỏi đã chuẩn hóa + đoạn đứng đầu. Khi chủ đề được
+    nạp lại (phiên bản đổi) các câu trả lời cũ tự bị bỏ; mục quá `ttl` giây bị bỏ, và
+    khi vượt `max_entries` thì các mục lâu không dùng nhất bị loại theo lô (thứ tự dùng
+    giữ trong một OrderedDict, không phải quét toàn bộ cache).
+    """
+
+    def __init__(self, max_distance: float = ANSWER_CACHE_MAX_DISTANCE,
+                 ttl: float = ANSWER_CACHE_TTL, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._scopes: dict = {}
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[int, tuple]" = OrderedDict()   # id mục → khóa scope, cũ nhất trước
+        self._next_id = 0
+        self.stats_counter = {"hits": 0, "misses": 0, "stores": 0, "invalidations": 0, "evictions": 0}
+
+    @staticmethod
+    def _scope_key(class_code: str, topic_slugs: List[str]) -> tuple:
+        return slugify_name(class_code), tuple(sorted(slugify_name(t) for t in topic_slugs))
+
+    @staticmethod
+    def _exact_key(question: str, hits: List[SearchHit] | None) -> tuple:
+        top = (hits[0].topic, hits[0].index) if hits else None
+        return " ".join(question.lower().split()), top
+
+    @staticmethod
+    def _versions(class_code: str, topic_slugs: List[str]) -> tuple:
+        out = []
+        for t in sorted(topic_slugs, key=slugify_name):
+            topic = load_topic(class_code, t)
+            out.append(topic.version if topic is not None else None)
+        return tuple(out)
+
+    def _forget(self, items) -> None:
+        for it in items:
+            self._lru.pop(it["id"], None)
+
+    def _scope(self, key: tuple, versions: tuple, create: bool) -> _AnswerScope | None:
+        scope = self._scopes.get(key)
+        if scope is not None and scope.versions != versions:
+            # tri thức đã được nạp lại → câu trả lời cũ không còn đúng
+            self._forget(scope.all_items())
+            self.stats_counter["invalidations"] += scope.size
+            del self._scopes[key]
+            scope = None
+        if scope is None and create:
+            scope = self._scopes[key] = _AnswerScope(versions)
+        return scope
+
+    def _expire(self, scope: _AnswerScope, now: float) -> None:
+        old = {it["id"] for it in scope.all_items() if now - it["created"] > self.ttl}
+        if old:
+            for item_id in old:
+                self._lru.pop(item_id, None)
+            scope.remove(old)
+
+    def _touch(self, item: dict, now: float) -> None:
+        item["last_used"] = now
+        self._lru.move_to_end(item["id"])
+
+    def lookup(self, class_code: str, topic_slugs: List[str], query_vec: np.ndarray | None,
+               hits: List[SearchHit] | None = None, question: str | None = None) -> dict | None:
+        """
+        Trả mục đã lưu ({answer, question, score, ...}) nếu có câu hỏi đủ gần, không thì None.
+        query_vec=None (câu hỏi trả lời bằng từ khóa): tra đúng `question` + đoạn đứng đầu.
+        """
+        q = normalize_rows(query_vec)[0] if query_vec is not None else None
+        now = time.time()
+        key = self._scope_key(class_code, topic_slugs)
+        versions = self._versions(class_code, topic_slugs)
+        with self._lock:
+            scope = self._scope(key, versions, create=False)
+            if scope is not None:
+                self._expire(scope, now)
+            if q is None:
+                item = scope.exact.get(self._exact_key(question or "", hits)) if scope is not None else None
+                if item is None:
+                    self.stats_counter["misses"] += 1
+                    metrics.incr("answer_cache.misses")
+                    return None
+                self._touch(item, now)
+                self.stats_counter["hits"] += 1
+                metrics.incr("answer_cache.hits")
+                return dict(item, score=1.0)
+            if scope is None or not scope.items or scope.vecs.shape[1] != q.shape[0]:
+                self.stats_counter["misses"] += 1
+                metrics.incr("answer_cache.misses")
+                return None
+            sims = scope.vecs @ q
+            top_source = (hits[0].topic, hits[0].index) if hits else None
+            for i in np.argsort(-sims):
+                if 1.0 - float(sims[i]) > self.max_distance:
+                    break
+                item = scope.items[i]
+                if top_source is None or top_source in item["sources"]:
+                    self._touch(item, now)
+                    self.stats_counter["hits"] += 1
+                    metrics.incr("answer_cache.hits")
+                    return dict(item, score=float(sims[i]))
+            self.stats_counter["misses"] += 1
+            metrics.incr("answer_cache.misses")
+            return None
+
+    def store(self, class_code: str, topic_slugs: List[str], query_vec: np.ndarray | None,
+              question: str, answer: str, hits: List[SearchHit] | None = None) -> None:
+        """Lưu câu trả lời; query_vec=None → lưu theo văn bản câu hỏi + đoạn đứng đầu (xem lookup)."""
+        q = normalize_rows(query_vec) if query_vec is not None else None
+        now = time.time()
+        item = {
+            "question": question,
+            "answer": answer,
+            "sources": {(h.topic, h.index) for h in (hits or [])},
+            "created": now,
+            "last_used": now,
+        }
+        key = self._scope_key(class_code, topic_slugs)
+        versions = self._versions(class_code, topic_slugs)
+        with self._lock:
+            scope = self._scope(key, versions, create=True)
+            item["id"] = self._next_id
+            self._next_id += 1
+            if q is None:
+                exact_key = self._exact_key(question, hits)
+                old = scope.exact.get(exact_key)
+                if old is not None:
+                    self._forget([old])
+                scope.exact[exact_key] = item
+            else:
+                if scope.vecs.size and scope.vecs.shape[1] != q.shape[1]:
+                    # đổi mô hình embedding → vector cũ không so được với vector mới
+                    self._forget(scope.items)
+                    scope.drop([])
+                    scope.vecs = np.zeros((0, q.shape[1]), dtype=np.float32)
+                scope.vecs = np.vstack([scope.vecs, q]) if scope.vecs.size else q
+                scope.items.append(item)
+            self._lru[item["id"]] = key
+            self.stats_counter["stores"] += 1
+            if len(self._lru) > self.max_entries:
+                self._evict_lru()
+
+    def _evict_lru(self) -> None:
+        """Bỏ một lượt các mục lâu không dùng nhất, mỗi scope bị đụng tới chỉ chép vecs một lần."""
+        n = len(self._lru) - int(self.max_entries * ANSWER_CACHE_EVICT_TO)
+        by_scope: dict = {}
+        for _ in range(max(n, 0)):
+            item_id, key = self._lru.popitem(last=False)
+            by_scope.setdefault(key, set()).add(item_id)
+        for key, ids in by_scope.items():
+            scope = self._scopes.get(key)
+            if scope is None:
+                continue
+            scope.remove(ids)
+            if not scope.size:
+                del self._scopes[key]
+        self.stats_counter["evictions"] += max(n, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.stats_counter["hits"] + self.stats_counter["misses"]
+            return dict(self.stats_counter, entries=len(self._lru),
+                        hit_rate=round(self.stats_counter["hits"] / total, 4) if total else 0.0)
+
+_ANSWER_CACHE = AnswerCache()
+
+def get_answer_cache() -> AnswerCache:
+    return _ANSWER_CACHE
+
+def answer_cache_stats() -> dict:
+    return _ANSWER_CACHE.stats()
@@ -0,0 +1,197 @@
+"""
+metrics.py — đo thời gian từng công đoạn (nạp tri thức, nhúng câu hỏi, tìm kiếm, sinh câu trả lời).
+- timer("kb.search", chunks=N): đo một công đoạn (dùng với `with`).
+- incr("embed.retries"): bộ đếm (số lần gọi API, thử lại, trúng cache...).
+- trace("ask", ...): gom các công đoạn của một câu hỏi thành một dòng JSON trong
+  data/metrics.jsonl (tự xoay vòng theo dung lượng).
+- summary(): p50/p95 theo công đoạn cho bảng chẩn đoán của giáo viên.
+Đặt METRICS=0 để tắt: timer/trace trả về một đối tượng rỗng dùng chung, không ghi gì.
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import threading
+import contextvars
+import logging
+import logging.handlers
+from collections import deque
+
+DATA_DIR = "data"   # cùng thư mục dữ liệu với kb.py
+METRICS_PATH = os.path.join(DATA_DIR, "metrics.jsonl")
+METRICS_MAX_BYTES = 5 * 1024 * 1024     # mỗi file log tối đa 5MB ...
+METRICS_BACKUPS = 3                     # ... giữ thêm 3 file cũ
+METRICS_WINDOW = 2000                   # số mẫu gần nhất mỗi công đoạn dùng để tính p50/p95
+
+ENABLED = os.getenv("METRICS", "1") != "0"
+
+_LOCK = threading.Lock()
+_SAMPLES: dict[str, deque] = {}        # công đoạn → thời gian (giây) các lần gần nhất
+_COUNTERS: dict[str, float] = {}
+_TRACE: contextvars.ContextVar = contextvars.ContextVar("metrics_trace", default=None)
+_LOGGER: logging.Logger | None = None
+
+def set_enabled(flag: bool) -> None:
+    global ENABLED
+    ENABLED = bool(flag)
+
+def _logger() -> logging.Logger:
+    global _LOGGER
+    if _LOGGER is None:
+        with _LOCK:
+            if _LOGGER is None:
+                os.makedirs(os.path.dirname(METRICS_PATH) or ".", exist_ok=True)
+                handler = logging.handlers.RotatingFileHandler(
+                    METRICS_PATH, maxBytes=METRICS_MAX_BYTES, backupCount=METRICS_BACKUPS, encoding="utf-8")
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                log = logging.getLogger("chatbot.metrics")
+                log.setLevel(logging.INFO)
+                log.propagate = False
+                log.addHandler(handler)
+                _LOGGER = log
+    return _LOGGER
+
+def _write(event: dict) -> None:
+    try:
+        _logger().info(json.dumps(event, ensure_ascii=False, default=str))
+    except Exception:
+        pass    # không ghi được log thì bỏ qua, không làm hỏng luồng hỏi đáp
+
+# ========= GHI NHẬN =========
+def observe(stage: str, seconds: float, **fields) -> None:
+    """Ghi một lần đo của công đoạn (giây); thêm vào trace đang mở nếu có."""
+    if not ENABLED:
+        return
+    with _LOCK:
+        q = _SAMPLES.get(stage)
+        if q is None:
+            q = _SAMPLES[stage] = deque(maxlen=METRICS_WINDOW)
+        q.append(seconds)
+        tr = _TRACE.get()
+        if tr is not None:
+            tr.stages.append(dict(fields, stage=stage, ms=round(seconds * 1000, 3)))
+
+def incr(name: str, n: float = 1) -> None:
+    if not ENABLED or not n:
+        return
+    with _LOCK:
+        _COUNTERS[name] = _COUNTERS.get(name, 0) + n
+        tr = _TRACE.get()
+        if tr is not None:
+            tr.counters[name] = tr.counters.get(name, 0) + n
+
+def error(stage: str, exc: BaseException, **fields) -> None:
+    """Ghi lỗi vào log (kể cả khi METRICS=0: lỗi hiếm nên không tốn gì đáng kể)."""
+    incr(f"{stage}.errors")
+    _write(dict(fields, ts=round(time.time(), 3), kind="error", stage=stage,
+                error=f"{type(exc).__name__}: {exc}"))
+
+class _Noop:
+    """Dùng chung khi tắt đo: with/set không làm gì."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **fields) -> None:
+        pass
+
+_NOOP = _Noop()
+
+class _Timer:
+    __slots__ = ("stage", "fields", "t0")
+
+    def __init__(self, stage: str, fields: dict):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+            incr(f"{self.stage}.errors")
+        observe(self.stage, time.perf_counter() - self.t0, **self.fields)
+        return False
+
+    def set(self, **fields) -> None:
+        """Bổ sung thông tin biết được trong lúc chạy (số đoạn, số byte...)."""
+        self.fields.update(fields)
+
+def timer(stage: str, **fields):
+    """with timer("kb.load", topic=slug) as t: ... ; t.set(bytes=n)"""
+    if not ENABLED:
+        return _NOOP
+    return _Timer(stage, fields)
+
+class _Trace:
+    __slots__ = ("kind", "fields", "stages", "counters", "t0", "token")
+
+    def __init__(self, kind: str, fields: dict):
+        self.kind = kind
+        self.fields = fields
+        self.stages: list[dict] = []
+        self.counters: dict[str, float] = {}
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        self.token = _TRACE.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _TRACE.reset(self.token)
+        seconds = time.perf_counter() - self.t0
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        observe(self.kind, seconds)
+        _write(dict(self.fields, ts=round(time.time(), 3), kind=self.kind, ms=round(seconds * 1000, 3),
+                    stages=self.stages, counters=self.counters))
+        return False
+
+    def set(self, **fields) -> None:
+        self.fields.update(fields)
+
+def trace(kind: str, **fields):
+    """Gom mọi timer/incr chạy trong khối (cùng luồng/context) thành một bản ghi log."""
+    if not ENABLED:
+        return _NOOP
+    return _Trace(kind, fields)
+
+def bind(fn):
+    """Bọc hàm để chạy trong context hiện tại (giữ trace khi gửi sang ThreadPoolExecutor)."""
+    if not ENABLED or _TRACE.get() is None:
+        return fn
+    ctx = contextvars.copy_context()
+    return lambda *a, **kw: ctx.run(fn, *a, **kw)
+
+# ========= TỔNG HỢP =========
+def _percentile(sorted_vals: list[float], p: float) -> float:
+    i = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[i]
+
+def summary() -> dict:
+    """{"stages": {công đoạn: {count, p50_ms, p95_ms, max_ms}}, "counters": {...}} trong process."""
+    with _LOCK:
+        samples = {k: sorted(v) for k, v in _SAMPLES.items() if v}
+        counters = dict(_COUNTERS)
+    stages = {
+        k: {
+            "count": len(v),
+            "p50_ms": round(_percentile(v, 50) * 1000, 2),
+            "p95_ms": round(_percentile(v, 95) * 1000, 2),
+            "max_ms": round(v[-1] * 1000, 2),
+        }
+        for k, v in sorted(samples.items())
+    }
+    return {"stages": stages, "counters": dict(sorted(counters.items()))}
+
+def reset() -> None:
+    with _LOCK:
+        _SAMPLES.clear()
+        _COUNTERS.clear()
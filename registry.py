@@ -0,0 +1,213 @@
+"""
+registry.py — sổ đăng ký lớp học (SQLite, chế độ WAL) thay cho các file <lớp>_info.json.
+- Lớp, học sinh, chủ đề và phiên bản tri thức của từng chủ đề nằm trong một CSDL có chỉ mục:
+  tra cứu O(1) theo mã lớp thay vì os.listdir + đọc lại JSON mỗi lần rerun.
+- Ghi trong giao dịch (BEGIN IMMEDIATE) nên nhiều giáo viên thêm học sinh cùng lúc không mất dữ liệu.
+- Đọc qua cache trong process, tự làm mới khi CSDL bị process khác ghi (PRAGMA data_version).
+- import_legacy_info() chuyển một lần các file <lớp>_info.json cũ vào CSDL.
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DATA_DIR = "data"   # cùng thư mục dữ liệu với kb.py
+DB_PATH = os.path.join(DATA_DIR, "registry.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS classes (
+    code     TEXT PRIMARY KEY,
+    created  REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS students (
+    class_code TEXT NOT NULL REFERENCES classes(code) ON DELETE CASCADE,
+    name       TEXT NOT NULL,
+    added      REAL NOT NULL,
+    PRIMARY KEY (class_code, name)
+);
+CREATE TABLE IF NOT EXISTS topics (
+    class_code TEXT NOT NULL REFERENCES classes(code) ON DELETE CASCADE,
+    file       TEXT NOT NULL,
+    name       TEXT NOT NULL,
+    version    INTEGER,
+    created    REAL NOT NULL,
+    updated    REAL NOT NULL,
+    PRIMARY KEY (class_code, file)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS topics_name ON topics(class_code, name);
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+_LOCK = threading.RLock()
+_CONN: sqlite3.Connection | None = None
+_GENERATION = 0                   # tăng sau mỗi lần process này ghi
+_CACHE: dict = {}                 # khóa → giá trị đọc được
+_CACHE_STAMP: tuple | None = None
+_LEGACY_CHECKED = False           # import_legacy_info đã chạy trong process này
+
+def _conn() -> sqlite3.Connection:
+    global _CONN
+    if _CONN is None:
+        os.makedirs(os.path.dirname(DB_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(DB_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(_SCHEMA)
+        _CONN = conn
+    return _CONN
+
+def _cached(key, loader):
+    """Đọc qua cache; bỏ cache khi CSDL đổi (ghi trong process hoặc từ process khác)."""
+    global _CACHE_STAMP
+    with _LOCK:
+        stamp = (_conn().execute("PRAGMA data_version").fetchone()[0], _GENERATION)
+        if stamp != _CACHE_STAMP:
+            _CACHE.clear()
+            _CACHE_STAMP = stamp
+        if key not in _CACHE:
+            _CACHE[key] = loader(_conn())
+        return _CACHE[key]
+
+class _Transaction:
+    """
+    with _Transaction() as c: ... — BEGIN IMMEDIATE / COMMIT, ROLLBACK khi lỗi.
+    Cache đọc chỉ bị bỏ khi giao dịch thật sự ghi dòng nào đó.
+    """
+
+    def __enter__(self) -> sqlite3.Connection:
+        _LOCK.acquire()
+        try:
+            c = _conn()
+            self.changes = c.total_changes
+            c.execute("BEGIN IMMEDIATE")
+        except Exception:
+            _LOCK.release()
+            raise
+        return c
+
+    def __exit__(self, exc_type, exc, tb):
+        global _GENERATION
+        try:
+            if exc_type is None:
+                _CONN.execute("COMMIT")
+                if _CONN.total_changes != self.changes:
+                    _GENERATION += 1
+            else:
+                _CONN.execute("ROLLBACK")
+        finally:
+            _LOCK.release()
+        return False
+
+# ========= ĐỌC =========
+def list_classes() -> list[str]:
+    return list(_cached(("classes",), lambda c: [r[0] for r in c.execute("SELECT code FROM classes ORDER BY code")]))
+
+def class_exists(class_code: str) -> bool:
+    return get_class(class_code) is not None
+
+def get_class(class_code: str) -> dict | None:
+    """Thông tin lớp cùng dạng với <lớp>_info.json cũ: {class_code, students, topics}."""
+    def load(c):
+        if c.execute("SELECT 1 FROM classes WHERE code=?", (class_code,)).fetchone() is None:
+            return None
+        students = [r[0] for r in c.execute(
+            "SELECT name FROM students WHERE class_code=? ORDER BY added, name", (class_code,))]
+        topics = [{"name": r[0], "file": r[1], "version": r[2]} for r in c.execute(
+            "SELECT name, file, version FROM topics WHERE class_code=? ORDER BY created, name", (class_code,))]
+        return {"class_code": class_code, "students": students, "topics": topics}
+    info = _cached(("class", class_code), load)
+    if info is None:
+        return None
+    # bản sao để người gọi sửa thoải mái mà không làm hỏng cache
+    return {"class_code": info["class_code"], "students": list(info["students"]),
+            "topics": [dict(t) for t in info["topics"]]}
+
+# ========= GHI =========
+def create_class(class_code: str) -> bool:
+    """Tạo lớp; False nếu đã tồn tại."""
+    with _Transaction() as c:
+        cur = c.execute("INSERT OR IGNORE INTO classes(code, created) VALUES (?, ?)", (class_code, time.time()))
+        return cur.rowcount > 0
+
+def add_student(class_code: str, name: str) -> bool:
+    """Thêm học sinh; False nếu đã có trong lớp (hoặc lớp không tồn tại)."""
+    with _Transaction() as c:
+        if c.execute("SELECT 1 FROM classes WHERE code=?", (class_code,)).fetchone() is None:
+            return False
+        cur = c.execute("INSERT OR IGNORE INTO students(class_code, name, added) VALUES (?, ?, ?)",
+                        (class_code, name, time.time()))
+        return cur.rowcount > 0
+
+def add_topic(class_code: str, name: str, file: str, version: int | None = None) -> bool:
+    """
+    Ghi chủ đề của lớp (hoặc cập nhật phiên bản tri thức nếu chủ đề đã có).
+    False nếu lớp không tồn tại hoặc tên chủ đề đã dùng cho file khác.
+    """
+    now = time.time()
+    with _Transaction() as c:
+        if c.execute("SELECT 1 FROM classes WHERE code=?", (class_code,)).fetchone() is None:
+            return False
+        row = c.execute("SELECT file FROM topics WHERE class_code=? AND name=?", (class_code, name)).fetchone()
+        if row is not None and row[0] != file:
+            return False
+        c.execute(
+            "INSERT INTO topics(class_code, file, name, version, created, updated) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(class_code, file) DO UPDATE SET version=excluded.version, updated=excluded.updated",
+            (class_code, file, name, version, now, now),
+        )
+        return True
+
+# ========= CHUYỂN DỮ LIỆU CŨ =========
+def import_legacy_info(data_dir: str = DATA_DIR, force: bool = False) -> int:
+    """
+    Nhập các file <lớp>_info.json vào CSDL (chỉ chạy một lần, trừ khi force=True).
+    Trả về số lớp đã nhập. File cũ được giữ nguyên để có thể quay lại.
+    Gọi ở mỗi lần rerun cũng rẻ: chỉ kiểm tra một lần mỗi process, bằng một lệnh đọc
+    (không mở giao dịch ghi) khi đã nhập rồi.
+    """
+    global _LEGACY_CHECKED
+    if not force:
+        if _LEGACY_CHECKED:
+            return 0
+        with _LOCK:
+            done = _conn().execute("SELECT 1 FROM meta WHERE key='legacy_imported'").fetchone()
+        if done:
+            _LEGACY_CHECKED = True
+            return 0
+    with _Transaction() as c:
+        if not force and c.execute("SELECT 1 FROM meta WHERE key='legacy_imported'").fetchone():
+            _LEGACY_CHECKED = True
+            return 0
+        n = 0
+        try:
+            names = sorted(os.listdir(data_dir))
+        except OSError:
+            names = []
+        now = time.time()
+        for fname in names:
+            if not fname.endswith("_info.json"):
+                continue
+            try:
+                with open(os.path.join(data_dir, fname), "r", encoding="utf-8") as f:
+                    info = json.load(f)
+            except (OSError, ValueError):
+                continue
+            code = info.get("class_code") or fname[:-len("_info.json")]
+            c.execute("INSERT OR IGNORE INTO classes(code, created) VALUES (?, ?)", (code, now))
+            for i, s in enumerate(info.get("students", [])):
+                c.execute("INSERT OR IGNORE INTO students(class_code, name, added) VALUES (?, ?, ?)",
+                          (code, s, now + i * 1e-6))
+            for i, t in enumerate(info.get("topics", [])):
+                c.execute("INSERT OR IGNORE INTO topics(class_code, file, name, version, created, updated) "
+                          "VALUES (?, ?, ?, NULL, ?, ?)", (code, t["file"], t["name"], now + i * 1e-6, now))
+            n += 1
+        c.execute("INSERT OR REPLACE INTO meta(key, value) VALUES ('legacy_imported', ?)", (str(now),))
+    _LEGACY_CHECKED = True
+    return n
@@ -0,0 +1,36 @@
+"""Cấu hình pytest: chạy trong thư mục tạm với backend nhúng giả lập (không gọi mạng)."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import common
+import jobs
+import kb
+import registry
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """DATA_DIR ("data", đường dẫn tương đối) trỏ vào thư mục tạm; bỏ mọi cache trong process."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("EMBED_CACHE", "0")
+    common.set_embed_backend(common.FakeEmbedBackend(dim=32))
+    common.set_generate_backend(common.FakeGenerateBackend())
+    with registry._LOCK:
+        if registry._CONN is not None:
+            registry._CONN.close()
+        registry._CONN = None
+        registry._CACHE.clear()
+        registry._LEGACY_CHECKED = False
+    with kb._KB_CACHE_LOCK:
+        kb._KB_CACHE.clear()
+        kb._KB_LOAD_LOCKS.clear()
+        kb._KB_CACHE_BYTES = 0
+    with jobs._INDEX_LOCK:
+        jobs._INDEX.clear()
+    yield tmp_path
+    common.set_embed_backend(None)
+    common.set_generate_backend(None)
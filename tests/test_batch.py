@@ -0,0 +1,30 @@
+import threading
+
+import common
+import batch
+import kb
+
+class _BrokenBackend(common.FakeGenerateBackend):
+    def generate(self, prompt: str) -> str:
+        raise ValueError("mô hình hỏng")
+
+class _RecordingSt:
+    def __init__(self):
+        self.threads = []
+
+    def error(self, msg):
+        self.threads.append(threading.current_thread())
+
+def test_answer_batch_reports_errors_to_caller(workdir, monkeypatch):
+    chunks = ["Phương trình bậc hai có hai nghiệm.", "Định lý Pytago cho tam giác vuông."]
+    assert kb.save_knowledge("L1", "toan", chunks, common.embed_texts(chunks)) is True
+    common.set_generate_backend(_BrokenBackend())
+    st = _RecordingSt()
+    monkeypatch.setattr(common, "st", st)
+
+    stats: dict = {}
+    rows = batch.answer_batch("L1", ["toan"], ["Phương trình bậc hai?", "Định lý Pytago?"],
+                              use_cache=False, stats=stats)
+    assert all(r["error"] for r in rows)
+    assert stats["errors"] == ["Lỗi gọi mô hình: mô hình hỏng"]
+    assert st.threads == []      # worker không gọi st.error
@@ -0,0 +1,15 @@
+import numpy as np
+
+import common
+
+def test_embedding_cache_counts_only_new_keys(tmp_path):
+    cache = common.EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=3)
+    vec = np.ones(4, dtype=np.float32)
+    cache.put_many({"a": vec, "b": vec})
+    cache.put_many({"a": vec, "b": vec, "c": vec})
+    assert cache.stats()["entries"] == 3
+    cache.put_many({"c": vec, "d": vec})
+    assert cache.stats()["entries"] == 3
+    assert cache._conn.execute("SELECT COUNT(*) FROM emb").fetchone()[0] == 3
+    found = cache.get_many(["a", "b", "c", "d"])
+    assert len(found) == 3 and {"c", "d"} <= set(found)
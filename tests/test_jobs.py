@@ -0,0 +1,86 @@
+import io
+import json
+import os
+import time
+import zipfile
+
+import numpy as np
+import pytest
+
+import common
+import jobs
+import kb
+import registry
+
+def _upload(name: str, text: str):
+    f = io.BytesIO(text.encode("utf-8"))
+    f.name = name
+    return f
+
+def _zip(members: dict, encrypt: bool = False):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w") as zf:
+        for name, text in members.items():
+            zf.writestr(name, text)
+    data = bytearray(buf.getvalue())
+    if encrypt:     # zipfile không tạo được ZIP có mật khẩu: bật cờ mã hóa trong header
+        pos = 0
+        while (pos := data.find(b"PK\x03\x04", pos)) >= 0:
+            data[pos + 6] |= 1
+            pos += 4
+        pos = 0
+        while (pos := data.find(b"PK\x01\x02", pos)) >= 0:
+            data[pos + 8] |= 1
+            pos += 4
+    f = io.BytesIO(bytes(data))
+    f.name = "tai_lieu.zip"
+    return f
+
+def _wait(job_id: str, timeout: float = 30.0) -> dict:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = jobs.get_job(job_id)
+        if job and job["status"] not in ("queued", "running"):
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} chưa xong sau {timeout}s")
+
+def test_update_job_keeps_int8_and_exact(workdir):
+    registry.create_class("L1")
+    chunks = ["Phương trình bậc hai có hai nghiệm.", "Định lý Pytago cho tam giác vuông."]
+    emb = common.embed_texts(chunks)
+    assert kb.save_knowledge("L1", "toan", chunks, emb, dtype="int8", keep_exact=True) is True
+    assert registry.add_topic("L1", "Toán", "toan", kb.read_meta("L1", "toan")["version"])
+
+    text = "Phương trình bậc hai có hai nghiệm.\n\nHàm số bậc nhất có đồ thị là đường thẳng.\n"
+    job = _wait(jobs.submit_job("L1", "Toán", "toan", _upload("toan.txt", text), mode="update"))
+    assert job["status"] == "done", job["error"]
+
+    meta = kb.read_meta("L1", "toan")
+    assert meta["version"] == 2
+    assert meta["dtype"] == "int8"
+    assert meta.get("exact") is True
+    topic = kb.load_topic("L1", "toan")
+    assert topic.embeddings.dtype == np.int8
+    assert topic.exact is not None and topic.exact.shape == (topic.embeddings.shape[0], 32)
+
+def test_encrypted_zip_is_rejected_with_value_error(workdir):
+    registry.create_class("L1")
+    up = _zip({"a.txt": "Bài 1. Số tự nhiên.", "b.txt": "Bài 2. Phân số."}, encrypt=True)
+    with pytest.raises(ValueError, match="mật khẩu"):
+        jobs.submit_job("L1", "Toán", "toan", up)
+    assert not [n for n in os.listdir(jobs.JOBS_DIR) if n.endswith(".upload")]
+
+def test_finished_jobs_expire_after_retention(workdir):
+    registry.create_class("L1")
+    job = _wait(jobs.submit_job("L1", "Toán", "toan", _upload("toan.txt", "Bài 1. Số tự nhiên.\n")))
+    assert job["status"] == "done", job["error"]
+    assert [j["id"] for j in jobs.list_jobs("L1")] == [job["id"]]
+    assert jobs.list_jobs("L2") == []
+    assert jobs.list_jobs("L1", statuses=("queued", "running")) == []
+
+    job["updated"] = time.time() - jobs.JOB_RETENTION - 1
+    with open(jobs._path(job["id"], "json"), "w", encoding="utf-8") as f:
+        json.dump(job, f)
+    assert jobs.list_jobs() == []
+    assert os.listdir(jobs.JOBS_DIR) == []
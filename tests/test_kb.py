@@ -0,0 +1,118 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import common
+import kb
+
+def test_ivf_search_keeps_top_k_per_query():
+    # cụm 0 chỉ có 2 đoạn, cụm 1 có 40 đoạn; nprobe=1 → câu hỏi 0 chỉ có 2 ứng viên
+    centroids = np.eye(2, 4, dtype=np.float32)
+    ids = np.arange(42, dtype=np.int32)
+    index = kb.IVFIndex(centroids, np.array([0, 2, 42], dtype=np.int64), ids)
+    emb = kb.normalize_rows(np.random.default_rng(0).standard_normal((42, 4)).astype(np.float32))
+    q = kb.normalize_rows(np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float32))
+
+    idx, scores = index.search(emb, q, top_k=5, nprobe=1)
+    assert idx.shape == scores.shape == (2, 5)
+    assert sorted(idx[0, :2].tolist()) == [0, 1]
+    assert (idx[0, 2:] == -1).all() and np.isneginf(scores[0, 2:]).all()
+    expected = 2 + kb.top_k_indices(emb[2:] @ q[1], 5)
+    assert idx[1].tolist() == expected.tolist()
+
+CHUNKS = ["Phương trình bậc hai có hai nghiệm.", "Định lý Pytago cho tam giác vuông.",
+          "Hàm số bậc nhất có đồ thị là đường thẳng."]
+
+def _save_topic():
+    model = common.get_embed_backend().model
+    assert kb.save_knowledge("L1", "toan", CHUNKS, common.embed_texts(CHUNKS), embed_model=model) is True
+    assert kb.read_meta("L1", "toan")["embed_model"] == model
+
+def test_update_reuses_unchanged_chunks(workdir):
+    _save_topic()
+    edited = CHUNKS[:2] + ["Hàm số bậc nhất có đồ thị là một đường thẳng."]
+    out = kb.update_knowledge("L1", "toan", edited, common.embed_texts,
+                              embed_model=common.get_embed_backend().model)
+    assert (out["reused"], out["embedded"], out["removed"]) == (2, 1, 1)
+
+@pytest.mark.parametrize("backend", [common.FakeEmbedBackend(dim=32, model="fake-embedding-2"),
+                                     common.FakeEmbedBackend(dim=4)], ids=["model", "dim"])
+def test_update_reembeds_everything_after_model_change(workdir, backend):
+    _save_topic()
+    common.set_embed_backend(backend)
+    out = kb.update_knowledge("L1", "toan", CHUNKS, common.embed_texts, embed_model=backend.model)
+    assert (out["reused"], out["embedded"]) == (0, 3)
+    topic = kb.load_topic("L1", "toan")
+    emb = np.asarray(topic.embeddings, dtype=np.float32)
+    assert emb.shape == (3, backend.dim)
+    assert (np.abs(emb).sum(axis=1) > 0).all()
+    assert kb.read_meta("L1", "toan")["embed_model"] == backend.model
+
+def _write_legacy(chunks, emb):
+    text_fp, emb_fp = kb._base_paths("L1", "cu")
+    os.makedirs(os.path.dirname(text_fp), exist_ok=True)
+    with open(text_fp, "w", encoding="utf-8") as f:
+        json.dump(chunks, f, ensure_ascii=False)
+    np.save(emb_fp, emb)
+
+def test_legacy_topic_with_dropped_blank_chunks_stays_aligned(workdir):
+    emb = common.embed_texts(CHUNKS)
+    _write_legacy([CHUNKS[0], "  ", CHUNKS[1], CHUNKS[2]], emb)
+    chunks, loaded = kb.load_knowledge("L1", "cu")
+    assert list(chunks) == CHUNKS
+    assert np.allclose(loaded, kb.normalize_rows(emb), atol=1e-5)
+    assert kb.missing_vectors("L1", "cu") == 0
+
+def test_legacy_topic_with_missing_vectors_is_still_served(workdir):
+    emb = common.embed_texts(CHUNKS[:2])
+    _write_legacy(CHUNKS, emb)          # vector của đoạn cuối bị mất khi nhúng
+    chunks, loaded = kb.load_knowledge("L1", "cu")
+    assert list(chunks) == CHUNKS and loaded.shape == (3, 32)
+    assert kb.missing_vectors("L1", "cu") == 1
+
+    out = kb.update_knowledge("L1", "cu", CHUNKS, common.embed_texts)
+    assert (out["reused"], out["embedded"]) == (2, 1)
+    assert kb.missing_vectors("L1", "cu") == 0
+    assert (np.abs(np.asarray(kb.load_topic("L1", "cu").embeddings)).sum(axis=1) > 0).all()
+
+def test_lexical_only_answers_are_cached_and_respect_min_score(workdir):
+    chunks = ["Định luật Ôm: cường độ dòng điện tỉ lệ thuận với hiệu điện thế.",
+              "Công suất điện bằng tích hiệu điện thế và cường độ dòng điện.",
+              "Nhiệt lượng tỏa ra trên dây dẫn theo định luật Jun Len-xơ."]
+    assert kb.save_knowledge("L1", "ly", chunks, common.embed_texts(chunks)) is True
+
+    def no_embed(q):
+        raise AssertionError("không được nhúng câu hỏi khớp từ khóa rõ ràng")
+
+    question = "Định luật Jun Len-xơ"
+    hits, qvec = kb.hybrid_search("L1", ["ly"], question, no_embed, top_k=3)
+    assert qvec is None and hits[0].index == 2 and hits[0].score == 1.0
+    assert len(hits) > 1 and hits[-1].score < 0.5
+    strict, _ = kb.hybrid_search("L1", ["ly"], question, no_embed, top_k=3, min_score=0.5)
+    assert all(h.score >= 0.5 for h in strict) and strict[0].index == 2
+
+    cache = kb.AnswerCache()
+    assert cache.lookup("L1", ["ly"], None, hits, question=question) is None
+    cache.store("L1", ["ly"], None, question, "Q = I²Rt", hits)
+    assert cache.lookup("L1", ["ly"], None, hits, question="  định luật jun len-xơ ")["answer"] == "Q = I²Rt"
+    assert cache.stats()["entries"] == 1
+
+def test_answer_cache_counts_entries_and_evicts_least_recently_used(workdir):
+    cache = kb.AnswerCache(max_entries=10)
+    rng = np.random.default_rng(0)
+    cache.store("L1", ["ly"], rng.standard_normal((1, 8)), "cũ", "a")
+    cache.store("L1", ["ly"], rng.standard_normal((1, 16)), "mới", "b")
+    assert cache.stats()["entries"] == 1
+
+    vecs = kb.normalize_rows(rng.standard_normal((10, 16)))
+    for i, v in enumerate(vecs[:9]):
+        cache.store("L1", ["ly"], v[None], f"c{i}", f"t{i}")
+    assert cache.lookup("L1", ["ly"], vecs[0][None])["answer"] == "t0"
+    cache.store("L1", ["ly"], vecs[9][None], "c9", "t9")
+    stats = cache.stats()
+    assert stats["entries"] == 9 and stats["evictions"] == 2
+    assert cache.lookup("L1", ["ly"], vecs[0][None])["answer"] == "t0"
+    assert cache.lookup("L1", ["ly"], vecs[1][None]) is None
+    assert cache.lookup("L1", ["ly"], vecs[9][None])["answer"] == "t9"